@@ -0,0 +1,239 @@
+"""
+Scaling benchmark for the spacia pipeline.
+
+Simulates datasets of increasing size and times each pipeline stage of
+spacia.py (loading, neighbor search, pathway construction and job input
+preparation), together with its CPU time and peak resident memory.
+With '--mcmc', a full spacia.py run with small MCMC parameters is also
+timed for every size, covering the MCMC jobs and result collection.
+
+Results are saved as json, and two result files can be compared with
+'--compare'.
+
+Usage:
+    python run_benchmark.py -n 2000,10000,50000 -l baseline
+    python run_benchmark.py --compare results/baseline.json results/new.json
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import subprocess
+import tempfile
+import numpy as np
+import pandas as pd
+
+benchmark_path = os.path.dirname(os.path.abspath(__file__))
+spacia_root = os.path.dirname(benchmark_path)
+sys.path.insert(0, spacia_root)
+sys.path.insert(0, os.path.join(spacia_root, "spacia"))
+import spacia as sp
+from Run_Profiler import RunProfiler
+from simulate_data import simulate_spatial_data, write_spatial_data
+
+
+def run_stages(counts_fn, meta_fn, receiver, sender, n_neighbors, bag_size, nb, output_path):
+    """
+    Time the python stages of spacia.py on one dataset.
+
+    The stages are run by the functions of spacia.py: load_data, then
+    prepare_spacia_jobs of the receiver/sender pair, with a '|' joined
+    receiver pathway and the pca sender mode, which finds the bags,
+    constructs the pathways and writes the job inputs to output_path
+    without running the MCMC jobs. Each stage is timed by the RunProfiler
+    of spacia.py, so the benchmark follows the pipeline as it changes.
+    """
+    profiler = RunProfiler(output_path)
+    args = sp.default_args(
+        counts_fn, meta_fn, receiver_cluster=receiver, sender_cluster=sender,
+        receiver_features="gene1|gene3", sender_features="pca",
+        n_neighbors=n_neighbors, bag_size=bag_size, number_bags=nb,
+        output_path=output_path,
+    )
+    np.random.seed(0)
+    profiler.start_stage("load")
+    data = sp.load_data(counts_fn, meta_fn)
+    spot_meta = data["spot_meta"]
+    r_cells = np.flatnonzero(spot_meta.cell_type == receiver)
+    s_cells = np.flatnonzero(spot_meta.cell_type == sender)
+    sp.prepare_spacia_jobs(
+        data["cpm"], spot_meta, r_cells, s_cells, output_path, args,
+        data["spatial_index"], sender, profiler, cells=data["cells"],
+    )
+    profiler.end_stage()
+
+    records = []
+    for stage in profiler.stages:
+        record = {
+            "stage": stage["stage"],
+            "wall_s": stage["wall_s"],
+            "cpu_s": stage["cpu_s"],
+            "peak_mem_mb": stage["peak_rss_mb"],
+        }
+        print("\t{stage:<22} wall {wall_s:>9.3f}s  cpu {cpu_s:>9.3f}s  peak {peak_mem_mb:>9.1f}MB".format(**record))
+        records.append(record)
+    with open(os.path.join(output_path, "model_input", "dist_sender.json")) as f:
+        n_bags = len(json.load(f))
+    return records, n_bags
+
+
+def run_end_to_end(counts_fn, meta_fn, receiver, sender, output_path, mcmc_params):
+    """
+    Time a full spacia.py run, including the R MCMC jobs and collection.
+
+    Peak memory is the maximal resident set size of spacia.py and its
+    child processes. The stages recorded in the run report of spacia.py
+    are added as 'end_to_end:<stage>'.
+    """
+    cmd = [
+        sys.executable, os.path.join(spacia_root, "spacia.py"),
+        counts_fn, meta_fn, "-rc", receiver, "-sc", sender,
+        "-rf", "gene1", "-sf", "gene2,gene3", "-m", mcmc_params,
+        "-o", output_path,
+    ]
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - t0
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    maxrss = rusage.ru_maxrss / (2**20 if sys.platform == "darwin" else 2**10)
+    record = {
+        "stage": "end_to_end",
+        "wall_s": round(wall, 4),
+        "cpu_s": round(rusage.ru_utime + rusage.ru_stime, 4),
+        "peak_mem_mb": round(maxrss, 2),
+        "returncode": os.waitstatus_to_exitcode(status),
+    }
+    print("\t{stage:<22} wall {wall_s:>9.3f}s  cpu {cpu_s:>9.3f}s  peak {peak_mem_mb:>9.1f}MB".format(**record))
+    records = [record]
+    # per stage breakdown from the run report of spacia.py
+    report_fn = os.path.join(output_path, "run_report.json")
+    if os.path.exists(report_fn):
+        with open(report_fn) as f:
+            report = json.load(f)
+        for stage in report["stages"]:
+            records.append({
+                "stage": "end_to_end:" + stage["stage"],
+                "wall_s": stage["wall_s"],
+                "cpu_s": stage["cpu_s"],
+                "peak_mem_mb": stage["peak_rss_mb"],
+            })
+    return records
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=spacia_root,
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def compare_results(base_fn, new_fn):
+    """
+    Print the per-stage ratios of two benchmark result files.
+    """
+    tables = []
+    for fn in [base_fn, new_fn]:
+        with open(fn) as f:
+            tables.append(pd.DataFrame(json.load(f)["results"]))
+    keys = ["n_cells", "n_genes", "stage"]
+    merged = tables[0].merge(tables[1], on=keys, suffixes=("_base", "_new"))
+    for col in ["wall_s", "cpu_s", "peak_mem_mb"]:
+        merged[col + "_ratio"] = (
+            merged[col + "_new"] / merged[col + "_base"].replace(0, np.nan)
+        ).round(3)
+    cols = keys + [
+        "wall_s_base", "wall_s_new", "wall_s_ratio",
+        "peak_mem_mb_base", "peak_mem_mb_new", "peak_mem_mb_ratio",
+    ]
+    with pd.option_context("display.width", 200, "display.max_rows", None):
+        print(merged[cols].to_string(index=False))
+    return merged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Scaling benchmark of spacia stages on simulated data.",
+    )
+    parser.add_argument(
+        "--n_cells", "-n", type=str, default="2000,10000,50000",
+        help="Comma separated numbers of cells to sweep.")
+    parser.add_argument(
+        "--n_genes", "-g", type=str, default="100",
+        help="Comma separated numbers of genes to sweep.")
+    parser.add_argument(
+        "--cell_type_mix", "-t", type=str, default="A:0.5,B:0.5",
+        help="Cell type fractions. The first type is used as receiver and \
+            the last as sender.")
+    parser.add_argument("--density", "-d", type=float, default=1.0, help="Cells per unit area.")
+    parser.add_argument("--n_neighbors", type=float, default=10, help="Expected number of neighbors.")
+    parser.add_argument("--bag_size", "-b", type=int, default=2, help="Minimal bag size.")
+    parser.add_argument("--number_bags", "-nb", type=int, default=5000, help="Number of bags.")
+    parser.add_argument(
+        "--mcmc", action="store_true", default=False,
+        help="Also time a full spacia.py run, requires R.")
+    parser.add_argument(
+        "--mcmc_params", "-m", type=str, default="2000,1000,10,1",
+        help="MCMC parameters for the full run.")
+    parser.add_argument("--label", "-l", type=str, default=None, help="Name of this benchmark run.")
+    parser.add_argument(
+        "--output_path", "-o", type=str,
+        default=os.path.join(benchmark_path, "results"), help="Folder for result files.")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("BASE", "NEW"), default=None,
+        help="Compare two result files instead of running the benchmark.")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        compare_results(*args.compare)
+        sys.exit(0)
+
+    label = args.label or time.strftime("%Y%m%d_%H%M%S")
+    mix = args.cell_type_mix.split(",")
+    receiver, sender = mix[0].split(":")[0], mix[-1].split(":")[0]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_genes in [int(x) for x in args.n_genes.split(",")]:
+            for n_cells in [int(x) for x in args.n_cells.split(",")]:
+                print("Benchmarking {} cells x {} genes".format(n_cells, n_genes))
+                data_path = os.path.join(tmp, "sim_{}_{}".format(n_cells, n_genes))
+                expression, meta, truth = simulate_spatial_data(
+                    n_cells, n_genes, args.cell_type_mix, args.density)
+                counts_fn, meta_fn = write_spatial_data(expression, meta, truth, data_path)
+                del expression, meta
+                records, n_bags = run_stages(
+                    counts_fn, meta_fn, receiver, sender,
+                    args.n_neighbors, args.bag_size, args.number_bags,
+                    os.path.join(data_path, "stages"))
+                if args.mcmc:
+                    records += run_end_to_end(
+                        counts_fn, meta_fn, receiver, sender,
+                        os.path.join(data_path, "spacia"), args.mcmc_params)
+                for rec in records:
+                    rec.update({"n_cells": n_cells, "n_genes": n_genes, "n_bags": n_bags})
+                results += records
+
+    if not os.path.exists(args.output_path):
+        os.makedirs(args.output_path)
+    result_fn = os.path.join(args.output_path, label + ".json")
+    with open(result_fn, "w") as f:
+        json.dump(
+            {
+                "label": label,
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "git_commit": get_git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "params": vars(args),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print("Benchmark results saved to {}".format(result_fn))
@@ -0,0 +1,169 @@
+"""
+Synthetic spatial transcriptomics data for benchmarking spacia.
+
+Generates a cells-by-genes expression matrix (log1p cpm, like the inputs
+expected by spacia.py) and a metadata table with 'X', 'Y' and 'cell_type'
+columns. Sender->receiver effects are planted by raising the response gene
+in receiver cells that have a neighboring sender cell with high expression
+of the signal gene.
+
+Usage:
+    python simulate_data.py -n 10000 -g 200 -t A:0.5,B:0.5 -o sim_10k
+"""
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+
+def parse_cell_type_mix(cell_type_mix):
+    """
+    Parse 'A:0.5,B:0.3,C:0.2' into a dict of cell type fractions.
+    """
+    if isinstance(cell_type_mix, dict):
+        return cell_type_mix
+    mix = {}
+    for item in cell_type_mix.split(","):
+        name, frac = item.split(":")
+        mix[name] = float(frac)
+    return mix
+
+
+def simulate_spatial_data(
+    n_cells=5000,
+    n_genes=100,
+    cell_type_mix="A:0.5,B:0.5",
+    density=1.0,
+    effects=None,
+    effect_radius=3.0,
+    depth=2000,
+    seed=0,
+):
+    """
+    Simulate expression and spatial metadata with planted interactions.
+
+    Parameters:
+    n_cells (int): Number of cells.
+    n_genes (int): Number of genes, named gene1, gene2, ...
+    cell_type_mix (str or dict): Cell type fractions, e.g. 'A:0.5,B:0.5'.
+    density (float): Cells per unit area, cells are placed uniformly in a
+        square of side sqrt(n_cells / density).
+    effects (list): Planted effects as tuples of (sender_type, signal_gene,
+        receiver_type, response_gene, strength). Defaults to gene2 in the
+        second cell type driving gene1 in the first one.
+    effect_radius (float): Maximal sender to receiver distance of an effect.
+    depth (int): Mean number of counts per cell.
+    seed (int): Random seed.
+
+    Returns:
+    Tuple[pd.DataFrame, pd.DataFrame, dict]: expression (cells x genes),
+        metadata (X, Y, cell_type) and a dict describing the ground truth.
+    """
+    rng = np.random.default_rng(seed)
+    mix = parse_cell_type_mix(cell_type_mix)
+    cell_types = list(mix.keys())
+    probs = np.array([mix[x] for x in cell_types], dtype=float)
+    probs = probs / probs.sum()
+    if effects is None:
+        effects = [(cell_types[-1], "gene2", cell_types[0], "gene1", 1.5)]
+
+    cells = np.array(["cell_" + str(i) for i in range(n_cells)])
+    genes = ["gene" + str(i + 1) for i in range(n_genes)]
+    side = np.sqrt(n_cells / density)
+    xy = rng.uniform(0, side, size=(n_cells, 2)).round(2)
+    cell_type = rng.choice(cell_types, size=n_cells, p=probs)
+    meta = pd.DataFrame(
+        {"X": xy[:, 0], "Y": xy[:, 1], "cell_type": cell_type}, index=cells
+    )
+
+    # gene means differ between cell types by a small random fold change
+    gene_means = rng.gamma(2, 1, size=n_genes)
+    type_fc = {
+        ct: np.exp(rng.normal(0, 0.3, size=n_genes)) for ct in cell_types
+    }
+    rates = np.vstack([type_fc[ct] for ct in cell_type]) * gene_means
+    size_factor = rng.lognormal(0, 0.2, size=n_cells)
+    rates *= (depth * size_factor / rates.sum(axis=1))[:, None]
+    counts = rng.poisson(rates).astype(float)
+
+    # plant effects on the response genes
+    truth = {"effects": [], "effect_radius": effect_radius, "seed": seed}
+    gene_idx = {g: i for i, g in enumerate(genes)}
+    for sender_type, signal_gene, receiver_type, response_gene, strength in effects:
+        s_idx = np.where(cell_type == sender_type)[0]
+        r_idx = np.where(cell_type == receiver_type)[0]
+        signal = np.log1p(counts[s_idx, gene_idx[signal_gene]])
+        signal = (signal - signal.mean()) / (signal.std() + 1e-12)
+        s_tree = cKDTree(xy[s_idx])
+        r_tree = cKDTree(xy[r_idx])
+        pairs = r_tree.sparse_distance_matrix(
+            s_tree, effect_radius, output_type="coo_matrix"
+        )
+        # the strongest high-signal neighbor is the primary instance
+        activation = np.zeros(len(r_idx))
+        np.maximum.at(activation, pairs.row, np.maximum(signal[pairs.col], 0))
+        response = rng.poisson(
+            rates[r_idx, gene_idx[response_gene]] * np.expm1(strength * activation)
+        )
+        counts[r_idx, gene_idx[response_gene]] += response
+        truth["effects"].append(
+            {
+                "sender_type": sender_type,
+                "signal_gene": signal_gene,
+                "receiver_type": receiver_type,
+                "response_gene": response_gene,
+                "strength": strength,
+                "n_activated_receivers": int((activation > 0).sum()),
+            }
+        )
+
+    cpm = np.log1p(1e4 * counts / counts.sum(axis=1, keepdims=True))
+    expression = pd.DataFrame(cpm.round(5), index=cells, columns=genes)
+    return expression, meta, truth
+
+
+def write_spatial_data(expression, meta, truth, output_path):
+    """
+    Write simulated data in the spacia.py input format.
+    """
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    counts_fn = os.path.join(output_path, "counts.txt")
+    meta_fn = os.path.join(output_path, "spacia_metadata.txt")
+    expression.to_csv(counts_fn, sep="\t")
+    meta.to_csv(meta_fn, sep="\t")
+    with open(os.path.join(output_path, "truth.json"), "w") as f:
+        json.dump(truth, f, indent=2)
+    return counts_fn, meta_fn
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Simulate spatial expression data with planted sender->receiver effects.",
+    )
+    parser.add_argument("--n_cells", "-n", type=int, default=5000, help="Number of cells.")
+    parser.add_argument("--n_genes", "-g", type=int, default=100, help="Number of genes.")
+    parser.add_argument(
+        "--cell_type_mix", "-t", type=str, default="A:0.5,B:0.5",
+        help="Cell type fractions, e.g. 'A:0.5,B:0.3,C:0.2'.")
+    parser.add_argument(
+        "--density", "-d", type=float, default=1.0, help="Cells per unit area.")
+    parser.add_argument(
+        "--effect_radius", "-r", type=float, default=3.0,
+        help="Maximal sender to receiver distance of the planted effect.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument("--output_path", "-o", type=str, default="sim", help="Output path")
+    args = parser.parse_args()
+
+    expression, meta, truth = simulate_spatial_data(
+        args.n_cells,
+        args.n_genes,
+        args.cell_type_mix,
+        args.density,
+        effect_radius=args.effect_radius,
+        seed=args.seed,
+    )
+    write_spatial_data(expression, meta, truth, args.output_path)
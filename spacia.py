@@ -5,26 +5,39 @@ import argparse
 import logging
 import csv
 import json
+import re
+import hashlib
+import queue
+import shutil
+import warnings
+import itertools
+import subprocess
 from multiprocessing import Pool
-import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-from scipy.spatial.distance import cdist
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.preprocessing import scale
-from sklearn.mixture import GaussianMixture
-from sklearn.decomposition import PCA
-from scipy import stats
 import pprint
+# scipy, sklearn and matplotlib are imported by the functions using them,
+# so that the command line and `import spacia` start fast
+# supporting python modules are kept with the R codes in the spacia folder
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "spacia"))
+from Run_Profiler import RunProfiler, run_timed_command
+from Job_Monitor import JobMonitor, read_status
+from Work_Queue import WorkQueue
+from MCMC_Diagnostics import diagnose_job, plot_jobs
+from Pathway_Screen import bag_means, screen_pathways, passing_pathways
+from Spatial_Index import (
+    ProximityGraph, SpatialIndex, find_sender_candidates_by_sample,
+    find_sender_candidates_tiled)
 
 def spacia_worker(cmd):
     """
-    worker function for multiprocessing.
+    worker function for multiprocessing. Returns the wall time, CPU time and
+    peak RSS of the job.
     """
-    os.system(cmd)
+    return run_timed_command(cmd)
     # remove temp job input files
     # os.system('rm -f {}'.format(' '.join(spacia_job_inputs)))
-    return
 
 def cal_norm_dispersion(cts):
     '''
@@ -64,6 +77,8 @@ def cal_norm_dispersion(cts):
 def calculate_neighbor_radius(
     spot_meta, r_cells, s_cells, sample_size=1000, target_n_neighbors=10,
 ):
+    from scipy.spatial.distance import cdist
+
     r_spot_meta = spot_meta.loc[r_cells]
     s_spot_meta = spot_meta.loc[s_cells]
     if sample_size >= r_spot_meta.shape[0]:
@@ -100,6 +115,8 @@ def find_sender_candidates(r_cells, s_cells, locations, dist_cutoff=30):
     r_cells, s_cells: list of spot ids.
     locations: pd.DataFrame of X, Y locations
     """
+    from scipy.spatial.distance import cdist
+
     pip = pd.Series(dtype=object)
     n_chunks = int(np.ceil(len(r_cells)/10000))
     for c in range(n_chunks):
@@ -154,11 +171,13 @@ def preprocessing_counts(
     return filtered_cpm
 
 def get_corr_agg_genes(corr_agg, cpm, cells, g, top_corr_genes, agg_method):
+    from scipy.spatial.distance import cdist
+
     if corr_agg:
         print('Constructing pathway using correlation aggregation')
         corr = 1-cdist(
-            cpm.loc[cells, g].values.reshape(1, -1),
-            cpm.loc[cells].T,
+            cpm[g].iloc[cells].values.reshape(1, -1),
+            cpm.iloc[cells].T,
             metric="correlation",
         )[0]
         pathway_genes = pd.Series(corr, index = cpm.columns)
@@ -185,7 +204,13 @@ def contruct_pathways(
     agg_method,
     n_pc = 20,
     pca_gene = None,
+    corr_agg = True,
+    top_corr_genes = 100,
 ):
+    from sklearn.cluster import AgglomerativeClustering
+    from sklearn.decomposition import PCA
+    from sklearn.preprocessing import scale
+
     receiver_pathways = {}
     sender_pathways = {}
     for pathway_dict, pathway_features, pathway_type in zip(
@@ -195,7 +220,7 @@ def contruct_pathways(
     ):
         cells  = receiver_candidates if pathway_type == "Receiver" else sender_candidates
         if pathway_features == 'pca':
-            pathway_exp = cpm.loc[cells,:]
+            pathway_exp = cpm.iloc[cells]
             # Remove genes with all 0s
             pathway_exp = pathway_exp.T[pathway_exp.std() > 0].T
             # Calculate normalized dispersion and use it as cutoff
@@ -226,7 +251,7 @@ def contruct_pathways(
             )
             # Get gene modules
             
-            pathway_exp = cpm.loc[cells,:]
+            pathway_exp = cpm.iloc[cells]
             # Remove genes with all 0s
             pathway_exp = pathway_exp.T[pathway_exp.std() > 0].T
             
@@ -335,13 +360,20 @@ def remove_outliers(betas):
     return betas
 
 def process_b(df_b, spacia_res_path, chain_size, n_chains):
+    '''
+    chain_size can be None if chains were stopped early by the adaptive mode,
+    in which case it is inferred from the number of samples in each job.
+    '''
+    from scipy import stats
+
     df_b = df_b.groupby(df_b.index).first()
-    remove = [x*chain_size for x in range(n_chains)]
     indiv_results = df_b.index.unique()
     planned = os.listdir(spacia_res_path)
     for fn in [
         'Interactions.csv', 'B_and_FDR.csv', 'spacia_log.txt', 
-        'Pathway_betas.csv', 'spacia_r.log', 'model_input']:
+        'Pathway_betas.csv', 'spacia_r.log', 'model_input',
+        'run_report.json', 'profiles', 'mcmc_progress.tsv', 'slide_reports',
+        'proximity_graph.npz', 'Prefilter_stats.csv', 'MCMC_diagnostics.csv']:
         try:
             planned.remove(fn)
         except:
@@ -357,11 +389,16 @@ def process_b(df_b, spacia_res_path, chain_size, n_chains):
             continue
         # print(fn_b)
         indiv_b = pd.read_csv(fn_b, header=None, sep='\t', skiprows=1).iloc[:,2]
+        job_chain_size = chain_size
+        if job_chain_size is None:
+            job_chain_size = indiv_b.shape[0] // n_chains
+        remove = [x*job_chain_size for x in range(n_chains)]
         indiv_b = indiv_b[~indiv_b.index.isin(remove)]
         arr = []
         for i in range(n_chains):
-            chain_df = indiv_b[chain_size*i:chain_size*(i+1)]
-            arr += chain_df.sample(50, replace=False).tolist()
+            chain_df = indiv_b[job_chain_size*i:job_chain_size*(i+1)]
+            arr += chain_df.sample(
+                min(50, chain_df.shape[0]), replace=False).tolist()
         arr = np.array(arr)
         pval = stats.ttest_1samp(arr, 0, alternative='less')[1]
         df_b.loc[fn, 'pval'] = pval
@@ -370,8 +407,9 @@ def process_b(df_b, spacia_res_path, chain_size, n_chains):
 
 def process_beta(
     pathway_beta, spacia_res_path, chain_size, n_chains, mode = 'pca'):
+    from scipy import stats
+
     indiv_results = pathway_beta.index.unique()
-    remove = [x*chain_size for x in range(n_chains)]
     if mode == 'pca':
         pathway_beta = {
             'RG':[], 
@@ -384,6 +422,10 @@ def process_beta(
         if not os.path.exists(fn_beta):
             continue
         df_beta = pd.read_csv(fn_beta, sep='\t').reset_index().iloc[:,1:]
+        job_chain_size = chain_size
+        if job_chain_size is None:
+            job_chain_size = df_beta.shape[0] // n_chains
+        remove = [x*job_chain_size for x in range(n_chains)]
         df_beta = df_beta[~df_beta.index.isin(remove)]
         if mode == 'pca':
             pca_loadings = pd.read_csv(
@@ -399,8 +441,10 @@ def process_beta(
         for gene in df_beta.columns:
             arr = []
             for i in range(n_chains):
-                chain_df = df_beta[chain_size*i:chain_size*(i+1)][gene]
-                arr += chain_df.sample(50, replace=False).tolist()
+                chain_df = df_beta[
+                    job_chain_size*i:job_chain_size*(i+1)][gene]
+                arr += chain_df.sample(
+                    min(50, chain_df.shape[0]), replace=False).tolist()
             arr = np.array(arr)
             mean_beta = df_beta[gene].mean()
             pval = stats.ttest_1samp(arr, 0)[1]
@@ -428,8 +472,871 @@ def p_adjust_bh(p):
     steps = float(len(p)) / np.arange(len(p), 0, -1)
     q = np.minimum(1, np.minimum.accumulate(steps * p[by_descend]))
     return q[by_orig]
-#%%
-if __name__ == "__main__":
+
+def parse_pairs(pairs, cell_types):
+    """
+    Parse the '--pairs' argument into a list of (receiver, sender) cell
+    types. 'all' gives every ordered pair of two different cell types.
+    """
+    if pairs == 'all':
+        return [(r, s) for r in cell_types for s in cell_types if r != s]
+    res = []
+    for pair in pairs.split(','):
+        pair = pair.strip().split(':')
+        if len(pair) != 2:
+            raise ValueError(
+                "Pairs must be given as 'receiver:sender', separated by ','!")
+        for c_name in pair:
+            if c_name not in cell_types:
+                raise ValueError('{} not found in cell types!'.format(c_name))
+        res.append(tuple(pair))
+    return res
+
+def pair_folder_name(receiver_cluster, sender_cluster):
+    """Output folder of a receiver/sender pair in the batch mode."""
+    return re.sub(
+        r'[^\w.-]', '_', '{}-{}'.format(receiver_cluster, sender_cluster))
+
+# parameters of '--sweep', with the type of their values
+SWEEP_PARAMS = {'response_exp_cutoff': str, 'num_corr_genes': int, 'bag_size': int}
+
+# model_input files common to all jobs of a pair, see prepare_spacia_jobs
+SENDER_INPUT_FILES = [
+    'metadata.txt', 'dist_sender.json', 'exp_sender.json',
+    'receiver_pathways.json', 'sender_pathways.json', 'sender_pc.csv',
+]
+
+def parse_sweep(sweep):
+    """
+    Parse the '--sweep' argument, e.g. 'response_exp_cutoff=0.3,0.5;bag_size=2,4',
+    into the parameter points of the grid of all combinations, as dicts of
+    parameter values.
+    """
+    names, grid = [], []
+    for param in sweep.split(';'):
+        param = param.strip().split('=')
+        name = param[0].strip()
+        if (len(param) != 2) or (name not in SWEEP_PARAMS):
+            raise ValueError(
+                "Sweep parameters must be given as 'name=value,value' separated "
+                "by ';', with names in {}!".format(', '.join(SWEEP_PARAMS)))
+        if name in names:
+            raise ValueError('{} is swept twice!'.format(name))
+        values = [x.strip() for x in param[1].split(',') if x.strip() != '']
+        for x in values:
+            if (name == 'response_exp_cutoff') & (x == 'auto'):
+                continue
+            try:
+                float(x) if SWEEP_PARAMS[name] is str else SWEEP_PARAMS[name](x)
+            except ValueError:
+                raise ValueError('{} is not a valid value of {}!'.format(x, name))
+        names.append(name)
+        grid.append([SWEEP_PARAMS[name](x) for x in values])
+    return [dict(zip(names, x)) for x in itertools.product(*grid)]
+
+def sweep_point_name(point):
+    """Output folder of a parameter point in the sweep mode."""
+    return re.sub(r'[^\w.-]', '_', '_'.join(
+        '{}-{}'.format(name, value) for name, value in point.items()))
+
+def link_sender_inputs(src_folder, dst_folder):
+    """
+    Link the model_input files common to all jobs of a pair from the
+    model_input folder of another parameter point, copying them if the
+    file system has no hard links.
+    """
+    for fn in SENDER_INPUT_FILES:
+        src = os.path.join(src_folder, fn)
+        dst = os.path.join(dst_folder, fn)
+        if not os.path.exists(src):
+            continue
+        if os.path.exists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+def finished_job_inference(job_folder, job_id):
+    """
+    Inference of a job finished by an earlier run into the same output path,
+    or None if it did not finish: 'laplace' if the status of MIL_Laplace.py
+    says done, 'mcmc' if the spacia_job.R log ends with its time difference.
+    The status is read first, as Laplace fits also wrote that log line.
+    """
+    status = read_status(os.path.join(job_folder, job_id + '_status.json')) or {}
+    if status.get('method') == 'laplace':
+        return 'laplace' if status.get('phase') == 'done' else None
+    log_path = os.path.join(job_folder, job_id + '_log.txt')
+    if os.path.exists(log_path):
+        with open(log_path, 'r') as f:
+            if any('Time difference' in x for x in f):
+                return 'mcmc'
+    return None
+
+def bag_fingerprint(model_input_folder):
+    """
+    md5 of the metadata.txt of a model_input folder, which lists the sender
+    cells of each bag in order, so that two runs with the same fingerprint
+    have the same instances. spacia_job.R saves it in the chains state as
+    'bags'. None if the folder has no metadata.txt.
+    """
+    try:
+        with open(os.path.join(model_input_folder, 'metadata.txt'), 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def warm_start_inits(prev_job_folder, job_id, sender_names, mode='mean', bags=None):
+    """
+    Initial values of the MCMC chains of a job from the chains state saved by
+    a previous run of the same job (see MIL_C2Cinter), for spacia_job.R.
+
+    The betas of the previous run are matched to the current sender
+    pathways by name, pathways new to this run start at the prior mean 0.
+    In 'mean' mode, all chains start around the posterior means, dispersed
+    by the posterior sd; in 'last' mode, each chain continues from the last
+    draw of a previous chain. Its primary instances are only reused if the
+    bag fingerprint of the previous run (see bag_fingerprint) is bags, and
+    are otherwise drawn again by spacia_job.R.
+
+    Returns None if the previous run has no chains state for this job.
+    """
+    try:
+        with open(os.path.join(prev_job_folder, job_id + '_state.json')) as f:
+            state = json.load(f)
+        with open(os.path.join(prev_job_folder, job_id + '_features.json')) as f:
+            prev_names = json.load(f)
+    except (OSError, ValueError):
+        return None
+    prev_pos = {name: i + 1 for i, name in enumerate(prev_names)}
+
+    def match(beta, default=0):
+        # intercept followed by the sender pathways
+        return [beta[0]] + [
+            beta[prev_pos[x]] if x in prev_pos else default for x in sender_names]
+
+    if mode == 'mean':
+        # the prior sd is 1 for the pathways new to this run
+        chains = [{
+            'beta': match(state['mean']['beta']),
+            'b': state['mean']['b'],
+            'beta_sd': match(state['mean']['beta_sd'], 1),
+            'b_sd': state['mean']['b_sd'],
+        }]
+    else:
+        same_bags = (bags is not None) and (state.get('bags') == bags)
+        if not same_bags:
+            print('The bags of {} differ from {}, its primary instances are drawn again.'.format(
+                job_id, prev_job_folder))
+        chains = [
+            {'beta': match(x['beta']), 'b': x['b']} for x in state['chains']]
+        if same_bags:
+            for chain, x in zip(chains, state['chains']):
+                chain['delta'] = x['delta']
+    return {'chains': chains}
+
+def find_pair_bags(
+    spot_meta, r_cells, s_cells, args, spatial_index=None, index_key=None,
+    samples=None, tmp_dir=None,
+):
+    """
+    Find the bags of sender cells within the neighbor radius of each
+    receiver cell, with the radius of args.dist_cutoff or estimated for
+    args.n_neighbors expected neighbors. See prepare_spacia_jobs for
+    spatial_index, index_key and samples.
+
+    Returns the ProximityGraph of the non-empty bags, the radius and the
+    statistics of each slide. The distances are float32 with args.float32.
+    """
+    dist_cutoff = args.dist_cutoff
+    n_neighbors = args.n_neighbors
+    if (dist_cutoff is None) & (samples is not None):
+        slide_radius = []
+        for slide in pd.unique(samples.loc[r_cells]):
+            slide_cells = samples.index[samples == slide]
+            slide_r_cells = pd.Index(r_cells).intersection(slide_cells, sort=False)
+            slide_s_cells = pd.Index(s_cells).intersection(slide_cells, sort=False)
+            if (len(slide_r_cells) == 0) | (len(slide_s_cells) == 0):
+                continue
+            slide_radius.append(calculate_neighbor_radius(
+                spot_meta.loc[slide_cells].iloc[:, :2], slide_r_cells,
+                slide_s_cells, target_n_neighbors=n_neighbors,
+            ))
+        if len(slide_radius) == 0:
+            raise ValueError('No slide has both receiver and sender cells!')
+        dist_cutoff = np.median(slide_radius)
+        print(
+            "Maximal distance for {} expected neighbors is {:.2f} (median of {} slides)".format(
+                n_neighbors, dist_cutoff, len(slide_radius)
+            )
+        )
+    elif dist_cutoff is None:
+        dist_cutoff = calculate_neighbor_radius(
+            spot_meta.iloc[:, :2], r_cells, s_cells, target_n_neighbors=n_neighbors, 
+        )
+        print(
+            "Maximal distance for {} expected neighbors is {:.2f}".format(
+                n_neighbors, dist_cutoff
+            )
+    )
+
+    # bags of each receiver, see ProximityGraph
+    slides = []
+    if args.tile_size is not None:
+        bags, tiles = find_sender_candidates_tiled(
+            spot_meta, r_cells, s_cells, dist_cutoff, args.tile_size, samples,
+            tmp_dir=tmp_dir,
+        )
+        tiles = pd.DataFrame(tiles)
+        print(
+            'Found bags in {} tiles, at most {} receivers and {} senders per tile.'.format(
+                tiles.shape[0], tiles.n_receivers.max(), tiles.n_senders.max()))
+        if samples is not None:
+            # statistics of each slide summed over its tiles
+            n_senders = samples.loc[s_cells].value_counts()
+            bag_sizes = pd.Series(bags.bag_sizes()).groupby(
+                samples.loc[bags.receivers].values).mean()
+            for slide, slide_tiles in tiles.groupby('sample'):
+                slides.append({
+                    'sample': slide,
+                    'n_receivers': int(slide_tiles.n_receivers.sum()),
+                    'n_senders': int(n_senders.get(slide, 0)),
+                    'n_bags': int(slide_tiles.n_bags.sum()),
+                    'mean_bag_size': round(float(bag_sizes.get(slide, 0)), 3),
+                    'wall_s': round(float(slide_tiles.wall_s.sum()), 3),
+                })
+    elif samples is not None:
+        bags, slides = find_sender_candidates_by_sample(
+            spot_meta, samples, r_cells, s_cells, dist_cutoff
+        )
+        print('Found bags in {} slides.'.format(len(slides)))
+    elif spatial_index is None:
+        bags = ProximityGraph.from_series(
+            find_sender_candidates(r_cells, s_cells, spot_meta[["X", "Y"]], dist_cutoff),
+            spot_meta[["X", "Y"]],
+        )
+    else:
+        bags = spatial_index.proximity_graph(
+            r_cells, s_cells, dist_cutoff, index_key
+        ).drop_empty()
+    if args.float32:
+        bags.distances = bags.distances.astype(np.float32)
+    return bags, dist_cutoff, slides
+
+def prepare_spacia_jobs(
+    cpm, spot_meta, r_cells, s_cells, output_path, args,
+    spatial_index=None, index_key=None, profiler=None, label=None,
+    samples=None, submit=None, shared=None, cells=None,
+):
+    """
+    Find the bags of sender cells around receiver cells, construct the
+    receiver and sender pathways and write the spacia_job.R inputs and job
+    commands of one receiver/sender pair to output_path.
+
+    cpm, spot_meta and samples are indexed by integer cell codes, see
+    load_data, and r_cells and s_cells are codes. The bags and selections
+    are positional, and the cell ids of the codes, cells, are only used to
+    write the model_input files.
+
+    spatial_index is a SpatialIndex shared by all pairs of a run, and
+    index_key caches its tree of sender cells, e.g. by sender cell type.
+    label is added to the stage names of the profiler.
+
+    With samples, the slide of each cell, bags are found separately in each
+    slide and pooled, and the neighbor radius is the median of the radii of
+    the slides. With args.tile_size, bags are found in spatial tiles by
+    parallel workers, see find_sender_candidates_tiled.
+
+    submit is called with the ids, command and status files of each job as
+    soon as its inputs are written, so that the MCMC of the first receiver
+    pathways starts while the next ones are prepared. With
+    args.multi_response, a job runs the MCMC of several receiver pathways.
+
+    shared caches the bags, pathways and sender inputs of the pair between
+    the points of a parameter sweep, see parse_sweep. The neighbor search
+    is done once per pair, and the pathways and sender inputs once per
+    bag_size and num_corr_genes, their model_input files being linked to
+    the points of other response cutoffs.
+
+    Returns a dict with the R job commands ('jobs'), their ids ('job_ids'),
+    all job folders including finished ones ('job_folders'), the status
+    file of each job ('status_files') and the statistics of each slide
+    ('slides').
+    """
+    from sklearn.mixture import GaussianMixture
+    from sklearn.preprocessing import scale
+
+    def start_stage(name):
+        if profiler is not None:
+            profiler.start_stage(name if label is None else name + ':' + label)
+
+    shared = {} if shared is None else shared
+    receiver_features = args.receiver_features
+    sender_features = args.sender_features
+    response_exp_cutoff = args.response_exp_cutoff
+    response_exp_cutoff = response_exp_cutoff if response_exp_cutoff == 'auto' else float(response_exp_cutoff)
+    ntotal, nwarm, nthin, nchain = [int(x) for x in args.mcmc_params.split(",")]
+    # the diagnostic plots are made after the MCMC jobs, see run_spacia
+    plot_mcmc = 'F'
+    corr_agg_method = args.corr_agg_method
+    bag_size = args.bag_size
+    nb = args.number_bags
+    pca_gene = args.pca_gene
+    n_pc = args.num_comps
+    plot_debug = args.debug_plots
+    ext = args.ext
+    adaptive_mcmc = args.adaptive_mcmc
+    psrf_cutoff = args.psrf_cutoff
+    warm_start = args.warm_start
+    if (warm_start is not None) & (label is not None):
+        warm_start = os.path.join(warm_start, label)
+    ess_cutoff = args.ess_cutoff
+    check_every = args.check_every
+    multi_response = max(1, args.multi_response)
+
+    intermediate_folder = os.path.join(output_path, "model_input")
+    if not os.path.exists(intermediate_folder):
+        os.makedirs(intermediate_folder)
+    dist_sender_fn = os.path.join(intermediate_folder, "dist_sender.json")
+    metadata_fn = os.path.join(intermediate_folder, "metadata.txt")
+    exp_sender_fn = os.path.join(intermediate_folder, "exp_sender.json")
+
+    # getting script path for supporting codes.
+    spacia_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "spacia")
+    spacia_script = os.path.join(spacia_path, "spacia_job.R")
+    laplace_script = os.path.join(spacia_path, "MIL_Laplace.py")
+
+    # find candidate receiver and sender cells, shared by the sweep points
+    # of the pair
+    if 'bags' not in shared:
+        start_stage('neighbor_search')
+        shared['bags'] = find_pair_bags(
+            spot_meta, r_cells, s_cells, args, spatial_index, index_key,
+            samples, tmp_dir=output_path,
+        )
+    all_bags, dist_cutoff, slides = shared['bags']
+    slides = [dict(x) for x in slides]
+    receiver_cell_for_cutoff = all_bags.receivers
+    # the bags, pathways and sender inputs only depend on bag_size and
+    # num_corr_genes, sweep points of other response cutoffs reuse them
+    sender_key = ('senders', bag_size, args.num_corr_genes)
+    reuse = sender_key in shared
+    if reuse:
+        bags, receiver_pathways, sender_names, shared_folder, bag_features = shared[sender_key]
+        print('Reusing the bags and sender inputs of {}.'.format(shared_folder))
+        receiver_candidates = bags.receivers
+    else:
+        print('Limiting bags to those with at least {} sender cells'.format(bag_size))
+        bags = all_bags.filter_bags(bag_size)
+        print('Number of bags: {}'.format(len(bags)))
+        if len(bags) == 0:
+            raise ValueError('No bags with at least {} sender cells are found!'.format(bag_size))
+        elif len(bags) < 500 :
+            # raise ValueError('Number of total bags is too small, job killed.')
+            Warning('Number of total bags is too small.')
+            pass
+        elif len(bags) > nb:
+            print('Subsample bags for Spacia.')
+            bags = bags.subsample(nb)
+        sender_candidates = bags.unique_senders()
+        receiver_candidates = bags.receivers
+    if samples is not None:
+        n_used = samples.loc[receiver_candidates].value_counts()
+        for slide_stats in slides:
+            slide_stats['dist_cutoff'] = round(float(dist_cutoff), 5)
+            slide_stats['n_bags_used'] = int(n_used.get(slide_stats['sample'], 0))
+            print(
+                'Slide {sample}: {n_receivers} receivers, {n_senders} senders, '
+                '{n_bags} bags, {n_bags_used} used'.format(**slide_stats))
+
+    ######## Preparing spacia_job.R inputs ########
+    if reuse:
+        start_stage('job_inputs')
+        link_sender_inputs(shared_folder, intermediate_folder)
+    else:
+        # Contruct sender and receiver pathways
+        start_stage('pathway_construction')
+        if receiver_features == 'all':
+            receiver_features = ','.join(cpm.columns)
+        receiver_pathways, sender_pathways = contruct_pathways(
+            cpm, 
+            receiver_candidates, 
+            sender_candidates, 
+            receiver_features, 
+            sender_features,
+            corr_agg_method,
+            n_pc,
+            pca_gene,
+            args.corr_agg,
+            args.num_corr_genes,
+        )
+        # If no receiver pathways are found, abort.
+        if len(receiver_pathways.keys()) == 0:
+            print('None of the genes in the provided receiver pathways are found in \
+                the expression matrix, please modify the input and try again.')
+            raise ValueError()
+
+        start_stage('job_inputs')
+        print('Writing spacia_job.R inputs to the model_input folder.')
+        # Receiver sender pair distances, normalized to 0-1
+        # model_input values are rounded in float64 in both precisions
+        dist_r2s = np.split(
+            (bags.distances.astype(float, copy=False) / dist_cutoff).round(5),
+            bags.indptr[1:-1])
+        # cell ids of the codes, for the model_input files
+        named_bags = bags if cells is None else bags.relabel(cells.values)
+        receiver_ids = named_bags.receivers.tolist()
+        sender_dist_dict = dict(zip(receiver_ids, [x.tolist() for x in dist_r2s]))
+
+        # contruct and save metadata
+        meta_data = spot_meta.iloc[receiver_candidates, :spot_meta.columns.get_loc("Y") + 1]
+        meta_data["Sender_cells"] = named_bags.join_senders()
+        meta_data_senders = spot_meta.iloc[
+            sender_candidates, :spot_meta.columns.get_loc("Y") + 1]
+        meta_data = pd.concat([meta_data, meta_data_senders])
+        if cells is not None:
+            meta_data.index = cells[meta_data.index]
+
+        # contruct and save sender exp
+        if sender_features == 'pca':
+            sender_pathway_exp = sender_pathways['Sender_y']
+            if pca_gene is not None:
+                sender_pathway_exp[pca_gene] = cpm[pca_gene].iloc[sender_pathway_exp.index].values
+            sender_pathway_exp.loc[:,:] = scale(sender_pathway_exp)
+        else:
+            sender_pathway_exp = pd.DataFrame(
+                index=sender_candidates, columns=sender_pathways.keys()
+            )
+            for key in sender_pathway_exp.columns:
+                sender_pathway_exp[key] = scale(
+                    cpm.iloc[sender_candidates, cpm.columns.get_indexer(
+                        sender_pathways[key])].mean(axis=1)
+                )
+
+        # # Add one dummy pathway as control
+        # dummy_pathway = np.random.normal(
+        #     scale=0.01,
+        #     size=sender_pathway_exp.shape[0]
+        # )
+        # sender_pathway_exp['dummy'] = dummy_pathway
+
+        sender_exp = dict(zip(
+            receiver_ids,
+            [x.tolist() for x in bags.gather(
+                sender_pathway_exp.reindex(bags.senders).values.astype(float).round(3))],
+        ))
+
+        # Save receiver and sender pathways for reference
+        # remove receiver genes from receiver pathway
+        # for key in rf_to_drop:
+        #     del receiver_pathways[key]
+        # sender_pathways['dummy'] = [] # add dummy pathway
+        for pathway_dict, fn in zip(
+            [receiver_pathways, sender_pathways],
+            ["receiver_pathways.json", "sender_pathways.json"],
+        ):
+            if (fn == "sender_pathways.json") & (sender_features == 'pca'):
+                pc_fn = os.path.join(intermediate_folder, 'sender_pc.csv')
+                sender_pathways['Sender_pc'].to_csv(pc_fn)
+                # prepare dummy sender_pathway.json for pca mode
+                pathway_dict = pd.DataFrame(
+                    index=sender_pathways['Sender_pc'].index.tolist())
+                pathway_dict = pathway_dict.to_dict(orient='index')
+                if pca_gene is not None:
+                    pathway_dict[pca_gene] = {}
+
+            with open(os.path.join(intermediate_folder, fn), "w") as f:
+                f.write(format_json(pathway_dict))
+
+        # Writing spacia R job inputs common for each receiver pathways,
+        # before the jobs that are submitted as soon as they are written
+        # job metadata
+        meta_data.to_csv(metadata_fn, sep='\t')
+
+        # sender distance and expression json (list of lists)
+        with open(dist_sender_fn, "w") as f:
+            f.write(format_json(sender_dist_dict))
+
+        # with open(exp_sender_fn, "w") as f:
+        #     f.write(format_json(sender_exp))
+        with open(exp_sender_fn, "w") as f:
+            f.write(format_json(sender_exp))
+        sender_names = sender_pathway_exp.columns.tolist()
+
+        # distance-weighted mean sender features of each bag, see
+        # Pathway_Screen
+        bag_features = None
+        if args.prefilter is not None:
+            bag_features = pd.DataFrame(
+                bag_means(
+                    bags.indptr, bags.indices,
+                    np.exp(-bags.distances.astype(float) / dist_cutoff),
+                    sender_pathway_exp.reindex(bags.senders).values.astype(float)),
+                index=receiver_candidates, columns=sender_names)
+        shared[sender_key] = (
+            bags, receiver_pathways, sender_names, intermediate_folder, bag_features)
+
+    if args.save_proximity_graph:
+        (bags if cells is None else bags.relabel(cells.values)).save(
+            os.path.join(output_path, 'proximity_graph.npz'))
+
+    ######## Write spacia_job.R jobs ########
+    def job_command(exp_receiver_fn, job_id, job_ntotal, job_nwarm, job_output_path, inits_fn=None):
+        if args.inference == 'laplace':
+            # same inputs and outputs, the draws being from the approximation
+            return " ".join([
+                sys.executable, laplace_script, exp_sender_fn, dist_sender_fn,
+                exp_receiver_fn, job_id, str(job_ntotal), str(job_nwarm),
+                str(nthin), str(nchain), job_output_path,
+            ])
+        job_cmd = [
+            "Rscript",
+            spacia_script,
+            spacia_path + "/",
+            exp_sender_fn,
+            dist_sender_fn,
+            exp_receiver_fn,
+            job_id,
+            str(job_ntotal),
+            str(job_nwarm),
+            str(nthin),
+            str(nchain),
+            job_output_path,
+            plot_mcmc,
+            ext,
+        ]
+        if adaptive_mcmc:
+            # prior, followed by the convergence cutoffs
+            job_cmd += ['1', str(psrf_cutoff), str(ess_cutoff), str(check_every)]
+        elif inits_fn is not None:
+            job_cmd += ['1', 'NA', 'NA', 'NA']
+        if inits_fn is not None:
+            job_cmd.append(inits_fn)
+        return " ".join(job_cmd)
+
+    def submit_batch():
+        # with multi_response, the receiver pathways of a batch run in one
+        # spacia_job.R process that reads the sender inputs once, see
+        # MIL_design
+        if len(batch) == 0:
+            return
+        if multi_response == 1:
+            job = batch[0]
+            job_cmd = job_command(
+                job['exp_receiver'], job['job_id'], job['ntotal'], job['nwarm'],
+                job['output_path'], job['inits'])
+        else:
+            batch_id = 'batch_{}'.format(len(spacia_jobs) + 1)
+            batch_fn = os.path.join(intermediate_folder, batch_id + '.json')
+            with open(batch_fn, 'w') as f:
+                json.dump(batch, f, indent=2)
+            job_cmd = job_command(
+                batch_fn, batch_id, ntotal, nwarm, intermediate_folder + "/")
+        job_ids = [x['job_id'] for x in batch]
+        status_files = {
+            x['job_id']: os.path.join(x['output_path'], x['job_id'] + "_status.json")
+            for x in batch
+        }
+        spacia_jobs.append(job_cmd)
+        spacia_job_ids.extend(job_ids)
+        spacia_status_files.update(status_files)
+        if submit is not None:
+            submit(job_ids, job_cmd, status_files)
+        del batch[:]
+
+    def receiver_labels(rp):
+        # receiver pathway labels of the bags, by expression cutoff
+        # Getting receiver exp
+        rp_genes = cpm.columns.get_indexer(receiver_pathways[rp])
+        # aggregate gene expression
+        if corr_agg_method == 'simple':
+            receiver_exp = cpm.iloc[receiver_cell_for_cutoff, rp_genes].mean(axis=1)
+        else:
+            corr = cpm.iloc[receiver_cell_for_cutoff, rp_genes].corr()[rp.split('_')[0]]
+            receiver_exp = np.matmul(
+                cpm.iloc[receiver_cell_for_cutoff, rp_genes],corr
+                )
+        # Decide receiver exp cutoff
+        # Debug codes
+        # print(receiver_exp.head())
+        # print(response_exp_cutoff)
+        if response_exp_cutoff == 'auto':
+            print(
+                'Estimating {} expression cutoff by fitting a bimodal distribution...'.format(rp)
+                )
+            gm = GaussianMixture(n_components=2, random_state=0).fit(
+                receiver_exp.values.reshape(-1,1))
+            labels = gm.predict(receiver_exp.values.reshape(-1,1))
+            # check bimodality and calculate cutoff
+            sd1 = receiver_exp[labels==0].std()
+            sd2 = receiver_exp[labels==1].std()
+            m1, m2 = gm.means_.flatten()
+            if m1 > m2:
+                m1, m2 = m2, m1
+                sd1, sd2 = sd2, sd1
+            if m2-1*sd2 <= m1+1*sd1:
+                # If not bimodal, use median
+                print('{} expression is likely not bimodal!'.format(rp))
+                print('Using m1 + 1sd cutoff value.')
+                cutoff = m1+1*sd1
+            else:
+                cutoff = (m1+m2)/2
+            
+            # For pathways whose expression are very expreme, use median as cutoff
+            if (
+                (labels.sum() > 0.9 * receiver_exp.shape[0]) or 
+                (labels.sum() < 0.1 * receiver_exp.shape[0])
+            ):
+                # print('Receiver expression too extreme, job skipped')
+                print('Receiver expression maybe too extreme.')
+                # rf_to_drop.append(rp)
+                cutoff = receiver_exp.quantile(0.5)
+        else:
+            cutoff = receiver_exp.quantile(response_exp_cutoff)
+
+        if plot_debug:
+            import matplotlib.pyplot as plt
+            receiver_exp.hist(bins=20,density=True)
+            plt.plot((cutoff,cutoff), (0,2))
+            plt.savefig(
+                os.path.join(intermediate_folder, rp + "_exp_receiver_dist.pdf"))
+            plt.close()
+        
+        receiver_exp = receiver_exp > cutoff
+        receiver_exp = receiver_exp + 0
+        return receiver_exp.loc[receiver_candidates]
+
+    # with args.prefilter, the receiver pathways are screened by bag-level
+    # statistics and only the ones passing get an MCMC job
+    pathway_labels = {}
+    prefilter_passed = None
+    if args.prefilter is not None:
+        start_stage('prefilter')
+        pathway_labels = {rp: receiver_labels(rp) for rp in receiver_pathways.keys()}
+        screen = screen_pathways(pd.DataFrame(pathway_labels), bag_features)
+        screen['pval_adj'] = p_adjust_bh(screen['pval'])
+        prefilter_passed = passing_pathways(screen, args.prefilter)
+        screen['passed'] = screen.Receiver_pathway.isin(prefilter_passed)
+        screen.to_csv(os.path.join(output_path, 'Prefilter_stats.csv'), index=False)
+        print('{} of {} receiver pathways pass the prefilter (adjusted p <= {}).'.format(
+            len(prefilter_passed), len(receiver_pathways), args.prefilter))
+        start_stage('job_inputs')
+
+    # construct receiver expression and the job commands
+    spacia_jobs = []
+    spacia_job_ids = []
+    spacia_job_folders = []
+    spacia_status_files = {}
+    batch = []
+    # primary instances of warm starts are only reused for the same bags
+    bags_fingerprint = bag_fingerprint(intermediate_folder) if warm_start is not None else None
+    for rp in receiver_pathways.keys():
+        if (prefilter_passed is not None) and (rp not in prefilter_passed):
+            continue
+        job_id = rp
+        job_folder = os.path.join(output_path, job_id)
+        spacia_job_folders.append(job_folder)
+        
+        # Check if the current rp is already done, with the same inference
+        job_inference = finished_job_inference(job_folder, job_id)
+        if job_inference == args.inference:
+            print(job_id + ' is already finished and will be skipped.')
+            continue
+        if job_inference is not None:
+            print('{} was fitted by {} inference and is fitted again by {}.'.format(
+                job_id, job_inference, args.inference))
+        
+        exp_receiver_fn = os.path.join(
+            intermediate_folder, job_id + "_exp_receiver.csv"
+        )
+        receiver_exp = pathway_labels.get(rp)
+        if receiver_exp is None:
+            receiver_exp = receiver_labels(rp)
+        receiver_exp.to_csv(exp_receiver_fn, header=None, index=None)
+
+        spacia_output_path = os.path.join(output_path, job_id)
+        if not os.path.exists(spacia_output_path):
+            os.makedirs(spacia_output_path)
+        # sender pathways of the betas, to match them in later warm starts
+        with open(os.path.join(spacia_output_path, job_id + '_features.json'), 'w') as f:
+            json.dump(sender_names, f)
+
+        inits = None
+        if warm_start is not None:
+            inits = warm_start_inits(
+                os.path.join(warm_start, job_id), job_id,
+                sender_names, args.warm_start_mode, bags_fingerprint)
+            if inits is None:
+                print('No chains state of {} in {}, cold start.'.format(job_id, warm_start))
+        job_nwarm, job_ntotal, inits_fn = nwarm, ntotal, None
+        if inits is not None:
+            # shorter warm-up, with the same number of sampling iterations
+            job_nwarm = min(nwarm, max(10, int(round(nwarm * args.warm_start_warmup))))
+            job_ntotal = ntotal - nwarm + job_nwarm
+            inits_fn = os.path.join(intermediate_folder, job_id + "_inits.json")
+            with open(inits_fn, 'w') as f:
+                json.dump(inits, f)
+            print('Warm start of {} from {}, {} warm-up iterations.'.format(
+                job_id, warm_start, job_nwarm))
+        batch.append({
+            'job_id': job_id,
+            'exp_receiver': exp_receiver_fn,
+            'output_path': spacia_output_path + "/",
+            'ntotal': job_ntotal,
+            'nwarm': job_nwarm,
+            'inits': inits_fn,
+        })
+        if len(batch) >= multi_response:
+            submit_batch()
+    submit_batch()
+
+    with open(os.path.join(output_path, 'spacia_r.log'), 'w') as f:
+        f.write('\n'.join(spacia_jobs)) # Save the actual jobs for debug purpose
+        
+    return {
+        'jobs': spacia_jobs,
+        'job_ids': spacia_job_ids,
+        'job_folders': spacia_job_folders,
+        'status_files': spacia_status_files,
+        'slides': slides,
+    }
+
+def load_collection_inputs(output_path):
+    """
+    Read the sender pathway names and the receiver/sender pairs of the bags
+    from the model_input folder of one receiver/sender pair.
+    """
+    intermediate_folder = os.path.join(output_path, "model_input")
+    metadata_fn = os.path.join(intermediate_folder, "metadata.txt")
+    meta_data = pd.read_csv(metadata_fn, index_col=0, sep="\t")
+    with open(os.path.join(intermediate_folder, "sender_pathways.json"), "r") as f:
+        sender_pathways_names = json.load(f).keys()
+
+    interactions_template = (
+        meta_data.dropna(subset=["Sender_cells"])
+        .Sender_cells.str.split(",")
+        .explode()
+        .reset_index()
+    )
+    interactions_template.columns = ["Receiver", "Sender"]
+    return sender_pathways_names, interactions_template
+
+def read_job_results(fd, sender_pathways_names, interactions_template):
+    """
+    Read the betas, primary instance scores, b and FDRs of one finished
+    spacia_job.R job. Returns None if the job failed without outputs.
+    """
+    job_id = fd.split('/')[-1]
+    # aggregating beta for different receiver pathways
+    try:
+        res_beta = pd.read_csv(os.path.join(fd, job_id + "_beta.txt"), sep="\t")
+        res_beta = remove_outliers(res_beta)
+        res_beta = res_beta.apply(lambda x: x/x.std()).mean()
+    except:
+        print('{} failed without outputs!'.format(job_id))
+        return None
+    res_beta = res_beta.reset_index()
+    res_beta.index = [job_id] * res_beta.shape[0]
+    res_beta.columns = ["Sender_pathway", "Beta"]
+    res_beta.Sender_pathway = sender_pathways_names
+
+    # aggregating primamy instances for different receiver pathways
+    pip_res = pd.read_csv(
+        os.path.join(fd, job_id + "_pip.txt"), sep="\t"
+    ).mean(axis=1)
+    assert (
+        pip_res.shape[0] == interactions_template.shape[0]
+    ), "Spaca results don't match input!"
+    _interactions = interactions_template.copy()
+    _interactions.index = [job_id] * _interactions.shape[0]
+    _interactions["Primary_instance_score"] = pip_res.values
+
+    # aggregating b and FDR for different receiver pathways
+    pred_b = (
+        pd.read_csv(os.path.join(fd, job_id + "_b.txt"), sep="\t")
+        .iloc[:, 1]
+        .mean()
+    )
+    fdr = pd.read_csv(os.path.join(fd, job_id + "_FDRs.txt"), sep="\t")
+    fdr = fdr.reset_index()
+    fdr.index = [job_id] * fdr.shape[0]
+    fdr.columns = ["Theta_cutoff", "FDR"]
+    fdr.Theta_cutoff = fdr.Theta_cutoff / 10
+    fdr["b"] = pred_b
+    return res_beta, _interactions, fdr
+
+def collect_spacia_results(
+    output_path, job_folders, args, job_results=None, job_diagnostics=None):
+    """
+    Collect the spacia_job.R results of one receiver/sender pair into
+    Pathway_betas.csv, Interactions.csv, B_and_FDR.csv and, with MCMC
+    inference, MCMC_diagnostics.csv in output_path.
+
+    job_results and job_diagnostics hold the results and the diagnostics
+    tables of the jobs already read by read_job_results and diagnose_job as
+    they finished, by job folder. The other jobs, e.g. finished in an
+    earlier run, are read here.
+    """
+    ntotal, nwarm, nthin, nchain = [int(x) for x in args.mcmc_params.split(",")]
+    spacia_job_folders = job_folders
+    job_results = {} if job_results is None else job_results
+    job_diagnostics = {} if job_diagnostics is None else job_diagnostics
+    collection_inputs = None
+
+    print('Spacia_R_results at: \n\t{}'.format('\n\t'.join(spacia_job_folders)))
+    results = []
+    for fd in spacia_job_folders:
+        if fd not in job_results:
+            if collection_inputs is None:
+                collection_inputs = load_collection_inputs(output_path)
+            job_results[fd] = read_job_results(fd, *collection_inputs)
+        if (fd not in job_diagnostics) & (args.inference == 'mcmc'):
+            if collection_inputs is None:
+                collection_inputs = load_collection_inputs(output_path)
+            job_diagnostics[fd] = diagnose_job(
+                fd, nchain, list(collection_inputs[0]))
+        if job_results[fd] is not None:
+            results.append(job_results[fd])
+    # one concat per table, in the order of the jobs
+    pathways, interactions, b_plus_fdr = [
+        pd.concat([x[i] for x in results]) if len(results) > 0 else pd.DataFrame()
+        for i in range(3)
+    ]
+        
+    # update pathway_betas
+    # chain sizes differ between jobs if chains were stopped early
+    c_l = None if args.adaptive_mcmc else int((ntotal-nwarm)/nthin)
+    agg_mode = 'pca' if args.sender_features == 'pca' else 'gene'
+    pathways = process_beta(pathways.copy(), output_path, c_l, nchain,agg_mode)
+    # so that screening results of --inference laplace are not taken for MCMC
+    pathways['inference'] = args.inference
+    pathways.to_csv(os.path.join(output_path, "Pathway_betas.csv"))
+    
+    interactions.to_csv(os.path.join(output_path, "Interactions.csv"))
+    # calculate p values for b
+    b_plus_fdr = process_b(b_plus_fdr.copy(), output_path, c_l, nchain)
+    b_plus_fdr['inference'] = args.inference
+    b_plus_fdr.to_csv(os.path.join(output_path, "B_and_FDR.csv"))
+    # ESS, split R hat, Geweke z-score and autocorrelation of beta and b
+    diagnostics_fn = os.path.join(output_path, "MCMC_diagnostics.csv")
+    if args.inference == 'laplace':
+        # independent draws of the Laplace fits are not chains to diagnose
+        if os.path.exists(diagnostics_fn):
+            os.remove(diagnostics_fn)
+        return
+    diagnostics = [job_diagnostics[fd] for fd in spacia_job_folders]
+    diagnostics = [x for x in diagnostics if x is not None]
+    if len(diagnostics) > 0:
+        diagnostics = pd.concat(diagnostics, ignore_index=True)
+    else:
+        diagnostics = pd.DataFrame()
+    diagnostics.to_csv(diagnostics_fn, index=False)
+
+
+def build_parser():
+    """Command line arguments of spacia.py, see default_args for the API."""
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description="Main function for running spacia, which evaluates interactions within \
@@ -473,21 +1380,94 @@ if __name__ == "__main__":
     )
     
     parser.add_argument(
-        "--receiver_features",
-        "-rf",
+        "--pairs",
         type=str,
         default=None,
-        help="Input for the 'response' feature in the receiver cells. Can be: \
-            1) a single gene as the 'response' feature. Works together with 'Corr_agg'; \
-            2) multiple genes, separated by ',', each correspond to a different 'response' feature. \
-            Works together with 'Corr_agg'; \
-            3) multiple genes, sep by '|' used together as one 'response' feature. \
-            'Corr_agg' if turned off in this mode; \
-            4) a csv file, each row correponds to a 'response' feature. \
-            The first column contains feature names, and the following columns are genes \
-            that together form the feature. 'Corr_agg' if turned off in this mode;\
-            5) 'pca', unsupervised mode, where the top ('num_comps') PCA embeddings are used as \
-            'response' feature(s). 'Corr_agg' if turned off in this mode; \
+        help="Batch mode for several receiver/sender pairs, given as \
+            'receiver:sender' separated by ',', or 'all' for every pair of two \
+            different cell types. The data is loaded once, bags of all pairs are \
+            found with one spatial index, and the MCMC jobs of all pairs run in \
+            one pool. Results of each pair are saved in a 'receiver-sender' \
+            folder in the output path. Overrides '-rc' and '-sc'.",
+    )
+
+    parser.add_argument(
+        "--sweep",
+        type=str,
+        default=None,
+        help="Parameter sweep over a grid of values of 'response_exp_cutoff', \
+            'num_corr_genes' and 'bag_size', e.g. \
+            'response_exp_cutoff=0.3,0.5;bag_size=2,4' for all 4 combinations. \
+            The bags of each pair are found once for all points, the pathways \
+            and sender inputs once per bag_size and num_corr_genes, and the \
+            MCMC jobs of all points run in one pool. Results of each point are \
+            saved in a 'name-value_name-value' folder of the output path, or \
+            of the pair folder with '--pairs', listed in 'sweep_points.csv'.",
+    )
+
+    parser.add_argument(
+        "--sample_column",
+        type=str,
+        default=None,
+        help="Column of spot_meta with the slide/sample of each cell. If given, \
+            neighbors are only searched within the same slide, in parallel \
+            workers, and the bags of all slides are pooled in the same MCMC jobs.",
+    )
+
+    parser.add_argument(
+        "--slide_reports",
+        action="store_true",
+        default=False,
+        help="Save the neighbor search statistics of each slide as json in the \
+            'slide_reports' folder. They are always included in 'run_report.json'.",
+    )
+
+    parser.add_argument(
+        "--tile_size",
+        type=float,
+        default=None,
+        help="Find bags in square spatial tiles of this size, with a halo of \
+            'dist_cutoff', processed by parallel workers that each load one tile \
+            from disk. For very large sections, the bags are the same as without \
+            tiles.",
+    )
+
+    parser.add_argument(
+        "--save_proximity_graph",
+        action="store_true",
+        default=False,
+        help="Save the receiver to sender proximity graph of the bags used by \
+            the MCMC as 'proximity_graph.npz' in the output folder. Load it \
+            with Spatial_Index.ProximityGraph.load.",
+    )
+
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        default=False,
+        help="Single precision memory mode. The expression is loaded as float32, \
+            and the scaling, PCA, pathway aggregation, neighbor distances and \
+            sender features computed from it stay in float32, halving their \
+            memory. The model_input values are rounded as in the default float64 \
+            mode, see README for the tolerance.",
+    )
+
+    parser.add_argument(
+        "--receiver_features",
+        "-rf",
+        type=str,
+        default=None,
+        help="Input for the 'response' feature in the receiver cells. Can be: \
+            1) a single gene as the 'response' feature. Works together with 'Corr_agg'; \
+            2) multiple genes, separated by ',', each correspond to a different 'response' feature. \
+            Works together with 'Corr_agg'; \
+            3) multiple genes, sep by '|' used together as one 'response' feature. \
+            'Corr_agg' if turned off in this mode; \
+            4) a csv file, each row correponds to a 'response' feature. \
+            The first column contains feature names, and the following columns are genes \
+            that together form the feature. 'Corr_agg' if turned off in this mode;\
+            5) 'pca', unsupervised mode, where the top ('num_comps') PCA embeddings are used as \
+            'response' feature(s). 'Corr_agg' if turned off in this mode; \
             6) None, unsupervised mode, where the averaged expressions of gene clusters \
             in the 'receiver' cells are used as 'response' feature(s)."
     )
@@ -581,6 +1561,62 @@ if __name__ == "__main__":
     )
 
     
+    parser.add_argument(
+        "--adaptive_mcmc",
+        action="store_true",
+        default=False,
+        help="Stop MCMC sampling once the split-chain PSRF and the effective sample \
+            size of beta and b reach '--psrf_cutoff' and '--ess_cutoff'. Convergence \
+            is checked every '--check_every' iterations after warm up, and 'ntotal' \
+            in '--mcmc_params' becomes the maximal number of iterations.",
+    )
+
+    parser.add_argument(
+        "--psrf_cutoff",
+        type=float,
+        default=1.05,
+        help="Maximal split-chain PSRF (R hat) of beta and b in the adaptive mode.",
+    )
+
+    parser.add_argument(
+        "--ess_cutoff",
+        type=float,
+        default=400,
+        help="Minimal effective sample size of beta and b, pooled over chains, \
+            in the adaptive mode.",
+    )
+
+    parser.add_argument(
+        "--check_every",
+        type=int,
+        default=1000,
+        help="Number of sampling iterations between convergence checks in the \
+            adaptive mode.",
+    )
+    
+    parser.add_argument(
+        "--inference",
+        type=str,
+        default="mcmc",
+        choices=["mcmc", "laplace"],
+        help="Inference of each receiver pathway: the MCMC of spacia_job.R, or \
+            a Laplace approximation of the posterior around its mode \
+            (spacia/MIL_Laplace.py) that takes seconds per receiver pathway and \
+            writes the same outputs, to screen many pathways before running the \
+            MCMC of the hits.",
+    )
+
+    parser.add_argument(
+        "--prefilter",
+        type=float,
+        default=None,
+        help="Screen the receiver pathways before their MCMC jobs. The receiver \
+            label is tested against the distance-weighted mean of each sender \
+            pathway in each bag, and only receiver pathways with a sender pathway \
+            at a Benjamini-Hochberg adjusted p-value of at most this cutoff get a \
+            job. The statistics of all pathways are saved in 'Prefilter_stats.csv'.",
+    )
+
     parser.add_argument(
         "--bag_size",
         "-b",
@@ -619,8 +1655,10 @@ if __name__ == "__main__":
         "--plot_mcmc",
         action = "store_true",
         default = False,
-        help = "Optional argument for plotting b and beta's trace plots, density plots, \
-         autocorrelation plots, and PSRF plots."
+        help = "Optional argument for plotting b and beta's trace plots, density plots \
+         and autocorrelation plots, in one file per job made after all MCMC jobs are done. \
+         The ESS, split R hat and Geweke diagnostics are always saved in MCMC_diagnostics.csv \
+         with --inference mcmc."
     )
     
     parser.add_argument (
@@ -638,9 +1676,487 @@ if __name__ == "__main__":
          (e.g. png), or one of eps, ps, tex (pictex), pdf, jpeg, tiff, png, bmp, svg or wmf (windows only)"
     )
 
+    parser.add_argument(
+        "--monitor_interval",
+        type=float,
+        default=30,
+        help="Seconds between progress updates of the running MCMC jobs, which \
+            are logged and saved to 'mcmc_progress.tsv'.",
+    )
+
+    parser.add_argument(
+        "--stall_timeout",
+        type=float,
+        default=None,
+        help="Kill MCMC jobs that have not reported progress for this many seconds.",
+    )
+
+    parser.add_argument(
+        "--slow_job_factor",
+        type=float,
+        default=None,
+        help="Kill MCMC jobs whose iterations per second are below the median of \
+            the running jobs divided by this factor.",
+    )
+
+    parser.add_argument(
+        "--warm_start",
+        type=str,
+        default=None,
+        help="Output path of a previous run of the same receiver/sender cell \
+            types. The MCMC chains of each receiver pathway found in that run \
+            start from its saved chains state instead of random values, with a \
+            shorter warm-up. Betas are matched by sender pathway name.",
+    )
+
+    parser.add_argument(
+        "--warm_start_mode",
+        type=str,
+        default="mean",
+        choices=["mean", "last"],
+        help="Warm start the chains around the posterior means of the previous \
+            run ('mean'), or from the last draw of its chains ('last').",
+    )
+
+    parser.add_argument(
+        "--warm_start_warmup",
+        type=float,
+        default=0.2,
+        help="Warm-up iterations of warm started chains, as a fraction of the \
+            warm-up of '--mcmc_params' (at least 10).",
+    )
+
+    parser.add_argument(
+        "--multi_response",
+        type=int,
+        default=1,
+        help="Number of receiver pathways of a pair whose MCMC runs in one \
+            spacia_job.R process, one after the other. The sender inputs, \
+            design matrix and prior invariants are then prepared once per \
+            process instead of once per receiver pathway.",
+    )
+
+    parser.add_argument(
+        "--work_queue",
+        type=str,
+        default=None,
+        help="Shared folder of a work queue. Instead of running the MCMC jobs \
+            in a local pool, they are published to this folder and run by \
+            workers on any node that mounts it, started with \
+            'python spacia/Work_Queue.py <work_queue>'.",
+    )
+
+    parser.add_argument(
+        "--local_workers",
+        type=int,
+        default=0,
+        help="With --work_queue, number of single-job worker processes started \
+            on this node in addition to the workers on other nodes.",
+    )
+
+    parser.add_argument(
+        "--dead_after",
+        type=float,
+        default=120,
+        help="With --work_queue, seconds without a heartbeat after which the \
+            job of a worker is reassigned to another worker.",
+    )
+
+    parser.add_argument (
+        "--profile",
+        action = "store_true",
+        default = False,
+        help = "Save a cProfile dump of each stage to the 'profiles' folder. \
+            Wall time, CPU time and peak memory of each stage and MCMC job are \
+            always saved in 'run_report.json'."
+    )
+
     parser.add_argument(
         "--output_path", "-o", type=str, default="spacia", help="Output path"
     )
+    return parser
+
+def default_args(counts, spot_meta, **kwargs):
+    """
+    Arguments of a spacia run with the command line defaults, for
+    run_spacia. counts and spot_meta are paths or DataFrames, and the other
+    arguments are given by their long names, e.g.
+
+        args = default_args(
+            counts, meta, receiver_cluster='A', sender_cluster='B',
+            receiver_features='gene1', output_path='out')
+    """
+    args = build_parser().parse_args(['counts', 'spot_meta'])
+    args.counts, args.spot_meta = counts, spot_meta
+    for key, value in kwargs.items():
+        if not hasattr(args, key):
+            raise TypeError('{} is not a spacia argument!'.format(key))
+        setattr(args, key, value)
+    return args
+
+def load_data(counts, spot_meta, sample_column=None, dtype=None):
+    """
+    Load the expression counts and spot metadata, as paths of tab separated
+    files or DataFrames, and align their cells.
+
+    Cells are mapped once to integer codes, their positions in the aligned
+    data, so that the pipeline selects cells and builds bags with integer
+    arrays instead of hashing cell id strings. The ids are restored when
+    the model_input files are written.
+
+    dtype is the float type of the expression, np.float32 halves the memory
+    of the expression and of the arrays computed from it, see --float32.
+
+    Returns a dict with the expression ('cpm'), the metadata ('spot_meta')
+    and the slide of each cell with sample_column ('samples'), indexed by
+    the codes, the cell id of each code ('cells') and the spatial index of
+    all cells ('spatial_index'), that run_spacia keeps in memory between
+    runs.
+    """
+    # Processing counts and spot_metadata
+    print('Processing expression counts.')
+    if not isinstance(counts, pd.DataFrame):
+        if dtype is not None:
+            # parse the counts directly as dtype, without a float64 copy
+            genes = pd.read_csv(counts, index_col=0, sep="\t", nrows=0).columns
+            counts = pd.read_csv(
+                counts, index_col=0, sep="\t", dtype=dict.fromkeys(genes, dtype))
+        else:
+            counts = pd.read_csv(counts, index_col=0, sep="\t")
+    elif dtype is not None:
+        counts = counts.astype(dtype)
+    if not isinstance(spot_meta, pd.DataFrame):
+        spot_meta = pd.read_csv(spot_meta, index_col=0, sep="\t")
+    if not all(x in spot_meta.columns for x in ['X','Y','cell_type']):
+        raise ValueError(
+            "Metadata must have ['X','Y','cell_type'] columns!"
+        )
+    # TODO: added a tag to allow normalization
+    if counts.max().max() > 1000:
+        # cpm = preprocessing_counts(counts)
+        UserWarning(
+            'input gene expression data does not seem in log1cpm format'
+            )
+    else:
+        cpm = counts
+    cpm, spot_meta = cpm.align(spot_meta, join="inner", axis=0)
+    samples = None
+    if sample_column is not None:
+        if sample_column not in spot_meta.columns:
+            raise ValueError('{} not found in metadata!'.format(sample_column))
+        if not spot_meta.index.is_unique:
+            raise ValueError('Cell ids must be unique across slides!')
+    # integer cell codes
+    cells = spot_meta.index
+    cpm = cpm.reset_index(drop=True)
+    spot_meta = spot_meta.reset_index(drop=True)
+    if sample_column is not None:
+        samples = spot_meta[sample_column].astype(str)
+        print('Found {} slides in column {}.'.format(
+            samples.nunique(), sample_column))
+
+    return {
+        'cpm': cpm,
+        'spot_meta': spot_meta,
+        'samples': samples,
+        'cells': cells,
+        # one spatial index for the neighbor search of all pairs
+        'spatial_index': SpatialIndex(spot_meta[["X", "Y"]]),
+    }
+
+def plan_runs(args, spot_meta):
+    """
+    Receiver/sender pairs and sweep points of a run, as a list of (label,
+    (receiver, sender), output path, sweep point) tuples. The label is
+    None for a single pair without sweep.
+    """
+    output_path = args.output_path
+    receiver_cluster, sender_cluster = args.receiver_cluster, args.sender_cluster
+    if args.pairs is not None:
+        # batch mode, every pair is saved in its own folder
+        pairs = parse_pairs(args.pairs, spot_meta.cell_type.unique().tolist())
+        print('Running spacia on {} receiver/sender pairs: {}'.format(
+            len(pairs), ', '.join(['{}:{}'.format(*x) for x in pairs])))
+        pair_runs = [
+            (pair_folder_name(*pair), pair, os.path.join(output_path, pair_folder_name(*pair)), None)
+            for pair in pairs
+        ]
+    else:
+        # catch error where a wrong cell cluster name is provided.
+        for c_name in [receiver_cluster, sender_cluster]:
+            if c_name not in spot_meta.cell_type.unique():
+                raise ValueError('{} not found in cell types!'.format(spot_meta))
+        pair_runs = [(None, (receiver_cluster, sender_cluster), output_path, None)]
+    if args.sweep is not None:
+        # sweep mode, every parameter point of a pair is saved in its own folder
+        sweep_points = parse_sweep(args.sweep)
+        print('Sweeping {} parameter points: {}'.format(
+            len(sweep_points), ', '.join([sweep_point_name(x) for x in sweep_points])))
+        pd.DataFrame(
+            sweep_points, index=[sweep_point_name(x) for x in sweep_points]
+        ).rename_axis('point').to_csv(os.path.join(output_path, 'sweep_points.csv'))
+        pair_runs = [
+            (
+                sweep_point_name(point) if label is None
+                else label + '/' + sweep_point_name(point),
+                pair,
+                os.path.join(pair_output_path, sweep_point_name(point)),
+                point,
+            )
+            for label, pair, pair_output_path, _ in pair_runs
+            for point in sweep_points
+        ]
+    return pair_runs
+
+def run_spacia(args, data=None, profiler=None):
+    """
+    Run the spacia pipeline: find the bags, construct the pathways and run
+    the MCMC jobs of every pair and sweep point of args, see default_args,
+    and collect their results in args.output_path.
+
+    data is the output of load_data, loaded from args.counts and
+    args.spot_meta if None, so that several runs in one process, e.g. from
+    a notebook or a scheduler, load the data once. profiler is the
+    RunProfiler of the run report.
+
+    Returns a dict with the output path of each collected pair ('outputs',
+    by label), the record of each MCMC job ('jobs') and the path of the
+    run report ('report').
+    """
+    output_path = args.output_path
+    cellid_file = args.cellid_file
+    keep = args.keep_intermediate
+    # Checking inputs
+    assert args.corr_agg_method in ['simple','weighted'], "'corr_agg_method' must be either 'simple' or 'weighted'!"
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    if profiler is None:
+        # records time and memory use of each stage in run_report.json
+        profiler = RunProfiler(output_path, args.profile)
+    if data is None:
+        profiler.start_stage('load')
+        data = load_data(
+            args.counts, args.spot_meta, args.sample_column,
+            np.float32 if args.float32 else None)
+    cpm, spot_meta = data['cpm'], data['spot_meta']
+    samples, spatial_index = data['samples'], data['spatial_index']
+    cells = data['cells']
+    if args.float32:
+        # sklearn's scale checks the centered means with a float64 tolerance,
+        # that float32 rounding does not meet
+        warnings.filterwarnings(
+            'ignore', message='Numerical issues were encountered', category=UserWarning)
+    if (args.inference == 'laplace') & (args.adaptive_mcmc | (args.warm_start is not None)):
+        # no chains to stop or to warm start
+        print('--adaptive_mcmc and --warm_start are ignored with --inference laplace.')
+        args.adaptive_mcmc, args.warm_start = False, None
+    np.random.seed(0)
+
+    pair_runs = plan_runs(args, spot_meta)
+
+    ######## Prepare, run and collect spacia_job.R jobs ########
+    # Each MCMC job is submitted to the pool as soon as its inputs are
+    # written, the results of each job are read as soon as it finishes, and
+    # each pair is collected as soon as all its jobs are done, while the
+    # other jobs still run.
+    spacia_job_ids = []
+    job_async = {}
+    job_pairs = {}
+    job_records = {}
+    pair_job_folders = {}
+    pair_state = {}
+    slide_stats = []
+    finished = queue.Queue()
+    work_queue = None
+    if args.work_queue is not None:
+        work_queue = WorkQueue(args.work_queue, dead_after=args.dead_after)
+        print('Publishing {} jobs to the work queue {}'.format(
+            'Laplace' if args.inference == 'laplace' else 'MCMC', work_queue.run_dir))
+        if (args.stall_timeout is not None) | (args.slow_job_factor is not None):
+            # the jobs run on other nodes
+            print('Stalled or slow jobs are not killed with --work_queue.')
+            args.stall_timeout, args.slow_job_factor = None, None
+    monitor = JobMonitor(
+        {}, output_path, args.stall_timeout, args.slow_job_factor, args.inference)
+    nchain = int(args.mcmc_params.split(",")[3])
+
+    def submit_job(label, job_ids, job, status_files):
+        # a job runs several receiver pathways with --multi_response
+        if label is not None:
+            status_files = {label + '/' + x: status_files[x] for x in job_ids}
+            job_ids = [label + '/' + x for x in job_ids]
+        monitor.add_jobs(status_files)
+        for job_id in job_ids:
+            job_pairs[job_id] = (label, os.path.dirname(status_files[job_id]))
+            pair_state[label]['pending'].add(job_id)
+            spacia_job_ids.append(job_id)
+        task_id = job_ids[0] if len(job_ids) == 1 else '{}+{}'.format(job_ids[0], len(job_ids) - 1)
+
+        def done(_, job_ids=job_ids):
+            for job_id in job_ids:
+                finished.put(job_id)
+
+        if work_queue is not None:
+            task = work_queue.submit(task_id, job, callback=done)
+        else:
+            task = p.apply_async(
+                spacia_worker, (job,), callback=done, error_callback=done)
+        for job_id in job_ids:
+            job_async[job_id] = task
+
+    def collect_pair(label):
+        # only once all jobs of the pair are prepared and done
+        state = pair_state[label]
+        if (label not in pair_job_folders) | (len(state['pending']) > 0) | state['collected']:
+            return
+        pair_output_path, job_folders = pair_job_folders[label]
+        print('Collecting results{}.'.format('' if label is None else ' of ' + label))
+        collect_spacia_results(
+            pair_output_path, job_folders, args, state['results'], state['diagnostics'])
+        state['collected'] = True
+
+    def job_finished(job_id):
+        label, job_folder = job_pairs[job_id]
+        # the jobs of a multi-response process share its record
+        job_records[job_id] = dict(job_async[job_id].get())
+        state = pair_state[label]
+        state['pending'].discard(job_id)
+        if state['inputs'] is None:
+            state['inputs'] = load_collection_inputs(pair_job_folders[label][0])
+        state['results'][job_folder] = read_job_results(job_folder, *state['inputs'])
+        if args.inference == 'mcmc':
+            state['diagnostics'][job_folder] = diagnose_job(
+                job_folder, nchain, list(state['inputs'][0]))
+        collect_pair(label)
+
+    if args.inference == 'laplace':
+        print('Running MIL_Laplace.py fits as their inputs are ready.')
+    else:
+        print('Running spacia_R MCMC MIL models as their inputs are ready.')
+    local_workers = [
+        subprocess.Popen([
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spacia', 'Work_Queue.py'),
+            args.work_queue, '--slots', '1', '--run_id', work_queue.run_id,
+        ])
+        for _ in range(args.local_workers if work_queue is not None else 0)
+    ]
+    # bags and sender inputs of each pair, shared by its sweep points
+    pair_shared = {}
+    with (Pool(16) if work_queue is None else work_queue) as p:
+        for label, (receiver_cluster, sender_cluster), pair_output_path, point in pair_runs:
+            if label is not None:
+                print('Preparing spacia jobs of {} receivers and {} senders{}.'.format(
+                    receiver_cluster, sender_cluster,
+                    '' if point is None else ', ' + sweep_point_name(point)))
+            run_args = args
+            if point is not None:
+                run_args = argparse.Namespace(**dict(vars(args), **point))
+            if (receiver_cluster is not None) & (sender_cluster is not None):
+                r_cells = np.flatnonzero(spot_meta.cell_type == receiver_cluster)
+                s_cells = np.flatnonzero(spot_meta.cell_type == sender_cluster)
+            elif cellid_file is not None:
+                cellids = pd.read_csv(cellid_file, header=None)
+                # integer codes of the cell ids
+                r_cells, s_cells = [
+                    cells.get_indexer(cellids.iloc[:, i].dropna().values) for i in [0, 1]]
+                if (r_cells < 0).any() | (s_cells < 0).any():
+                    raise ValueError(
+                        "{} cell ids of {} are not found in the data!".format(
+                            (r_cells < 0).sum() + (s_cells < 0).sum(), cellid_file))
+            else:
+                raise ValueError(
+                    "Must provide both receiver and sender clusters, or a file with their ids."
+                )
+            pair_state[label] = {
+                'pending': set(), 'results': {}, 'diagnostics': {}, 'inputs': None,
+                'collected': False}
+            try:
+                pair_jobs = prepare_spacia_jobs(
+                    cpm, spot_meta, r_cells, s_cells, pair_output_path, run_args,
+                    spatial_index, sender_cluster, profiler, label, samples,
+                    submit=lambda *job, label=label: submit_job(label, *job),
+                    shared=pair_shared.setdefault((receiver_cluster, sender_cluster), {}),
+                    cells=cells,
+                )
+            except ValueError as e:
+                if label is None:
+                    raise
+                print('Pair {} is skipped: {}'.format(label, e))
+                continue
+            pair_job_folders[label] = (pair_output_path, pair_jobs['job_folders'])
+            for slide_record in pair_jobs['slides']:
+                if label is not None:
+                    slide_record['pair'] = label
+                slide_stats.append(slide_record)
+                if args.slide_reports:
+                    report_path = os.path.join(pair_output_path, 'slide_reports')
+                    if not os.path.exists(report_path):
+                        os.makedirs(report_path)
+                    with open(os.path.join(report_path, '{}.json'.format(
+                            re.sub(r'[^\w.-]', '_', slide_record['sample']))), 'w') as f:
+                        json.dump(slide_record, f, indent=2)
+
+            # read the jobs finished in the meantime, and collect the pair if
+            # all its jobs are already done
+            while not finished.empty():
+                job_finished(finished.get())
+            collect_pair(label)
+
+        ######## Wait for the remaining spacia_job.R jobs ########
+        profiler.start_stage('mcmc_jobs')
+        while len(job_records) < len(job_async):
+            job_finished(monitor.wait_queue(finished, args.monitor_interval))
+    for worker in local_workers:
+        worker.wait()
+    monitor.update()
+
+    ######## Diagnostic plots of the MCMC chains ########
+    # after the MCMC jobs, so that plotting does not hold their workers
+    if args.plot_mcmc:
+        profiler.start_stage('mcmc_plots')
+        for label, (pair_output_path, job_folders) in pair_job_folders.items():
+            sender_pathways_names, _ = load_collection_inputs(pair_output_path)
+            plot_jobs(
+                job_folders, nchain, list(sender_pathways_names), args.ext,
+                n_workers=16)
+    job_summary = monitor.summary() if len(spacia_job_ids) > 0 else {}
+    for job_id in spacia_job_ids:
+        job_records[job_id].update(job_summary[job_id])
+        if job_records[job_id]['inference'] == 'laplace':
+            print('{}: {}, Laplace fit in {} optimizer iterations'.format(
+                job_id, job_records[job_id]['status'],
+                job_records[job_id]['optimizer_iterations']))
+        else:
+            print('{}: {}, {} iterations at {} iterations/sec'.format(
+                job_id, job_records[job_id]['mcmc_status'],
+                job_records[job_id]['iterations'], job_records[job_id]['iter_per_sec']))
+    profiler.add_jobs(spacia_job_ids, [job_records[x] for x in spacia_job_ids])
+    
+    if samples is not None:
+        report_fn = profiler.write_report(inference=args.inference, slides=slide_stats)
+    else:
+        report_fn = profiler.write_report(inference=args.inference)
+    print('Run report saved to {}'.format(report_fn))
+    
+    # Remove model_input files
+    if not keep:
+        for pair_output_path, _ in pair_job_folders.values():
+            os.system("rm -rf {}".format(
+                os.path.join(pair_output_path, "model_input")))
+
+    return {
+        'outputs': {
+            label: pair_job_folders[label][0]
+            for label in pair_job_folders if pair_state[label]['collected']
+        },
+        'jobs': job_records,
+        'report': report_fn,
+    }
+
+def main(argv=None):
+    """Command line entry point of spacia.py."""
+    parser = build_parser()
     ######## Setting up ########
     # Debug param
     # args = parser.parse_args(
@@ -656,46 +2172,10 @@ if __name__ == "__main__":
     #         # '-nc', '20',
     #         # '-o', '/endosome/work/InternalMedicine/s190548/Spacia/test'
     #         ])
-#%%
-    ######## Setting up ########
-    args = parser.parse_args()
-    counts = args.counts
-    spot_meta = args.spot_meta
-    receiver_cluster = args.receiver_cluster
-    sender_cluster = args.sender_cluster
-    cellid_file = args.cellid_file
-    # pathway_lib = args.pathway_lib
+    args = parser.parse_args(argv)
     output_path = args.output_path
-    n_neighbors = args.n_neighbors
-    receiver_features = args.receiver_features
-    sender_features = args.sender_features
-    top_corr_genes = args.num_corr_genes
-    dist_cutoff = args.dist_cutoff
-    response_exp_cutoff = args.response_exp_cutoff
-    response_exp_cutoff = response_exp_cutoff if response_exp_cutoff == 'auto' else float(response_exp_cutoff)
-    mcmc_params = args.mcmc_params
-    corr_agg = args.corr_agg
-    ntotal, nwarm, nthin, nchain = [int(x) for x in mcmc_params.split(",")]
-    keep = args.keep_intermediate
-    plot_mcmc = 'T' if args.plot_mcmc else 'F'
-    ext = args.ext
-    plot_debug = args.debug_plots
-    corr_agg_method = args.corr_agg_method
-    bag_size = args.bag_size
-    nb = args.number_bags
-    pca_gene = args.pca_gene
-    n_pc = args.num_comps
-    np.random.seed(0)
-
-    # Checking inputs
-    assert corr_agg_method in ['simple','weighted'], "'corr_agg_method' must be either 'simple' or 'weighted'!"  
-    
-    intermediate_folder = os.path.join(output_path, "model_input")
-    if not os.path.exists(intermediate_folder):
-        os.makedirs(intermediate_folder)
-    dist_sender_fn = os.path.join(intermediate_folder, "dist_sender.json")
-    metadata_fn = os.path.join(intermediate_folder, "metadata.txt")
-    exp_sender_fn = os.path.join(intermediate_folder, "exp_sender.json")
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
     
     # Setting up logs
     log_fn = os.path.join(output_path, "spacia_log.txt")
@@ -709,12 +2189,6 @@ if __name__ == "__main__":
     )
     # print(args)
 
-    # getting script path for supporting codes.
-    spacia_path = os.path.abspath(__file__)
-    wrapup_script = spacia_path.replace("spacia.py", "wrapup_spacia_results.py")
-    spacia_path = "/".join(spacia_path.split("/")[:-1]) + "/spacia"
-    spacia_script = os.path.join(spacia_path, "spacia_job.R")
-
     # redirects stdout and stderr to logger
     stdout_logger = logging.getLogger("STDOUT")
     sl = StreamToLogger(stdout_logger, logging.INFO)
@@ -723,364 +2197,8 @@ if __name__ == "__main__":
     sl = StreamToLogger(stderr_logger, logging.ERROR)
     sys.stderr = sl
 
-    ######## Processing counts and receiver and sender cells ########
-    # Processing counts and spot_metadata
-    print('Processing expression counts.')
-    counts = pd.read_csv(counts, index_col=0, sep="\t")
-    spot_meta = pd.read_csv(spot_meta, index_col=0, sep="\t")
-    if not all(x in spot_meta.columns for x in ['X','Y','cell_type']):
-        raise ValueError(
-            "Metadata must have ['X','Y','cell_type'] columns!"
-        )
-    # TODO: added a tag to allow normalization
-    if counts.max().max() > 1000:
-        # cpm = preprocessing_counts(counts)
-        UserWarning(
-            'input gene expression data does not seem in log1cpm format'
-            )
-    else:
-        cpm = counts
-    cpm, spot_meta = cpm.align(spot_meta, join="inner", axis=0)
+    run_spacia(args)
 
-    # catch error where a wrong cell cluster name is provided.
-    for c_name in [receiver_cluster, sender_cluster]:
-        if c_name not in spot_meta.cell_type.unique():
-            raise ValueError('{} not found in cell types!'.format(spot_meta))
-        
-    if (sender_cluster is not None) & (sender_cluster is not None):
-        r_cells = spot_meta[spot_meta.cell_type == receiver_cluster].index
-        s_cells = spot_meta[spot_meta.cell_type == sender_cluster].index
-    elif cellid_file is not None:
-        cellids = pd.read_csv(cellid_file, header=None)
-        r_cells = cellids.iloc[:, 0].dropna().values
-        s_cells = cellids.iloc[:, 1].dropna().values
-    else:
-        raise ValueError(
-            "Must provide both receiver and sender clusters, or a file with their ids."
-        )
-        
-    # find candidate receiver and sender cells
-    if dist_cutoff is None:
-        dist_cutoff = calculate_neighbor_radius(
-            spot_meta.iloc[:, :2], r_cells, s_cells, target_n_neighbors=n_neighbors, 
-        )
-        print(
-            "Maximal distance for {} expected neighbors is {:.2f}".format(
-                n_neighbors, dist_cutoff
-            )
-    )
-
-    r2s_matrix = find_sender_candidates(
-        r_cells, s_cells, spot_meta[["X", "Y"]], dist_cutoff
-    )
-    receiver_cell_for_cutoff = r2s_matrix.index.tolist()
-    print('Limiting bags to those with at least {} sender cells'.format(bag_size))
-    r2s_matrix = r2s_matrix[r2s_matrix.apply(len) >= bag_size]
-    print('Number of bags: {}'.format(r2s_matrix.shape[0]))
-    if r2s_matrix.shape[0] < 500 :
-        # raise ValueError('Number of total bags is too small, job killed.')
-        Warning('Number of total bags is too small.')
-        pass
-    elif r2s_matrix.shape[0]> nb:
-        print('Subsample bags for Spacia.')
-        r2s_matrix = r2s_matrix.sample(nb, replace=False)
-    sender_candidates = list(set(r2s_matrix.sum()))
-    receiver_candidates = r2s_matrix.index.tolist()
-
-    ######## Preparing spacia_job.R inputs ########
-    # Contruct sender and receiver pathways
-    if receiver_features == 'all':
-        receiver_features = ','.join(cpm.columns)
-    receiver_pathways, sender_pathways = contruct_pathways(
-        cpm, 
-        receiver_candidates, 
-        sender_candidates, 
-        receiver_features, 
-        sender_features,
-        corr_agg_method,
-        n_pc,
-        pca_gene
-    )
-    # If no receiver pathways are found, abort.
-    if len(receiver_pathways.keys()) == 0:
-        print('None of the genes in the provided receiver pathways are found in \
-            the expression matrix, please modify the input and try again.')
-        raise ValueError()
-        
-    print('Writing spacia_job.R inputs to the model_input folder.')
-    # Calculate each receiver sender pair distances
-    dist_r2s = r2s_matrix.to_frame().apply(
-        lambda x: (cdist(
-            # fixed issue in pandas that makes it object
-            spot_meta.loc[[x.name], :"Y"].values.reshape(-1, 2),
-            spot_meta.loc[x.iloc[0], :"Y"].values.reshape(-1, 2),
-        )[0]/dist_cutoff).round(5), # normalize distance to 0-1
-        axis=1,
-    )
-    
-    sender_dist_dict = {}
-    for i in dist_r2s.index:
-        sender_dist_dict[i] = dist_r2s[i].tolist()
-
-    # contruct and save metadata
-    meta_data = spot_meta.loc[receiver_candidates, :"Y"]
-    meta_data["Sender_cells"] = r2s_matrix.loc[receiver_candidates].apply(",".join)
-    meta_data_senders = spot_meta.loc[sender_candidates, :"Y"]
-    meta_data = pd.concat([meta_data, meta_data_senders])
-
-    # contruct and save sender exp
-    if sender_features == 'pca':
-        sender_pathway_exp = sender_pathways['Sender_y']
-        if pca_gene is not None:
-            sender_pathway_exp[pca_gene] = cpm.loc[sender_pathway_exp.index, pca_gene]
-        sender_pathway_exp.loc[:,:] = scale(sender_pathway_exp)
-    else:
-        sender_pathway_exp = pd.DataFrame(
-            index=sender_candidates, columns=sender_pathways.keys()
-        )
-        for key in sender_pathway_exp.columns:
-            sender_pathway_exp[key] = scale(
-                cpm.loc[sender_candidates, sender_pathways[key]].mean(axis=1)
-            )
-        
-    # # Add one dummy pathway as control
-    # dummy_pathway = np.random.normal(
-    #     scale=0.01,
-    #     size=sender_pathway_exp.shape[0]
-    # )
-    # sender_pathway_exp['dummy'] = dummy_pathway
-        
-    sender_exp = (
-        r2s_matrix.to_frame()
-        .apply(lambda x: sender_pathway_exp.loc[x[0],].values.round(3).tolist(), axis=1)
-        .to_dict()
-    )
-    
-    ######## Write spacia_job.R jobs ########
-    # construct receiver expression and the job commands
-    spacia_jobs = []
-    spacia_job_folders = []
-    for rp in receiver_pathways.keys():
-        job_id = rp
-        job_folder = os.path.join(output_path, job_id)
-        spacia_job_folders.append(job_folder)
-        
-        # Check if the current rp is already done
-        log_path = os.path.join(job_folder, job_id + '_log.txt')
-        job_finished = False
-        if os.path.exists(log_path):
-            with open(log_path, 'r') as f:
-                log = f.readlines()
-                job_finished = any(
-                    list(map(lambda x: 'Time difference' in x, log)))
-        if job_finished:
-            print(job_id + ' is already finished and will be skipped.')
-            continue
-        
-        exp_receiver_fn = os.path.join(
-            intermediate_folder, job_id + "_exp_receiver.csv"
-        )
-        # Getting receiver exp
-        rp_genes = receiver_pathways[rp]
-        # aggregate gene expression
-        if corr_agg_method == 'simple':
-            receiver_exp = cpm.loc[receiver_cell_for_cutoff, rp_genes].mean(axis=1)
-        else:
-            corr = cpm.loc[receiver_cell_for_cutoff, rp_genes].corr()[rp.split('_')[0]]
-            receiver_exp = np.matmul(
-                cpm.loc[receiver_cell_for_cutoff, rp_genes],corr
-                )
-        # Decide receiver exp cutoff
-        # Debug codes
-        # print(receiver_exp.head())
-        # print(response_exp_cutoff)
-        rf_to_drop = []
-        if response_exp_cutoff == 'auto':
-            print(
-                'Estimating {} expression cutoff by fitting a bimodal distribution...'.format(rp)
-                )
-            gm = GaussianMixture(n_components=2, random_state=0).fit(
-                receiver_exp.values.reshape(-1,1))
-            labels = gm.predict(receiver_exp.values.reshape(-1,1))
-            # check bimodality and calculate cutoff
-            sd1 = receiver_exp[labels==0].std()
-            sd2 = receiver_exp[labels==1].std()
-            m1, m2 = gm.means_.flatten()
-            if m1 > m2:
-                m1, m2 = m2, m1
-                sd1, sd2 = sd2, sd1
-            if m2-1*sd2 <= m1+1*sd1:
-                # If not bimodal, use median
-                print('{} expression is likely not bimodal!'.format(rp))
-                print('Using m1 + 1sd cutoff value.')
-                cutoff = m1+1*sd1
-            else:
-                cutoff = (m1+m2)/2
-                
-            # For pathways whose expression are very expreme, use median as cutoff
-            if (
-                (labels.sum() > 0.9 * receiver_exp.shape[0]) or 
-                (labels.sum() < 0.1 * receiver_exp.shape[0])
-            ):
-                # print('Receiver expression too extreme, job skipped')
-                print('Receiver expression maybe too extreme.')
-                # rf_to_drop.append(rp)
-                cutoff = receiver_exp.quantile(0.5)
-        else:
-            cutoff = receiver_exp.quantile(response_exp_cutoff)
-    
-        if plot_debug:
-            receiver_exp.hist(bins=20,density=True)
-            plt.plot((cutoff,cutoff), (0,2))
-            plt.savefig(
-                os.path.join(intermediate_folder, job_id + "_exp_receiver_dist.pdf"))
-            plt.close()
-            
-        receiver_exp = receiver_exp > cutoff
-        receiver_exp = receiver_exp + 0
-        receiver_exp = receiver_exp[receiver_candidates]
-        receiver_exp.to_csv(exp_receiver_fn, header=None, index=None)
-
-        spacia_output_path = os.path.join(output_path, job_id)
-        if not os.path.exists(spacia_output_path):
-            os.makedirs(spacia_output_path)
-        spacia_jobs.append(
-            " ".join(
-                [
-                    "Rscript",
-                    spacia_script,
-                    spacia_path + "/",
-                    exp_sender_fn,
-                    dist_sender_fn,
-                    exp_receiver_fn,
-                    job_id,
-                    str(ntotal),
-                    str(nwarm),
-                    str(nthin),
-                    str(nchain),
-                    spacia_output_path + "/",
-                    plot_mcmc,
-                    ext,
-                ]
-            )
-        )
-    
-    with open(os.path.join(output_path, 'spacia_r.log'), 'w') as f:
-        f.write('\n'.join(spacia_jobs)) # Save the actual jobs for debug purpose
-        
-    # Save receiver and sender pathways for reference
-    # remove receiver genes from receiver pathway
-    # for key in rf_to_drop:
-    #     del receiver_pathways[key]
-    # sender_pathways['dummy'] = [] # add dummy pathway
-    for pathway_dict, fn in zip(
-        [receiver_pathways, sender_pathways],
-        ["receiver_pathways.json", "sender_pathways.json"],
-    ):
-        if (fn == "sender_pathways.json") & (sender_features == 'pca'):
-            pc_fn = os.path.join(intermediate_folder, 'sender_pc.csv')
-            sender_pathways['Sender_pc'].to_csv(pc_fn)
-            # prepare dummy sender_pathway.json for pca mode
-            pathway_dict = pd.DataFrame(
-                index=sender_pathways['Sender_pc'].index.tolist())
-            pathway_dict = pathway_dict.to_dict(orient='index')
-            if pca_gene is not None:
-                pathway_dict[pca_gene] = {}
-
-        with open(os.path.join(intermediate_folder, fn), "w") as f:
-            f.write(format_json(pathway_dict))
-            
-    # Writing spacia R job inputs common for each receiver pathways
-    # job metadata
-    meta_data.to_csv(metadata_fn, sep='\t')
-    
-    # sender distance and expression json (list of lists)
-    with open(dist_sender_fn, "w") as f:
-        f.write(format_json(sender_dist_dict))
-        
-    # with open(exp_sender_fn, "w") as f:
-    #     f.write(format_json(sender_exp))
-    with open(exp_sender_fn, "w") as f:
-        f.write(format_json(sender_exp))
-    
-    ######## Proceed with spacia_job.R ########
-    # Run all spacia R jobs
-    print('Running spacia_R MCMC MIL models.')
-    with Pool(16) as p:
-        _ = p.map(spacia_worker, spacia_jobs)
-    
-    ######## Collect all results ########
-    print('Collecting results.')
-    meta_data = pd.read_csv(metadata_fn, index_col=0, sep="\t")
-    with open(os.path.join(intermediate_folder, "sender_pathways.json"), "r") as f:
-        sender_pathways_names = json.load(f).keys()
-
-    interactions_template = (
-        meta_data.dropna(subset=["Sender_cells"])
-        .Sender_cells.str.split(",", expand=True)
-        .stack()
-        .reset_index()
-    )
-    interactions_template.columns = ["Receiver", "x", "Sender"]
-    interactions_template = interactions_template[["Receiver", "Sender"]]
-
-    print('Spacia_R_results at: \n\t{}'.format('\n\t'.join(spacia_job_folders)))
-    pathways = pd.DataFrame()
-    interactions = pd.DataFrame()
-    b_plus_fdr = pd.DataFrame()
-    for fd in spacia_job_folders:
-        job_id = fd.split('/')[-1]
-        # aggregating beta for different receiver pathways
-        try:
-            res_beta = pd.read_csv(os.path.join(fd, job_id + "_beta.txt"), sep="\t")
-            res_beta = remove_outliers(res_beta)
-            res_beta = res_beta.apply(lambda x: x/x.std()).mean()
-        except:
-            print('{} failed without outputs!'.format(job_id))
-            continue
-        res_beta = res_beta.reset_index()
-        res_beta.index = [job_id] * res_beta.shape[0]
-        res_beta.columns = ["Sender_pathway", "Beta"]
-        res_beta.Sender_pathway = sender_pathways_names
-        pathways = pd.concat([pathways, res_beta])
-
-        # aggregating primamy instances for different receiver pathways
-        pip_res = pd.read_csv(
-            os.path.join(fd, job_id + "_pip.txt"), sep="\t"
-        ).mean(axis=1)
-        assert (
-            pip_res.shape[0] == interactions_template.shape[0]
-        ), "Spaca results don't match input!"
-        _interactions = interactions_template.copy()
-        _interactions.index = [job_id] * _interactions.shape[0]
-        _interactions["Primary_instance_score"] = pip_res.values
-        interactions = pd.concat([interactions, _interactions])
-
-        # aggregating b and FDR for different receiver pathways
-        pred_b = (
-            pd.read_csv(os.path.join(fd, job_id + "_b.txt"), sep="\t")
-            .iloc[:, 1]
-            .mean()
-        )
-        fdr = pd.read_csv(os.path.join(fd, job_id + "_FDRs.txt"), sep="\t")
-        fdr = fdr.reset_index()
-        fdr.index = [job_id] * fdr.shape[0]
-        fdr.columns = ["Theta_cutoff", "FDR"]
-        fdr.Theta_cutoff = fdr.Theta_cutoff / 10
-        fdr["b"] = pred_b
-        b_plus_fdr = pd.concat([b_plus_fdr, fdr])
-        
-    # update pathway_betas
-    c_l = int((ntotal-nwarm)/nthin)
-    agg_mode = 'pca' if sender_features == 'pca' else 'gene'
-    pathways = process_beta(pathways.copy(), output_path, c_l, nchain,agg_mode)
-    pathways.to_csv(os.path.join(output_path, "Pathway_betas.csv"))
-    
-    interactions.to_csv(os.path.join(output_path, "Interactions.csv"))
-    # calculate p values for b
-    b_plus_fdr = process_b(b_plus_fdr.copy(), output_path, c_l, nchain)
-    b_plus_fdr.to_csv(os.path.join(output_path, "B_and_FDR.csv"))
-    
-    # Remove model_input files
-    if not keep:
-        os.system("rm -rf {}".format(intermediate_folder))
+#%%
+if __name__ == "__main__":
+    main()
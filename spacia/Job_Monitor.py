@@ -0,0 +1,204 @@
+# Standard library imports
+import os
+import json
+import time
+import queue
+import signal
+from typing import Dict, List, Optional
+
+# Third-party library imports
+import numpy as np
+import pandas as pd
+
+
+def read_status(status_fn: str) -> Optional[dict]:
+    """
+    Read the json status file published by a running MCMC job, see
+    tickProgress in MICProB_MIL_C2Cinter.R. Returns None if the job has not
+    reported yet.
+    """
+    try:
+        with open(status_fn) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class JobMonitor:
+    """
+    Aggregates the progress of MCMC jobs from their status files into a live
+    progress view, and kills jobs that are stuck or much slower than others.
+    Jobs fitted by MIL_Laplace.py (method 'laplace' in their status) are
+    counted as running while they fit, but their optimizer iterations are
+    not MCMC iterations and are left out of the iterations/sec and of the
+    stuck and slow job checks.
+
+    Attributes:
+        status_files (Dict[str, str]): Status file of each job, by job id
+        output_path (str): Folder where the progress table is written
+        stall_timeout (Optional[float]): Seconds without a status update after
+            which a running job is considered stuck and killed
+        slow_job_factor (Optional[float]): Jobs slower than the median
+            iterations/sec divided by this factor are killed
+        inference (str): Inference of the jobs, 'mcmc' or 'laplace', for the
+            jobs that have not reported yet and the progress line
+        killed (Dict[str, str]): Killed jobs and the reason
+    """
+
+    def __init__(
+        self,
+        status_files: Dict[str, str],
+        output_path: str,
+        stall_timeout: Optional[float] = None,
+        slow_job_factor: Optional[float] = None,
+        inference: str = "mcmc",
+    ):
+        self.status_files = {}
+        self.output_path = output_path
+        self.stall_timeout = stall_timeout
+        self.slow_job_factor = slow_job_factor
+        self.inference = inference
+        self.killed = {}
+        self.t0 = time.time()
+        self.last_update = time.time()
+        self.add_jobs(status_files)
+
+    def add_jobs(self, status_files: Dict[str, str]):
+        """
+        Monitor more jobs, must be called before the jobs are started.
+        """
+        # remove status files left over by earlier runs
+        for fn in status_files.values():
+            if os.path.exists(fn):
+                os.remove(fn)
+        self.status_files.update(status_files)
+
+    def poll(self) -> pd.DataFrame:
+        """Read the status of all jobs into a table, one row per job."""
+        rows = []
+        for job_id, fn in self.status_files.items():
+            status = read_status(fn) or {"phase": "queued"}
+            status.setdefault("method", self.inference)
+            status["job_id"] = job_id
+            if job_id in self.killed:
+                status["phase"] = "killed"
+            rows.append(status)
+        progress = pd.DataFrame(rows).set_index("job_id")
+        for col in [
+            "iter_done", "iter_total", "iter_per_sec", "eta_sec", "updated",
+            "optimizer_iterations",
+        ]:
+            if col not in progress.columns:
+                progress[col] = np.nan
+        return progress
+
+    def check_jobs(self, progress: pd.DataFrame) -> List[str]:
+        """Kill stuck and slow running jobs, returns the newly killed ones."""
+        running = progress[
+            progress.phase.isin(["warmup", "sampling"]) & (progress.method == "mcmc")]
+        to_kill = {}
+        if self.stall_timeout is not None:
+            stalled = running[time.time() - running.updated > self.stall_timeout]
+            for job_id in stalled.index:
+                to_kill[job_id] = "no progress for {:.0f}s".format(self.stall_timeout)
+        if (self.slow_job_factor is not None) & (running.shape[0] >= 3):
+            median_rate = running.iter_per_sec.median()
+            slow = running[running.iter_per_sec < median_rate / self.slow_job_factor]
+            for job_id in slow.index:
+                to_kill.setdefault(
+                    job_id,
+                    "{:.1f} iterations/sec, median is {:.1f}".format(
+                        slow.loc[job_id, "iter_per_sec"], median_rate),
+                )
+        for job_id, reason in to_kill.items():
+            try:
+                os.kill(int(running.loc[job_id, "pid"]), signal.SIGTERM)
+            except (OSError, ValueError):
+                continue
+            self.killed[job_id] = reason
+            print("Killed MCMC job {}: {}".format(job_id, reason))
+        return list(to_kill.keys())
+
+    def report(self, progress: pd.DataFrame) -> str:
+        """
+        Summarize the progress of all jobs in one line, and save the per job
+        progress table to mcmc_progress.tsv in the output path.
+        """
+        progress.to_csv(os.path.join(self.output_path, "mcmc_progress.tsv"), sep="\t")
+        n_jobs = progress.shape[0]
+        phases = progress.phase.value_counts()
+        running = progress.phase.isin(["warmup", "sampling", "fitting"])
+        mcmc_running = running & (progress.method == "mcmc")
+        frac = (progress.iter_done / progress.iter_total).fillna(0)
+        frac[progress.phase == "done"] = 1
+        eta = progress.loc[mcmc_running, "eta_sec"].max()
+        line = (
+            "{} progress: {:.1f}% | {} done, {} running, {} queued, {} killed "
+            "of {} jobs | {:.0f} iterations/sec | ETA of running jobs {}".format(
+                "Laplace fit" if self.inference == "laplace" else "MCMC",
+                100 * frac.mean(),
+                phases.get("done", 0),
+                running.sum(),
+                phases.get("queued", 0),
+                phases.get("killed", 0),
+                n_jobs,
+                progress.loc[mcmc_running, "iter_per_sec"].sum(),
+                "n/a" if np.isnan(eta) else time.strftime("%H:%M:%S", time.gmtime(eta)),
+            )
+        )
+        print(line)
+        return line
+
+    def update(self) -> Optional[pd.DataFrame]:
+        """Poll, check and report once."""
+        self.last_update = time.time()
+        if len(self.status_files) == 0:
+            return None
+        progress = self.poll()
+        if self.check_jobs(progress):
+            progress = self.poll()
+        self.report(progress)
+        return progress
+
+    def wait_queue(self, finished: queue.Queue, interval: float = 30):
+        """
+        Monitor the jobs until a finished job is put on the queue, e.g. by the
+        callback of apply_async, and return it. Progress is reported every
+        interval seconds even if jobs keep finishing.
+        """
+        while True:
+            if time.time() - self.last_update >= interval:
+                self.update()
+            try:
+                return finished.get(
+                    timeout=max(0, self.last_update + interval - time.time()))
+            except queue.Empty:
+                continue
+
+    def summary(self) -> Dict[str, dict]:
+        """
+        Final iterations/sec and status of each job, to be added to the job
+        records of the run report. Laplace fits have their status and
+        optimizer iterations instead.
+        """
+        progress = self.poll()
+        res = {}
+        for job_id, row in progress.iterrows():
+            if row.method == "laplace":
+                res[job_id] = {
+                    "inference": "laplace",
+                    "status": row.phase,
+                    "optimizer_iterations": None if pd.isna(row.optimizer_iterations)
+                    else int(row.optimizer_iterations),
+                }
+            else:
+                res[job_id] = {
+                    "inference": "mcmc",
+                    "mcmc_status": row.phase,
+                    "iterations": None if pd.isna(row.iter_done) else int(row.iter_done),
+                    "iter_per_sec": None if pd.isna(row.iter_per_sec)
+                    else round(row.iter_per_sec, 3),
+                }
+            if job_id in self.killed:
+                res[job_id]["killed_reason"] = self.killed[job_id]
+        return res
@@ -0,0 +1,297 @@
+"""
+Convergence diagnostics of the beta and b draws of spacia_job.R jobs,
+computed with vectorized array math for all chains and parameters of a job
+at once, in place of the ggmcmc plots of BetaB2MCMCPlots.R.
+
+The draws of a job are an array of shape (chains, draws, parameters). For
+each parameter, the diagnostics table has its posterior mean and sd, the
+multi-chain effective sample size, the split-chain R hat, the Geweke z-score
+of the chain that deviates most and the lag 1 autocorrelation. Plots are
+rendered in a separate pass, after the MCMC jobs are done:
+
+    python spacia/MCMC_Diagnostics.py <output_path> --n_chains 2 --plot
+"""
+
+# Standard library imports
+import os
+import json
+import argparse
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Third-party library imports
+import numpy as np
+import pandas as pd
+
+
+def read_draws(fn: str, n_chains: int) -> Tuple[np.ndarray, List[str]]:
+    """
+    Read a *_beta.txt or *_b.txt file of spacia_job.R as a (chains, draws,
+    parameters) array, without the initial value saved as the first row of
+    each chain, and the parameter names. Chains stopped early by the
+    adaptive mode have the same length, inferred from the number of rows.
+    """
+    df = pd.read_csv(fn, sep="\t")
+    n_rows = df.shape[0] // n_chains
+    draws = df.values[: n_rows * n_chains].reshape(n_chains, n_rows, df.shape[1])
+    return draws[:, 1:], df.columns.tolist()
+
+
+def read_job_draws(
+    job_folder: str, n_chains: int, sender_names: Optional[Sequence[str]] = None,
+) -> Optional[Dict[str, Tuple[np.ndarray, List[str]]]]:
+    """
+    Draws of the betas and b of one spacia_job.R job, see read_draws, the
+    betas being named by sender_names if given. Returns None if the job has
+    no draws.
+    """
+    job_id = os.path.basename(os.path.normpath(job_folder))
+    res = {}
+    for kind in ["beta", "b"]:
+        fn = os.path.join(job_folder, job_id + "_" + kind + ".txt")
+        if not os.path.exists(fn):
+            return None
+        draws, columns = read_draws(fn, n_chains)
+        if (kind == "beta") & (sender_names is not None):
+            if len(sender_names) == len(columns):
+                columns = list(sender_names)
+        res[kind] = (draws, columns)
+    return res
+
+
+def autocovariance(draws: np.ndarray) -> np.ndarray:
+    """FFT autocovariance of each chain and parameter, along the draws axis."""
+    n = draws.shape[1]
+    x = draws - draws.mean(axis=1, keepdims=True)
+    f = np.fft.rfft(x, n=2 * n, axis=1)
+    return np.fft.irfft(f * np.conj(f), n=2 * n, axis=1)[:, :n] / n
+
+
+def _geyer_tau(rho: np.ndarray) -> np.ndarray:
+    """
+    Integrated autocorrelation time from autocorrelations along axis 0,
+    truncated at the first non-positive sum of two consecutive lags
+    (Geyer's initial positive sequence), as effSampleSize in
+    MICProB_MIL_C2Cinter.R.
+    """
+    k_max = rho.shape[0] // 2
+    pairs = rho[0:2 * k_max:2] + rho[1:2 * k_max:2]
+    stop = pairs <= 0
+    k = np.where(stop.any(axis=0), stop.argmax(axis=0), k_max)
+    sums = np.concatenate([np.zeros((1,) + pairs.shape[1:]), np.cumsum(pairs, axis=0)])
+    tau = -1 + 2 * np.take_along_axis(sums, k[None], axis=0)[0]
+    return np.maximum(tau, 1)
+
+
+def effective_sample_size(draws: np.ndarray) -> np.ndarray:
+    """Multi-chain effective sample size of each parameter."""
+    n_chains, n = draws.shape[:2]
+    acov = autocovariance(draws)
+    w = (acov[:, 0] * n / (n - 1)).mean(axis=0)
+    var_plus = w * (n - 1) / n
+    if n_chains > 1:
+        var_plus = var_plus + draws.mean(axis=1).var(axis=0, ddof=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rho = 1 - (w - acov.mean(axis=0)) / var_plus
+    rho[0] = 1
+    ess = n_chains * n / _geyer_tau(rho)
+    return np.where(var_plus > 0, ess, n_chains * n)
+
+
+def split_rhat(draws: np.ndarray) -> np.ndarray:
+    """Split-chain R hat (PSRF) of each parameter, as splitPSRF in R."""
+    n = draws.shape[1] // 2
+    halves = np.concatenate([draws[:, :n], draws[:, draws.shape[1] - n:]])
+    b = n * halves.mean(axis=1).var(axis=0, ddof=1)
+    w = halves.var(axis=1, ddof=1).mean(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sqrt(((n - 1) / n * w + b / n) / w)
+
+
+def geweke(draws: np.ndarray, first: float = 0.1, last: float = 0.5) -> np.ndarray:
+    """
+    Geweke z-scores of each chain and parameter, comparing the means of the
+    first and last parts of the chains. The variance of each mean comes
+    from the spectral density at frequency 0, estimated with the
+    autocorrelation time of the part.
+    """
+    n = draws.shape[1]
+    parts = [draws[:, :max(2, int(first * n))], draws[:, n - max(2, int(last * n)):]]
+    means, variances = [], []
+    for x in parts:
+        acov = autocovariance(x)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rho = np.moveaxis(acov / acov[:, :1], 1, 0)
+        tau = _geyer_tau(np.nan_to_num(rho))
+        means.append(x.mean(axis=1))
+        variances.append(acov[:, 0] * tau / x.shape[1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (means[0] - means[1]) / np.sqrt(variances[0] + variances[1])
+
+
+def diagnostics_table(draws: np.ndarray, parameters: Sequence[str]) -> pd.DataFrame:
+    """Diagnostics of each parameter of a (chains, draws, parameters) array."""
+    acov = autocovariance(draws)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        acf1 = (acov[:, 1] / acov[:, 0]).mean(axis=0)
+    z = geweke(draws)
+    worst = np.nan_to_num(np.abs(z), nan=-1).argmax(axis=0)
+    flat = draws.reshape(-1, draws.shape[2])
+    return pd.DataFrame({
+        "parameter": list(parameters),
+        "mean": flat.mean(axis=0),
+        "sd": flat.std(axis=0, ddof=1),
+        "ess": effective_sample_size(draws),
+        "split_rhat": split_rhat(draws),
+        "geweke_z": z[worst, np.arange(draws.shape[2])],
+        "acf_lag1": acf1,
+    })
+
+
+def diagnose_job(
+    job_folder: str, n_chains: int, sender_names: Optional[Sequence[str]] = None,
+) -> Optional[pd.DataFrame]:
+    """Diagnostics table of the betas and b of one job, see read_job_draws."""
+    job_draws = read_job_draws(job_folder, n_chains, sender_names)
+    if job_draws is None:
+        return None
+    tables = []
+    for kind, (draws, columns) in job_draws.items():
+        table = diagnostics_table(draws, columns)
+        table.insert(0, "type", kind)
+        tables.append(table)
+    res = pd.concat(tables, ignore_index=True)
+    res.insert(0, "job_id", os.path.basename(os.path.normpath(job_folder)))
+    return res
+
+
+def _diagnose_job(job):
+    return diagnose_job(*job)
+
+
+def diagnose_jobs(
+    job_folders: List[str], n_chains: int,
+    sender_names: Optional[Sequence[str]] = None, n_workers: int = 1,
+) -> pd.DataFrame:
+    """Diagnostics tables of several jobs, read by parallel workers."""
+    jobs = [(x, n_chains, sender_names) for x in job_folders]
+    if (n_workers > 1) & (len(jobs) > 1):
+        with Pool(min(n_workers, len(jobs))) as p:
+            tables = p.map(_diagnose_job, jobs)
+    else:
+        tables = [_diagnose_job(x) for x in jobs]
+    tables = [x for x in tables if x is not None]
+    if len(tables) == 0:
+        return pd.DataFrame()
+    return pd.concat(tables, ignore_index=True)
+
+
+def plot_job(
+    job_folder: str, n_chains: int, sender_names: Optional[Sequence[str]] = None,
+    ext: str = "pdf", max_lag: int = 50,
+) -> Optional[str]:
+    """
+    Plot the trace, density and autocorrelation of the betas and b of one
+    job, one row per parameter, to <job_id>_diagnostics.<ext> in its folder.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    job_draws = read_job_draws(job_folder, n_chains, sender_names)
+    if job_draws is None:
+        return None
+    job_id = os.path.basename(os.path.normpath(job_folder))
+    draws = np.concatenate([x[0] for x in job_draws.values()], axis=2)
+    names = sum([x[1] for x in job_draws.values()], [])
+    acov = autocovariance(draws)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        acf = (acov / acov[:, :1]).mean(axis=0)
+    n_lags = min(max_lag, draws.shape[1] - 1) + 1
+
+    fig, axes = plt.subplots(
+        len(names), 3, figsize=(12, 2 * len(names)), squeeze=False)
+    for j, name in enumerate(names):
+        for c in range(n_chains):
+            axes[j, 0].plot(draws[c, :, j], lw=0.5)
+            axes[j, 1].hist(draws[c, :, j], bins=30, density=True, alpha=0.5)
+        axes[j, 2].bar(np.arange(n_lags), acf[:n_lags, j], width=0.8)
+        axes[j, 0].set_ylabel(name)
+    axes[0, 0].set_title("Trace")
+    axes[0, 1].set_title("Density")
+    axes[0, 2].set_title("Autocorrelation")
+    fig.tight_layout()
+    fn = os.path.join(job_folder, "{}_diagnostics.{}".format(job_id, ext))
+    fig.savefig(fn)
+    plt.close(fig)
+    return fn
+
+
+def _plot_job(job):
+    return plot_job(*job)
+
+
+def plot_jobs(
+    job_folders: List[str], n_chains: int,
+    sender_names: Optional[Sequence[str]] = None, ext: str = "pdf",
+    n_workers: int = 1,
+) -> List[str]:
+    """Plot several jobs in parallel workers, returns the plot files."""
+    jobs = [(x, n_chains, sender_names, ext) for x in job_folders]
+    if (n_workers > 1) & (len(jobs) > 1):
+        with Pool(min(n_workers, len(jobs))) as p:
+            fns = p.map(_plot_job, jobs)
+    else:
+        fns = [_plot_job(x) for x in jobs]
+    return [x for x in fns if x is not None]
+
+
+def find_job_folders(output_path: str) -> List[str]:
+    """Job folders of a receiver/sender pair, the folders with a *_beta.txt file."""
+    res = []
+    for fd in sorted(os.listdir(output_path)):
+        if os.path.exists(os.path.join(output_path, fd, fd + "_beta.txt")):
+            res.append(os.path.join(output_path, fd))
+    return res
+
+
+def read_sender_names(output_path: str) -> Optional[List[str]]:
+    """Sender pathway names of the betas, if the model_input folder was kept."""
+    fn = os.path.join(output_path, "model_input", "sender_pathways.json")
+    if not os.path.exists(fn):
+        return None
+    with open(fn) as f:
+        return list(json.load(f).keys())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Diagnostics of the MCMC chains of the spacia_job.R jobs of \
+            a receiver/sender pair, saved as MCMC_diagnostics.csv in its folder."
+    )
+    parser.add_argument("output_path", type=str, help="Output folder of a pair.")
+    parser.add_argument(
+        "--n_chains",
+        type=int,
+        required=True,
+        help="Number of chains of the jobs, see '--mcmc_params' of spacia.py.",
+    )
+    parser.add_argument(
+        "--plot",
+        action="store_true",
+        default=False,
+        help="Also plot the trace, density and autocorrelation of each job.",
+    )
+    parser.add_argument(
+        "--ext", type=str, default="pdf", help="File format of the plots.",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=8, help="Number of parallel workers.",
+    )
+    args = parser.parse_args()
+    job_folders = find_job_folders(args.output_path)
+    sender_names = read_sender_names(args.output_path)
+    diagnose_jobs(job_folders, args.n_chains, sender_names, args.workers).to_csv(
+        os.path.join(args.output_path, "MCMC_diagnostics.csv"), index=False)
+    if args.plot:
+        plot_jobs(job_folders, args.n_chains, sender_names, args.ext, args.workers)
@@ -0,0 +1,344 @@
+"""
+Fast approximate inference of the probit multiple instance model of
+MICProB_MIL_C2Cinter.R by a Laplace approximation of the posterior, for
+screening many receiver pathways before running the MCMC of the hits.
+
+The model is the one of the Gibbs sampler: each sender instance j of the bag
+of receiver i is a primary instance (delta_ij = 1) if u_ij > 0, with
+u_ij ~ N(b0 + b1 * distance_ij, 1), and the receiver label is y_i = 1 if
+z_i > 0, with z_i ~ N(beta0 + sum_j delta_ij * x_ij' beta, 1). Priors of
+beta and b are N(0, prior * I). z, u and delta are integrated out, with
+the bag sum of delta_ij * x_ij' beta approximated by a normal of the same
+mean and variance, and beta and b are approximated by a normal centered at
+the posterior mode (L-BFGS with analytic gradient) with the inverse
+Hessian as covariance. All bags are handled with vectorized array math.
+
+It is a drop-in replacement of spacia_job.R, with the same command line
+and output files (betas, b, primary instance scores, B-FDRs, chains state,
+log and a status marked as a Laplace fit), the draws of each "chain" being independent draws from
+the approximate posterior:
+
+    python spacia/MIL_Laplace.py exp_sender.json dist_sender.json \
+        exp_receiver.csv job_id ntotal nwarm nthin nchain output_path/
+"""
+
+# Standard library imports
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import contextlib
+from typing import Dict, List, Optional, Tuple
+
+# Third-party library imports
+import numpy as np
+import pandas as pd
+from scipy.special import expit, log_ndtr
+
+THETAS = np.arange(1, 10) / 10
+
+
+def read_sender_inputs(
+    exp_sender_fn: str, dist_sender_fn: str,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Read the sender inputs of spacia.py as the instance features (instances
+    x sender pathways), the distances normalized by the maximal distance as
+    in spacia_job.R, and the number of instances of each bag.
+    """
+    with open(exp_sender_fn) as f:
+        exp_sender = json.load(f)
+    with open(dist_sender_fn) as f:
+        dist_sender = json.load(f)
+    ninst = np.array([len(x) for x in dist_sender.values()], dtype=np.int64)
+    pos = np.concatenate([np.asarray(x, dtype=float) for x in dist_sender.values()])
+    pos = pos / pos.max()
+    X = np.concatenate([
+        np.asarray(x, dtype=float).reshape(len(x), -1) for x in exp_sender.values()])
+    return X, pos, ninst
+
+
+def _mills(x: np.ndarray) -> np.ndarray:
+    """Inverse Mills ratio phi(x) / Phi(x), stable for large negative x."""
+    return np.exp(-0.5 * x ** 2 - 0.5 * np.log(2 * np.pi) - log_ndtr(x))
+
+
+def _bag_moments(
+    theta: np.ndarray, pos: np.ndarray, X: np.ndarray, offsets: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Primary instance probabilities p, instance effects t = x' beta, and mean
+    and variance of the bag sums of delta * t, for theta = (beta0, beta, b).
+    """
+    d = X.shape[1]
+    p = np.exp(log_ndtr(theta[d + 1] + theta[d + 2] * pos))
+    t = X @ theta[1:d + 1]
+    mean = np.add.reduceat(p * t, offsets)
+    var = np.add.reduceat(p * (1 - p) * t ** 2, offsets)
+    return p, t, mean, var
+
+
+def neg_log_posterior(
+    theta: np.ndarray, y: np.ndarray, pos: np.ndarray, X: np.ndarray,
+    offsets: np.ndarray, bag: np.ndarray, prior: float = 1,
+) -> Tuple[float, np.ndarray]:
+    """
+    Negative log posterior of theta = (beta0, beta, b) and its gradient, with
+    the primary instances and latent variables integrated out. The bag sum
+    of delta * x' beta is approximated by a normal of the same mean and
+    variance, so that P(y_i = 1) = Phi((beta0 + mean_i) / sqrt(1 + var_i)).
+    """
+    d = X.shape[1]
+    p, t, mean, var = _bag_moments(theta, pos, X, offsets)
+    scale = np.sqrt(1 + var)
+    sign = np.where(y, 1, -1)
+    eta = (theta[0] + mean) / scale
+    log_lik = log_ndtr(sign * eta).sum()
+
+    # chain rule through eta, the bag moments and p
+    g_eta = sign * _mills(sign * eta)
+    g_mean = (g_eta / scale)[bag]
+    g_var = (-0.5 * g_eta * eta / scale ** 2)[bag]
+    g_beta = X.T @ (g_mean * p + 2 * g_var * p * (1 - p) * t)
+    w = theta[d + 1] + theta[d + 2] * pos
+    g_p = (g_mean * t + g_var * (1 - 2 * p) * t ** 2) * np.exp(
+        -0.5 * w ** 2 - 0.5 * np.log(2 * np.pi))
+    grad = np.concatenate([
+        [(g_eta / scale).sum()], g_beta, [g_p.sum(), g_p @ pos]])
+    return -(log_lik - 0.5 * theta @ theta / prior), -(grad - theta / prior)
+
+
+def fit_laplace(
+    y: np.ndarray, pos: np.ndarray, X: np.ndarray, ninst: np.ndarray,
+    prior: float = 1, max_iter: int = 1000, tol: float = 1e-8,
+) -> Dict[str, np.ndarray]:
+    """
+    Laplace approximation of the posterior of the probit multiple instance
+    model: maximum a posteriori beta and b, with the covariance of the
+    inverse Hessian at the mode.
+
+    Parameters:
+    y (np.ndarray): Label of each bag (receiver), 0 or 1
+    pos (np.ndarray): Normalized distance of each instance (sender)
+    X (np.ndarray): Features of each instance, instances x sender pathways
+    ninst (np.ndarray): Number of instances of each bag, in the order of X
+    prior (float): Prior variance of beta and b
+    max_iter (int): Maximal number of L-BFGS iterations
+    tol (float): Tolerance of the projected gradient of L-BFGS
+
+    Returns:
+    Dict[str, np.ndarray]: posterior mode and covariance of beta (with
+        intercept, 'beta', 'beta_cov') and b ('b', 'b_cov'), the posterior
+        probability of each instance being primary at the mode ('pip') and
+        the number of iterations ('n_iter')
+    """
+    from scipy.optimize import minimize
+
+    y = np.asarray(y, dtype=bool)
+    d = X.shape[1]
+    offsets = np.concatenate([[0], np.cumsum(ninst)[:-1]])
+    bag = np.repeat(np.arange(len(ninst)), ninst)
+    fn_args = (y, pos, X, offsets, bag, prior)
+    res = minimize(
+        neg_log_posterior, np.zeros(d + 3), args=fn_args, jac=True,
+        method='L-BFGS-B', options={'maxiter': max_iter, 'gtol': tol})
+    theta = res.x
+
+    # Hessian by central differences of the analytic gradient
+    step = 1e-5 * np.maximum(1, np.abs(theta))
+    hess = np.empty((d + 3, d + 3))
+    for k in range(d + 3):
+        e = np.zeros(d + 3)
+        e[k] = step[k]
+        hess[k] = (
+            neg_log_posterior(theta + e, *fn_args)[1]
+            - neg_log_posterior(theta - e, *fn_args)[1]) / (2 * step[k])
+    hess = (hess + hess.T) / 2
+    try:
+        cov = np.linalg.inv(np.linalg.cholesky(hess))
+        cov = cov.T @ cov
+    except np.linalg.LinAlgError:
+        # not a strict mode, fall back to the prior
+        print('Hessian not positive definite, using the prior covariance.')
+        cov = np.eye(d + 3) * prior
+
+    # P(delta_ij = 1 | y_i) at the mode, with the moments of the other
+    # instances of the bag
+    p, t, mean, var = _bag_moments(theta, pos, X, offsets)
+    mean_other = mean[bag] - p * t
+    scale_other = np.sqrt(1 + var[bag] - p * (1 - p) * t ** 2)
+    sign = np.where(y, 1, -1)[bag]
+    log_on = log_ndtr(sign * (theta[0] + t + mean_other) / scale_other)
+    log_off = log_ndtr(sign * (theta[0] + mean_other) / scale_other)
+    pip = expit(log_ndtr(theta[d + 1] + theta[d + 2] * pos) + log_on
+                - log_ndtr(-theta[d + 1] - theta[d + 2] * pos) - log_off)
+    return {
+        'beta': theta[:d + 1], 'beta_cov': cov[:d + 1, :d + 1],
+        'b': theta[d + 1:], 'b_cov': cov[d + 1:, d + 1:],
+        'pip': pip, 'n_iter': res.nit,
+    }
+
+
+def write_table(fn: str, values: np.ndarray, name: str):
+    """Write values as write.table of the list(name=values) in spacia_job.R."""
+    values = np.asarray(values, dtype=float)
+    values = values.reshape(len(values), -1)
+    if (values.shape[1] == 1) & (name == 'FDRs'):
+        columns = ['x']
+    elif values.shape[1] == 1:
+        columns = [name]
+    else:
+        columns = ['{}.{}'.format(name, i + 1) for i in range(values.shape[1])]
+    # quoted header without a row names column, quoted row names
+    with open(fn, 'w') as f:
+        f.write('\t'.join('"{}"'.format(x) for x in columns) + '\n')
+        for i, row in enumerate(values):
+            f.write('"{}"\t'.format(i + 1) + '\t'.join('%.15g' % x for x in row) + '\n')
+
+
+def write_status(fn: str, phase: str, n_iter: int, elapsed: float):
+    """
+    Status file of the job, as tickProgress in MICProB_MIL_C2Cinter.R, but
+    marked with method 'laplace' and with the L-BFGS iterations as
+    optimizer_iterations instead of MCMC iterations, so that JobMonitor
+    keeps them out of the iterations/sec of the MCMC jobs.
+    """
+    status = {
+        'pid': os.getpid(), 'method': 'laplace', 'phase': phase,
+        'optimizer_iterations': n_iter, 'elapsed_sec': round(elapsed, 1),
+        'updated': time.time(),
+    }
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(status, f)
+    os.replace(fn + '.tmp', fn)
+
+
+def run_job(
+    job: dict, X: np.ndarray, pos: np.ndarray, ninst: np.ndarray, nthin: int,
+    nchain: int, prior: float = 1, bags: Optional[str] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Fit one receiver pathway and write its outputs as spacia_job.R, with
+    nchain chains of independent draws of beta and b from the approximate
+    posterior, of the same length as the MCMC chains. job has the job_id,
+    exp_receiver, output_path, ntotal and nwarm of the job, and bags is the
+    fingerprint of the bags saved with the chains state.
+    """
+    job_id, output_path = job['job_id'], job['output_path']
+    prefix = os.path.join(output_path, job_id)
+    status_fn = prefix + '_status.json'
+    t0 = time.perf_counter()
+    write_status(status_fn, 'fitting', 0, 0)
+    y = pd.read_csv(job['exp_receiver'], header=None).iloc[:, 0].values == 1
+    if len(y) != len(ninst):
+        raise ValueError('{} labels for {} bags!'.format(len(y), len(ninst)))
+
+    fit = fit_laplace(y, pos, X, ninst, prior)
+    print('Laplace fit of {} bags and {} instances converged in {} iterations.'.format(
+        len(ninst), len(pos), fit['n_iter']))
+
+    # one "initial" draw followed by the saved draws of each chain, as the
+    # MCMC outputs
+    niter = int(job['ntotal']) - int(job['nwarm'])
+    nsave = 1 + (niter - 1) // nthin
+    rng = np.random.default_rng(0)
+    beta = rng.multivariate_normal(fit['beta'], fit['beta_cov'], nchain * (nsave + 1))
+    b = rng.multivariate_normal(fit['b'], fit['b_cov'], nchain * (nsave + 1))
+    pip = np.tile(fit['pip'][:, None], (1, nchain))
+    fdrs = np.array([
+        ((pip > theta) * (1 - pip)).sum() / (pip > theta).sum()
+        if (pip > theta).any() else 1
+        for theta in THETAS])
+    write_table(prefix + '_pip.txt', pip, 'pip')
+    write_table(prefix + '_b.txt', b, 'b')
+    write_table(prefix + '_beta.txt', beta[:, 1:], 'beta')
+    write_table(prefix + '_FDRs.txt', fdrs, 'FDRs')
+    write_table(
+        prefix + '_pip_recal.txt',
+        np.exp(log_ndtr(fit['b'][0] + pos * fit['b'][1])), 'pip_recal')
+
+    # chains state for warm starts of the MCMC, see warm_start_inits
+    last = (np.arange(nchain) + 1) * (nsave + 1) - 1
+    state = {
+        'chains': [
+            {
+                'beta': beta[i].tolist(), 'b': b[i].tolist(),
+                'delta': (fit['pip'] > 0.5).astype(int).tolist(),
+            }
+            for i in last
+        ],
+        'mean': {
+            'beta': fit['beta'].tolist(), 'b': fit['b'].tolist(),
+            'beta_sd': np.sqrt(np.diag(fit['beta_cov'])).tolist(),
+            'b_sd': np.sqrt(np.diag(fit['b_cov'])).tolist(),
+        },
+    }
+    if bags is not None:
+        state['bags'] = bags
+    with open(prefix + '_state.json', 'w') as f:
+        json.dump(state, f)
+    elapsed = time.perf_counter() - t0
+    # marks the job as a finished Laplace fit for later runs, see
+    # finished_job_inference in spacia.py
+    write_status(status_fn, 'done', fit['n_iter'], elapsed)
+    print('Laplace fit in {:.3f} secs'.format(elapsed))
+    return fit
+
+
+def read_jobs(
+    exp_receiver: str, job_id: str, ntotal: int, nwarm: int, output_path: str,
+) -> List[dict]:
+    """
+    Jobs of one process: a single job, or the json list of jobs of the same
+    sender inputs of --multi_response in spacia.py.
+    """
+    if exp_receiver.endswith('.json'):
+        with open(exp_receiver) as f:
+            return json.load(f)
+    return [{
+        'job_id': job_id, 'exp_receiver': exp_receiver, 'output_path': output_path,
+        'ntotal': ntotal, 'nwarm': nwarm,
+    }]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Laplace approximation of the spacia MIL model, with the command \
+            line and outputs of spacia_job.R.")
+    parser.add_argument("exp_sender", type=str, help="exp_sender.json of model_input")
+    parser.add_argument("dist_sender", type=str, help="dist_sender.json of model_input")
+    parser.add_argument(
+        "exp_receiver", type=str,
+        help="Receiver labels csv, or json list of jobs of the same senders")
+    parser.add_argument("job_id", type=str, help="Job id, prefix of the outputs")
+    parser.add_argument("ntotal", type=int, help="MCMC iterations, sets the number of draws")
+    parser.add_argument("nwarm", type=int, help="MCMC warm-up iterations")
+    parser.add_argument("nthin", type=int, help="MCMC thinning")
+    parser.add_argument("nchain", type=int, help="Number of chains of draws")
+    parser.add_argument("output_path", type=str, help="Output folder of the job")
+    parser.add_argument("--prior", type=float, default=1, help="Prior variance of beta and b")
+    args = parser.parse_args()
+
+    X, pos, ninst = read_sender_inputs(args.exp_sender, args.dist_sender)
+    # fingerprint of the bags, as spacia_job.R, see bag_fingerprint in spacia.py
+    bags = None
+    metadata_fn = os.path.join(os.path.dirname(args.dist_sender), 'metadata.txt')
+    if os.path.exists(metadata_fn):
+        with open(metadata_fn, 'rb') as f:
+            bags = hashlib.md5(f.read()).hexdigest()
+    jobs = read_jobs(
+        args.exp_receiver, args.job_id, args.ntotal, args.nwarm, args.output_path)
+    failed = False
+    for k, job in enumerate(jobs):
+        log_fn = os.path.join(job['output_path'], job['job_id'] + '_log.txt')
+        with open(log_fn, 'w') as log, contextlib.redirect_stdout(log):
+            if len(jobs) > 1:
+                print('Job {} of {} of {}'.format(k + 1, len(jobs), args.job_id))
+            try:
+                run_job(job, X, pos, ninst, args.nthin, args.nchain, args.prior, bags)
+            except Exception as e:
+                print('{} failed: {!r}'.format(job['job_id'], e))
+                failed = True
+    sys.exit(1 if failed else 0)
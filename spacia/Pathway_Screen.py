@@ -0,0 +1,91 @@
+"""
+Cheap bag-level screening of receiver pathways before their MCMC jobs.
+
+Each bag is summarized by the distance-weighted mean of each sender
+feature over its sender cells, with weights exp(-distance / dist_cutoff),
+so that closer senders count more, as the primary instances of the model.
+The association between the receiver label and each summarized sender
+feature is then tested for all receiver pathway x sender feature
+combinations at once, by the point-biserial correlation and its t-test,
+with one matrix product.
+"""
+
+# Standard library imports
+from typing import List
+
+# Third-party library imports
+import numpy as np
+import pandas as pd
+
+
+def bag_means(
+    indptr: np.ndarray, indices: np.ndarray, weights: np.ndarray,
+    values: np.ndarray,
+) -> np.ndarray:
+    """
+    Weighted mean of the values of the instances of each bag.
+
+    Parameters:
+    indptr (np.ndarray): Offsets of the bags into indices and weights
+    indices (np.ndarray): Row of values of each instance
+    weights (np.ndarray): Weight of each instance
+    values (np.ndarray): Values, rows x features
+
+    Returns:
+    np.ndarray: Weighted means, bags x features, NaN for empty bags
+    """
+    from scipy import sparse
+
+    W = sparse.csr_matrix(
+        (weights, indices, indptr), shape=(len(indptr) - 1, len(values)))
+    total = np.asarray(W.sum(axis=1)).ravel()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (W @ values) / total[:, None]
+
+
+def screen_pathways(labels: pd.DataFrame, features: pd.DataFrame) -> pd.DataFrame:
+    """
+    Test the association of each receiver label with each bag feature.
+
+    Parameters:
+    labels (pd.DataFrame): 0/1 label of each bag, bags x receiver pathways
+    features (pd.DataFrame): Feature of each bag, bags x sender features,
+        on the same index as labels
+
+    Returns:
+    pd.DataFrame: One row per receiver pathway and sender feature, with the
+        number of bags and positive bags, the point-biserial correlation,
+        its t statistic and two-sided p-value. Constant labels or features
+        get a correlation of 0 and a p-value of 1.
+    """
+    from scipy import stats
+
+    features = features.dropna()
+    Y = labels.loc[features.index].values.astype(float)
+    F = features.values.astype(float)
+    n = len(F)
+    Yc, Fc = Y - Y.mean(axis=0), F - F.mean(axis=0)
+    scale = np.outer(np.sqrt((Yc ** 2).sum(axis=0)), np.sqrt((Fc ** 2).sum(axis=0)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = np.where(scale > 0, (Yc.T @ Fc) / scale, 0)
+        corr = np.clip(corr, -1, 1)
+        t = corr * np.sqrt((n - 2) / (1 - corr ** 2))
+    pval = 2 * stats.t.sf(np.abs(t), max(n - 2, 1))
+    return pd.DataFrame({
+        'Receiver_pathway': np.repeat(labels.columns.values, F.shape[1]),
+        'Sender_pathway': np.tile(features.columns.values, Y.shape[1]),
+        'n_bags': n,
+        'n_positive': np.repeat(Y.sum(axis=0).astype(int), F.shape[1]),
+        'corr': corr.ravel(),
+        't': t.ravel(),
+        'pval': pval.ravel(),
+    })
+
+
+def passing_pathways(screen: pd.DataFrame, cutoff: float, column: str = 'pval_adj') -> List:
+    """
+    Receiver pathways of screen with at least one sender feature whose
+    column is at most cutoff, in the order of screen.
+    """
+    best = screen.groupby('Receiver_pathway', sort=False)[column].min()
+    return best.index[best <= cutoff].tolist()
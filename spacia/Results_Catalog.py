@@ -0,0 +1,263 @@
+# Standard library imports
+import os
+import sqlite3
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Sequence, Union
+
+# Third-party library imports
+import pandas as pd
+
+# columns of the *_betas.csv and *_pip.csv files written by spacia.R
+BETA_COLUMNS = [
+    'sending_gene', 'receiving_gene', 'avg_beta', 'avg_beta_sampled',
+    'beta_pval', 'beta_FDR', 'b', 'b_sampled', 'b_pval',
+]
+PIP_COLUMNS = [
+    'receiving_cell', 'sending_cell', 'receiving_gene',
+    'avg_primary_instance_score',
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY,
+    directory TEXT,
+    receiving_cell TEXT,
+    sending_cell TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    file_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run TEXT,
+    path TEXT,
+    kind TEXT,
+    mtime_ns INTEGER,
+    size INTEGER,
+    n_rows INTEGER,
+    UNIQUE (run, path)
+);
+CREATE TABLE IF NOT EXISTS betas (
+    run TEXT,
+    file_id INTEGER,
+    sending_gene TEXT,
+    receiving_gene TEXT,
+    avg_beta REAL,
+    avg_beta_sampled REAL,
+    beta_pval REAL,
+    beta_FDR REAL,
+    b REAL,
+    b_sampled REAL,
+    b_pval REAL,
+    sending_cell TEXT,
+    receiving_cell TEXT
+);
+CREATE TABLE IF NOT EXISTS pips (
+    run TEXT,
+    file_id INTEGER,
+    receiving_cell TEXT,
+    sending_cell TEXT,
+    receiving_gene TEXT,
+    avg_primary_instance_score REAL
+);
+CREATE INDEX IF NOT EXISTS betas_genes ON betas (run, receiving_gene, sending_gene);
+CREATE INDEX IF NOT EXISTS betas_cells ON betas (receiving_cell, sending_cell);
+CREATE INDEX IF NOT EXISTS betas_file ON betas (file_id);
+CREATE INDEX IF NOT EXISTS pips_genes ON pips (run, receiving_gene);
+CREATE INDEX IF NOT EXISTS pips_receiver ON pips (receiving_cell);
+CREATE INDEX IF NOT EXISTS pips_sender ON pips (sending_cell);
+CREATE INDEX IF NOT EXISTS pips_file ON pips (file_id);
+"""
+
+
+def _read_result_file(path: str) -> pd.DataFrame:
+    """Worker function reading one betas or pip csv file."""
+    return pd.read_csv(path)
+
+
+def _result_kind(fn: str) -> Optional[str]:
+    """Kind of a result file, same file name rules as process_spacia_data."""
+    if fn.endswith('betas.csv'):
+        return 'betas'
+    elif fn.endswith('pip.csv'):
+        return 'pips'
+    return None
+
+
+class ResultsCatalog:
+    """
+    Persistent SQLite catalog of the betas and primary instance scores of
+    spacia.R runs, so that results are read from disk once and then queried
+    by run, gene and cell.
+
+    Each run is a results directory for one sending/receiving cell type
+    pair. Adding a run again only loads the files that are new or changed
+    since the last time, and drops the files that were removed.
+
+    Attributes:
+        db_path (str): Path of the SQLite database file
+        con (sqlite3.Connection): Connection to the database
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.con = sqlite3.connect(db_path)
+        self.con.executescript(SCHEMA)
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_run(
+        self,
+        directory: str,
+        receiving_cell: str,
+        sending_cell: str,
+        run: Optional[str] = None,
+        n_workers: int = 8,
+    ) -> Dict[str, int]:
+        """
+        Add or update the results of a run in the catalog.
+
+        Parameters:
+        directory (str): Results directory of the run, searched recursively
+        receiving_cell (str): Receiving cell type of the run
+        sending_cell (str): Sending cell type of the run
+        run (str): Name of the run, the absolute directory path by default
+        n_workers (int): Number of parallel workers reading the files
+
+        Returns:
+        Dict[str, int]: numbers of files added, updated, removed and unchanged
+        """
+        run = run or os.path.abspath(directory)
+        known = pd.read_sql_query(
+            'SELECT file_id, path, mtime_ns, size FROM files WHERE run = ?',
+            self.con, params=(run,), index_col='path')
+
+        on_disk = {}
+        for root, _, files in os.walk(directory):
+            for fn in files:
+                kind = _result_kind(fn)
+                if kind is None:
+                    continue
+                path = os.path.abspath(os.path.join(root, fn))
+                st = os.stat(path)
+                on_disk[path] = (kind, st.st_mtime_ns, st.st_size)
+
+        to_load, to_drop = [], []
+        for path, (kind, mtime_ns, size) in on_disk.items():
+            if path not in known.index:
+                to_load.append(path)
+            elif (known.loc[path, 'mtime_ns'] != mtime_ns) | (known.loc[path, 'size'] != size):
+                to_load.append(path)
+                to_drop.append(int(known.loc[path, 'file_id']))
+        removed = [int(x) for x in known.file_id[~known.index.isin(on_disk.keys())]]
+        to_drop += removed
+
+        # read the new files in parallel, writing is done by this process
+        if (n_workers > 1) & (len(to_load) > 1):
+            with Pool(min(n_workers, len(to_load))) as p:
+                tables = p.map(_read_result_file, to_load)
+        else:
+            tables = [_read_result_file(x) for x in to_load]
+
+        with self.con:
+            self.con.execute(
+                'INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)',
+                (run, os.path.abspath(directory), receiving_cell, sending_cell))
+            for file_id in to_drop:
+                for table in ['betas', 'pips', 'files']:
+                    self.con.execute(
+                        'DELETE FROM {} WHERE file_id = ?'.format(table), (file_id,))
+            for path, df in zip(to_load, tables):
+                kind, mtime_ns, size = on_disk[path]
+                cur = self.con.execute(
+                    'INSERT INTO files (run, path, kind, mtime_ns, size, n_rows) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (run, path, kind, mtime_ns, size, df.shape[0]))
+                if kind == 'betas':
+                    df = df.reindex(columns=BETA_COLUMNS)
+                    df['sending_cell'] = sending_cell
+                    df['receiving_cell'] = receiving_cell
+                else:
+                    df = df.reindex(columns=PIP_COLUMNS)
+                df.insert(0, 'file_id', cur.lastrowid)
+                df.insert(0, 'run', run)
+                df.to_sql(kind, self.con, if_exists='append', index=False, chunksize=100000)
+
+        n_updated = len(to_drop) - len(removed)
+        return {
+            'added': len(to_load) - n_updated,
+            'updated': n_updated,
+            'removed': len(removed),
+            'unchanged': len(on_disk) - len(to_load),
+        }
+
+    def runs(self) -> pd.DataFrame:
+        """All runs in the catalog with their numbers of files."""
+        return pd.read_sql_query(
+            'SELECT runs.*, COUNT(files.file_id) AS n_files FROM runs '
+            'LEFT JOIN files ON runs.run = files.run GROUP BY runs.run',
+            self.con)
+
+    def _query(
+        self, table: str, columns: List[str],
+        filters: Dict[str, Union[None, str, Sequence[str]]],
+    ) -> pd.DataFrame:
+        """Select columns of a table, filtering on one or several values per column."""
+        where, params = [], []
+        for col, value in filters.items():
+            if value is None:
+                continue
+            if isinstance(value, str):
+                value = [value]
+            value = list(value)
+            where.append('{} IN ({})'.format(col, ','.join(['?'] * len(value))))
+            params += value
+        query = 'SELECT {} FROM {}'.format(','.join(columns), table)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        # rows in the order the files were added
+        query += ' ORDER BY file_id, rowid'
+        return pd.read_sql_query(query, self.con, params=params)
+
+    def query_betas(
+        self,
+        run: Union[None, str, Sequence[str]] = None,
+        sending_gene: Union[None, str, Sequence[str]] = None,
+        receiving_gene: Union[None, str, Sequence[str]] = None,
+        sending_cell: Union[None, str, Sequence[str]] = None,
+        receiving_cell: Union[None, str, Sequence[str]] = None,
+    ) -> pd.DataFrame:
+        """
+        Betas of the catalog, in the format returned by process_spacia_data.
+        Each filter takes one value or a list of values, sending_cell and
+        receiving_cell are cell types here.
+        """
+        return self._query(
+            'betas', BETA_COLUMNS + ['sending_cell', 'receiving_cell'],
+            {
+                'run': run, 'sending_gene': sending_gene,
+                'receiving_gene': receiving_gene,
+                'sending_cell': sending_cell, 'receiving_cell': receiving_cell,
+            })
+
+    def query_pips(
+        self,
+        run: Union[None, str, Sequence[str]] = None,
+        receiving_gene: Union[None, str, Sequence[str]] = None,
+        sending_cell: Union[None, str, Sequence[str]] = None,
+        receiving_cell: Union[None, str, Sequence[str]] = None,
+    ) -> pd.DataFrame:
+        """
+        Primary instance scores of the catalog, in the format returned by
+        process_spacia_data. sending_cell and receiving_cell are cell ids.
+        """
+        return self._query(
+            'pips', PIP_COLUMNS,
+            {
+                'run': run, 'receiving_gene': receiving_gene,
+                'sending_cell': sending_cell, 'receiving_cell': receiving_cell,
+            })
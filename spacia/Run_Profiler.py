@@ -0,0 +1,183 @@
+# Standard library imports
+import os
+import sys
+import json
+import time
+import cProfile
+import resource
+import subprocess
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+
+def reset_peak_rss() -> bool:
+    """
+    Reset the peak resident set size (VmHWM) of this process. Only supported
+    on linux, returns False if the peak could not be reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss() -> int:
+    """
+    Peak resident set size of this process in bytes, since the last reset
+    where supported and since the process started otherwise.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return _maxrss_to_bytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def _maxrss_to_bytes(maxrss: int) -> int:
+    """ru_maxrss is in kilobytes on linux and in bytes on macOS."""
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def run_timed_command(
+    cmd: str, cwd: Optional[str] = None, started: Optional[Callable] = None,
+) -> dict:
+    """
+    Run a shell command and measure its wall time, CPU time and peak RSS.
+
+    The resource usage is taken from wait4 on the child process, so it is
+    specific to this command even when called from a pool worker that runs
+    many commands.
+
+    Parameters:
+    cmd (str): Shell command
+    cwd (str): Working directory of the command, the current one by default
+    started (Callable): Called with the Popen of the command once started. The
+        command then runs in its own process group, that started can kill
+        with os.killpg
+
+    Returns:
+    dict: wall_s, cpu_s, peak_rss_mb and returncode of the command
+    """
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        cmd, shell=True, cwd=cwd, start_new_session=started is not None)
+    if started is not None:
+        started(proc)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    return {
+        "wall_s": round(time.perf_counter() - t0, 3),
+        "cpu_s": round(rusage.ru_utime + rusage.ru_stime, 3),
+        "peak_rss_mb": round(_maxrss_to_bytes(rusage.ru_maxrss) / 2**20, 1),
+        "returncode": os.waitstatus_to_exitcode(status),
+    }
+
+
+class RunProfiler:
+    """
+    Records wall time, CPU time and peak RSS for named stages of a spacia run
+    and for each MCMC job, and writes them to a json run report.
+
+    Attributes:
+        output_path (str): Folder where the run report and profiles are saved
+        profile (bool): Whether to dump a cProfile of each stage
+        stages (List[dict]): Records of the finished stages
+        jobs (List[dict]): Records of the MCMC jobs
+    """
+
+    def __init__(self, output_path: str, profile: bool = False):
+        self.output_path = output_path
+        self.profile = profile
+        self.stages = []
+        self.jobs = []
+        self.start_time = time.strftime("%Y-%m-%d %H:%M:%S")
+        self._t0 = time.perf_counter()
+        self._c0 = time.process_time()
+        self._current = None
+
+    def start_stage(self, name: str):
+        """Start timing a stage, ending the current one if any."""
+        if self._current is not None:
+            self.end_stage()
+        self._current = {
+            "name": name,
+            "t0": time.perf_counter(),
+            "c0": time.process_time(),
+            "rss_reset": reset_peak_rss(),
+            "profiler": cProfile.Profile() if self.profile else None,
+        }
+        if self._current["profiler"] is not None:
+            self._current["profiler"].enable()
+
+    def end_stage(self) -> Optional[dict]:
+        """Stop timing the current stage and record it."""
+        cur = self._current
+        if cur is None:
+            return None
+        self._current = None
+        if cur["profiler"] is not None:
+            cur["profiler"].disable()
+            profile_path = os.path.join(self.output_path, "profiles")
+            if not os.path.exists(profile_path):
+                os.makedirs(profile_path)
+            cur["profiler"].dump_stats(
+                os.path.join(profile_path, cur["name"] + ".prof"))
+        record = {
+            "stage": cur["name"],
+            "wall_s": round(time.perf_counter() - cur["t0"], 3),
+            "cpu_s": round(time.process_time() - cur["c0"], 3),
+            "peak_rss_mb": round(get_peak_rss() / 2**20, 1),
+            # peak rss is for the whole process if it can not be reset
+            "peak_rss_scope": "stage" if cur["rss_reset"] else "process",
+        }
+        self.stages.append(record)
+        print(
+            "Stage {stage} finished in {wall_s:.1f}s (CPU {cpu_s:.1f}s), "
+            "peak RSS {peak_rss_mb:.0f}MB".format(**record)
+        )
+        return record
+
+    @contextmanager
+    def stage(self, name: str):
+        """Context manager timing the enclosed block as a stage."""
+        self.start_stage(name)
+        try:
+            yield self
+        finally:
+            self.end_stage()
+
+    def add_jobs(self, job_ids: List[str], job_records: List[dict]):
+        """Record the resource usage of MCMC jobs, see run_timed_command."""
+        for job_id, record in zip(job_ids, job_records):
+            record = dict(record)
+            record["job_id"] = job_id
+            self.jobs.append(record)
+
+    def write_report(self, fn: str = "run_report.json", **extra) -> str:
+        """
+        Write the run report as json to the output path.
+
+        Extra keyword arguments are saved as additional report entries.
+        """
+        self.end_stage()
+        report = {
+            "command": " ".join(sys.argv),
+            "start_time": self.start_time,
+            "total": {
+                "wall_s": round(time.perf_counter() - self._t0, 3),
+                "cpu_s": round(time.process_time() - self._c0, 3),
+                "peak_rss_mb": round(_maxrss_to_bytes(
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 2**20, 1),
+            },
+            "stages": self.stages,
+            "jobs": self.jobs,
+        }
+        report.update(extra)
+        report_fn = os.path.join(self.output_path, fn)
+        with open(report_fn, "w") as f:
+            json.dump(report, f, indent=2)
+        return report_fn
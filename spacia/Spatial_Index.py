@@ -0,0 +1,524 @@
+# Standard library imports
+import os
+import time
+import tempfile
+from dataclasses import dataclass
+from multiprocessing import Pool
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+# Third-party library imports
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+
+def _offsets(sizes: np.ndarray) -> np.ndarray:
+    """CSR row offsets of rows of the given sizes."""
+    return np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(sizes, dtype=np.int64)])
+
+
+def _ball_neighbors(
+    s_tree: cKDTree, s_xy: np.ndarray, r_xy: np.ndarray, radius: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Senders within radius of each receiver as CSR arrays: row offsets,
+    sender positions sorted within each row, and distances.
+    """
+    if (len(r_xy) == 0) | (len(s_xy) == 0):
+        return _offsets(np.zeros(len(r_xy), dtype=np.int64)), np.zeros(0, dtype=np.int64), np.zeros(0)
+    neighbors = s_tree.query_ball_point(r_xy, radius)
+    sizes = np.array([len(x) for x in neighbors], dtype=np.int64)
+    indptr = _offsets(sizes)
+    indices = np.fromiter(
+        (i for x in neighbors for i in sorted(x)), dtype=np.int64, count=indptr[-1])
+    rows = np.repeat(np.arange(len(r_xy)), sizes)
+    distances = np.sqrt(((r_xy[rows] - s_xy[indices]) ** 2).sum(axis=1))
+    return indptr, indices, distances
+
+
+@dataclass
+class ProximityGraph:
+    """
+    Sparse receiver to sender proximity graph in CSR form. Row i holds the
+    senders within the radius of receivers[i], as positions into senders,
+    with their distances.
+
+    This is also the container of the bags of spacia.py, where a bag is the
+    row of senders of a receiver. Bags are filtered, subsampled and gathered
+    with array operations on the offsets instead of lists of cell ids. The
+    cell ids of spacia.py are integer cell codes, see relabel.
+
+    Attributes:
+        receivers (np.ndarray): Receiver cell ids or codes, one per row
+        senders (np.ndarray): Sender cell ids or codes, one per column
+        indptr (np.ndarray): Row offsets into indices and distances
+        indices (np.ndarray): Sender positions of each edge
+        distances (np.ndarray): Receiver to sender distance of each edge
+    """
+    receivers: np.ndarray
+    senders: np.ndarray
+    indptr: np.ndarray
+    indices: np.ndarray
+    distances: np.ndarray
+
+    @property
+    def n_edges(self) -> int:
+        return int(self.indptr[-1])
+
+    def bag_sizes(self) -> np.ndarray:
+        """Number of senders of each receiver."""
+        return np.diff(self.indptr)
+
+    def to_csr(self) -> sparse.csr_matrix:
+        """Receivers x senders sparse matrix of the distances."""
+        return sparse.csr_matrix(
+            (self.distances, self.indices, self.indptr),
+            shape=(len(self.receivers), len(self.senders)))
+
+    def to_dict(self) -> Dict[Hashable, list]:
+        """Receiver -> list of sender ids, the proximity_dict of Workflow_Helpers."""
+        return self.to_series().to_dict()
+
+    def to_series(self) -> pd.Series:
+        """Series of lists of sender ids indexed by receiver, like r2s_matrix in spacia.py."""
+        bags = np.split(self.senders[self.indices], self.indptr[1:-1])
+        return pd.Series(
+            [x.tolist() for x in bags], index=pd.Index(self.receivers), dtype=object)
+
+    def distance_series(self) -> pd.Series:
+        """Series of arrays of the distances to the senders, indexed by receiver."""
+        return pd.Series(
+            np.split(self.distances, self.indptr[1:-1]),
+            index=pd.Index(self.receivers), dtype=object)
+
+    def __len__(self) -> int:
+        return len(self.receivers)
+
+    def take(self, rows: np.ndarray) -> "ProximityGraph":
+        """Graph of the given rows (receiver positions), in that order."""
+        rows = np.asarray(rows, dtype=np.int64)
+        sizes = self.bag_sizes()[rows]
+        indptr = _offsets(sizes)
+        # position of each kept edge in the edges of this graph
+        edges = np.repeat(self.indptr[rows] - indptr[:-1], sizes) + np.arange(indptr[-1])
+        return ProximityGraph(
+            self.receivers[rows], self.senders, indptr,
+            self.indices[edges], self.distances[edges])
+
+    def filter_bags(self, min_size: int = 1) -> "ProximityGraph":
+        """Keep the receivers with at least min_size senders."""
+        return self.take(np.flatnonzero(self.bag_sizes() >= min_size))
+
+    def drop_empty(self) -> "ProximityGraph":
+        """Remove the receivers without senders."""
+        return self.filter_bags(1)
+
+    def subsample(self, n: int) -> "ProximityGraph":
+        """
+        Random subset of n receivers without replacement, drawn from the
+        numpy global random state like pd.Series.sample.
+        """
+        return self.take(np.random.choice(len(self), n, replace=False))
+
+    def unique_senders(self) -> np.ndarray:
+        """Ids of the senders in at least one bag, in the order of senders."""
+        return self.senders[np.unique(self.indices)]
+
+    def gather(self, values: np.ndarray) -> List[np.ndarray]:
+        """
+        Split values of the senders (aligned with senders, first axis) into
+        the values of each bag.
+        """
+        return np.split(np.asarray(values)[self.indices], self.indptr[1:-1])
+
+    def relabel(self, ids: np.ndarray) -> "ProximityGraph":
+        """Same graph with integer cell codes replaced by ids[code]."""
+        ids = np.asarray(ids)
+        return ProximityGraph(
+            ids[self.receivers], ids[self.senders], self.indptr, self.indices,
+            self.distances)
+
+    def join_senders(self, sep: str = ",") -> List[str]:
+        """Sender ids of each bag joined into one string."""
+        return [sep.join(x) for x in self.gather(self.senders.astype(str))]
+
+    @classmethod
+    def concat(cls, graphs: Sequence["ProximityGraph"]) -> "ProximityGraph":
+        """Stack the rows of graphs with different senders."""
+        graphs = list(graphs)
+        if len(graphs) == 0:
+            return cls(
+                np.zeros(0, dtype=object), np.zeros(0, dtype=object),
+                _offsets(np.zeros(0, dtype=np.int64)), np.zeros(0, dtype=np.int64),
+                np.zeros(0))
+        s_offsets = _offsets([len(x.senders) for x in graphs])
+        return cls(
+            np.concatenate([x.receivers for x in graphs]),
+            np.concatenate([x.senders for x in graphs]),
+            _offsets(np.concatenate([x.bag_sizes() for x in graphs])),
+            np.concatenate([x.indices + o for x, o in zip(graphs, s_offsets)]),
+            np.concatenate([x.distances for x in graphs]))
+
+    @classmethod
+    def from_series(cls, bags: pd.Series, locations: pd.DataFrame) -> "ProximityGraph":
+        """
+        Graph of a Series of lists of sender ids indexed by receiver, such as
+        r2s_matrix in spacia.py, with the distances from the X, Y locations.
+        """
+        sizes = bags.apply(len).values.astype(np.int64)
+        edges = np.array([x for bag in bags for x in bag], dtype=object)
+        codes, senders = pd.factorize(edges)
+        positions = pd.Series(np.arange(locations.shape[0]), index=locations.index)
+        xy = locations.iloc[:, :2].values.astype(float)
+        r_xy = np.repeat(xy[positions.loc[bags.index].values], sizes, axis=0)
+        s_xy = xy[positions.loc[senders].values]
+        return cls(
+            bags.index.values.astype(object), np.asarray(senders, dtype=object),
+            _offsets(sizes), codes.astype(np.int64),
+            np.sqrt(((r_xy - s_xy[codes]) ** 2).sum(axis=1)))
+
+    def save(self, fn: str):
+        """Save the graph as npz, cell ids are saved as strings."""
+        np.savez_compressed(
+            fn, receivers=self.receivers.astype(str), senders=self.senders.astype(str),
+            indptr=self.indptr, indices=self.indices, distances=self.distances)
+
+    @classmethod
+    def load(cls, fn: str) -> "ProximityGraph":
+        """Load a graph saved by save."""
+        with np.load(fn) as data:
+            return cls(
+                data["receivers"].astype(object), data["senders"].astype(object),
+                data["indptr"], data["indices"], data["distances"])
+
+
+class SpatialIndex:
+    """
+    KD-tree index of cell locations, shared by all receiver/sender pairs of a
+    run so that the bags of each pair are found without pairwise distance
+    matrices. Trees are built once per group of sender cells and cached.
+
+    Attributes:
+        locations (pd.DataFrame): X, Y locations of all cells
+        xy (np.ndarray): X, Y locations as an n x 2 array
+        positions (Optional[pd.Series]): Row of each cell id, None if the
+            cells are integer codes
+        trees (Dict[Hashable, tuple]): Cached KD-tree and cell ids of each
+            sender group
+    """
+
+    def __init__(self, locations: pd.DataFrame):
+        self.locations = locations.loc[:, ["X", "Y"]]
+        self.xy = self.locations.values
+        # integer cell codes of load_data are the row positions, other cell
+        # ids are mapped to their positions
+        self.positions = None
+        if not self.locations.index.equals(pd.RangeIndex(self.locations.shape[0])):
+            self.positions = pd.Series(
+                np.arange(self.locations.shape[0]), index=self.locations.index)
+        self.trees = {}
+
+    def coords(self, cells: Sequence) -> np.ndarray:
+        """Coordinates of cells as an n x 2 array."""
+        if self.positions is None:
+            return self.xy[np.asarray(cells, dtype=np.int64)]
+        return self.xy[self.positions.loc[cells].values]
+
+    def tree(self, cells: Sequence, key: Optional[Hashable] = None):
+        """
+        KD-tree of a group of cells, cached under key (e.g. the cell type).
+        Without a key, the tree is built and not cached.
+        """
+        if (key is not None) and (key in self.trees):
+            return self.trees[key]
+        cells = pd.Index(cells)
+        res = (cKDTree(self.coords(cells)), cells)
+        if key is not None:
+            self.trees[key] = res
+        return res
+
+    def proximity_graph(
+        self,
+        r_cells: Sequence,
+        s_cells: Sequence,
+        radius: float,
+        key: Optional[Hashable] = None,
+    ) -> ProximityGraph:
+        """
+        Proximity graph of the senders within radius of each receiver, with
+        one row per receiver in the order of r_cells.
+
+        Parameters:
+        r_cells, s_cells (Sequence): Receiver and sender cell ids
+        radius (float): Maximal receiver to sender distance
+        key (Hashable): Cache key of the sender tree, e.g. the sender type
+        """
+        s_tree, s_cells = self.tree(s_cells, key)
+        r_xy = self.coords(r_cells)
+        indptr, indices, distances = _ball_neighbors(
+            s_tree, s_tree.data, r_xy, radius)
+        return ProximityGraph(
+            np.asarray(r_cells), s_cells.values, indptr, indices, distances)
+
+    def find_sender_candidates(
+        self,
+        r_cells: Sequence,
+        s_cells: Sequence,
+        dist_cutoff: float = 30,
+        key: Optional[Hashable] = None,
+    ) -> pd.Series:
+        """
+        Sender cells within dist_cutoff of each receiver cell, same output as
+        find_sender_candidates in spacia.py: a series of lists of sender ids
+        in the order of s_cells, indexed by the receivers with any sender.
+
+        Parameters:
+        r_cells, s_cells (Sequence): Receiver and sender cell ids
+        dist_cutoff (float): Maximal receiver to sender distance
+        key (Hashable): Cache key of the sender tree, e.g. the sender type
+        """
+        graph = self.proximity_graph(r_cells, s_cells, dist_cutoff, key)
+        return graph.drop_empty().to_series()
+
+
+def build_proximity_graph(
+    cell_metadata: pd.DataFrame,
+    receiver_type: str,
+    sender_type: str,
+    radius: float,
+    cell_type_column: str = "cell_type",
+    drop_empty: bool = True,
+    save_path: Optional[str] = None,
+) -> ProximityGraph:
+    """
+    Build the receiver to sender proximity graph of two cell types with a
+    KD-tree. The graph gives the proximity_dict of
+    calculate_weighted_activation_scores with to_dict, or a sparse matrix of
+    distances with to_csr.
+
+    Parameters:
+    cell_metadata (pd.DataFrame): Cell metadata with X, Y and cell type
+    receiver_type (str): Cell type of the receiver cells
+    sender_type (str): Cell type of the sender cells
+    radius (float): Maximal receiver to sender distance
+    cell_type_column (str): Column of the cell types
+    drop_empty (bool): Remove receivers without senders
+    save_path (str): Optional npz file to save the graph to, reload it with
+        ProximityGraph.load
+
+    Returns:
+    ProximityGraph: the proximity graph
+    """
+    cell_types = cell_metadata[cell_type_column]
+    index = SpatialIndex(cell_metadata)
+    graph = index.proximity_graph(
+        cell_metadata.index[cell_types == receiver_type],
+        cell_metadata.index[cell_types == sender_type],
+        radius,
+    )
+    if drop_empty:
+        graph = graph.drop_empty()
+    if save_path is not None:
+        graph.save(save_path)
+    return graph
+
+
+def _find_slide_bags(task: tuple) -> Tuple[ProximityGraph, dict]:
+    """
+    Worker of find_sender_candidates_by_sample, finds the bags of one slide
+    with its own KD-tree.
+    """
+    slide, r_ids, r_xy, s_ids, s_xy, dist_cutoff = task
+    t0 = time.perf_counter()
+    s_tree = cKDTree(s_xy) if len(s_ids) > 0 else None
+    graph = ProximityGraph(
+        r_ids, s_ids, *_ball_neighbors(s_tree, s_xy, r_xy, dist_cutoff)).drop_empty()
+    stats = {
+        "sample": slide,
+        "n_receivers": len(r_ids),
+        "n_senders": len(s_ids),
+        "n_bags": len(graph),
+        "mean_bag_size": round(float(graph.bag_sizes().mean()), 3) if len(graph) > 0 else 0,
+        "wall_s": round(time.perf_counter() - t0, 3),
+    }
+    return graph, stats
+
+
+def find_sender_candidates_by_sample(
+    locations: pd.DataFrame,
+    samples: pd.Series,
+    r_cells: Sequence,
+    s_cells: Sequence,
+    dist_cutoff: float = 30,
+    n_workers: int = 16,
+) -> Tuple[ProximityGraph, List[dict]]:
+    """
+    Find the bags of sender cells of each receiver cell separately in each
+    slide, so that cells of different slides are never neighbors even if
+    their coordinates overlap. Slides are processed in parallel workers and
+    the bags are pooled in the order of r_cells.
+
+    Parameters:
+    locations (pd.DataFrame): X, Y locations of all cells
+    samples (pd.Series): Slide of each cell
+    r_cells, s_cells (Sequence): Receiver and sender cell ids
+    dist_cutoff (float): Maximal receiver to sender distance
+    n_workers (int): Maximal number of parallel workers
+
+    Returns:
+    Tuple[ProximityGraph, List[dict]]: the non-empty bags, and the neighbor
+        search statistics of each slide
+    """
+    r_cells, s_cells = pd.Index(r_cells), pd.Index(s_cells)
+    r_samples = samples.loc[r_cells]
+    s_samples = samples.loc[s_cells]
+    tasks = []
+    for slide in pd.unique(samples.loc[r_cells.append(s_cells)]):
+        r_ids = r_cells[(r_samples == slide).values]
+        s_ids = s_cells[(s_samples == slide).values]
+        tasks.append((
+            slide,
+            r_ids.values,
+            locations.loc[r_ids, ["X", "Y"]].values,
+            s_ids.values,
+            locations.loc[s_ids, ["X", "Y"]].values,
+            dist_cutoff,
+        ))
+    n_workers = max(1, min(n_workers, len(tasks)))
+    if n_workers > 1:
+        with Pool(n_workers) as p:
+            res = p.map(_find_slide_bags, tasks)
+    else:
+        res = [_find_slide_bags(x) for x in tasks]
+    graph = ProximityGraph.concat([x[0] for x in res])
+    graph = graph.take(np.argsort(r_cells.get_indexer(graph.receivers), kind="stable"))
+    return graph, [x[1] for x in res]
+
+
+def _find_tile_bags(task: tuple) -> dict:
+    """
+    Worker of find_sender_candidates_tiled. Reads the receivers and the
+    halo of senders of one tile from disk, and writes the bags and the
+    receiver to sender distances back to disk.
+    """
+    tile, tile_fn, result_fn, dist_cutoff, _ = task
+    t0 = time.perf_counter()
+    with np.load(tile_fn) as data:
+        r_pos, r_xy = data["r_pos"], data["r_xy"]
+        s_pos, s_xy = data["s_pos"], data["s_xy"]
+    s_tree = cKDTree(s_xy) if len(s_pos) > 0 else None
+    # senders are in the order of s_cells within each tile
+    indptr, s_local, dists = _ball_neighbors(s_tree, s_xy, r_xy, dist_cutoff)
+    sizes = np.diff(indptr)
+    keep = sizes > 0
+    np.savez(
+        result_fn,
+        r_pos=r_pos[keep], sizes=sizes[keep], s_pos=s_pos[s_local], dists=dists)
+    return {
+        "tile": tile,
+        "n_receivers": len(r_pos),
+        "n_senders": len(s_pos),
+        "n_bags": int(keep.sum()),
+        "wall_s": round(time.perf_counter() - t0, 3),
+    }
+
+
+def find_sender_candidates_tiled(
+    locations: pd.DataFrame,
+    r_cells: Sequence,
+    s_cells: Sequence,
+    dist_cutoff: float,
+    tile_size: float,
+    samples: Optional[pd.Series] = None,
+    n_workers: int = 16,
+    tmp_dir: Optional[str] = None,
+) -> Tuple[ProximityGraph, List[dict]]:
+    """
+    Find the bags of sender cells of each receiver cell in square spatial
+    tiles, for sections too large to search at once.
+
+    Each receiver belongs to exactly one tile, and each tile also holds the
+    senders within dist_cutoff of its border (the halo), so merging the
+    bags of all tiles gives every bag once and exactly as without tiles.
+    The inputs and results of the tiles are kept on disk and only one tile
+    is loaded per worker. With samples, tiles never span two slides.
+
+    Parameters:
+    locations (pd.DataFrame): X, Y locations of all cells
+    r_cells, s_cells (Sequence): Receiver and sender cell ids
+    dist_cutoff (float): Maximal receiver to sender distance
+    tile_size (float): Side of the tiles, at least dist_cutoff
+    samples (pd.Series): Slide of each cell
+    n_workers (int): Maximal number of parallel workers
+    tmp_dir (str): Folder for the temporary tile files
+
+    Returns:
+    Tuple[ProximityGraph, List[dict]]: the non-empty bags, in the order of
+        r_cells, and the statistics of each tile
+    """
+    r_cells, s_cells = pd.Index(r_cells), pd.Index(s_cells)
+    tile_size = max(tile_size, dist_cutoff)
+    r_xy = locations.loc[r_cells, ["X", "Y"]].values.astype(float)
+    s_xy = locations.loc[s_cells, ["X", "Y"]].values.astype(float)
+    origin = np.vstack([r_xy, s_xy]).min(axis=0)
+    r_tiles = pd.DataFrame(
+        np.floor((r_xy - origin) / tile_size).astype(int), columns=["ix", "iy"])
+    s_tiles = pd.DataFrame(
+        np.floor((s_xy - origin) / tile_size).astype(int), columns=["ix", "iy"])
+    keys = ["ix", "iy"]
+    if samples is not None:
+        r_tiles["sample"] = samples.loc[r_cells].values
+        s_tiles["sample"] = samples.loc[s_cells].values
+        keys = ["sample"] + keys
+    s_groups = s_tiles.groupby(keys).indices
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tile_path:
+        tasks = []
+        for i, (tile, r_idx) in enumerate(r_tiles.groupby(keys).indices.items()):
+            ix, iy = tile[-2:]
+            # senders of the 3 x 3 neighboring tiles, limited to the halo
+            s_idx = [
+                s_groups.get(tile[:-2] + (ix + dx, iy + dy), np.zeros(0, dtype=int))
+                for dx in [-1, 0, 1] for dy in [-1, 0, 1]
+            ]
+            s_idx = np.sort(np.concatenate(s_idx).astype(int))
+            lo = origin + np.array([ix, iy]) * tile_size - dist_cutoff
+            hi = lo + tile_size + 2 * dist_cutoff
+            in_halo = ((s_xy[s_idx] >= lo) & (s_xy[s_idx] <= hi)).all(axis=1)
+            s_idx = s_idx[in_halo]
+            tile_fn = os.path.join(tile_path, "tile_{}.npz".format(i))
+            np.savez(
+                tile_fn, r_pos=r_idx, r_xy=r_xy[r_idx], s_pos=s_idx, s_xy=s_xy[s_idx])
+            tasks.append((
+                "_".join([str(x) for x in tile]), tile_fn,
+                os.path.join(tile_path, "bags_{}.npz".format(i)), dist_cutoff,
+                tile[0],
+            ))
+        n_workers = max(1, min(n_workers, len(tasks)))
+        if n_workers > 1:
+            with Pool(n_workers) as p:
+                tiles = p.map(_find_tile_bags, tasks)
+        else:
+            tiles = [_find_tile_bags(x) for x in tasks]
+        if samples is not None:
+            for tile, task in zip(tiles, tasks):
+                tile["sample"] = task[-1]
+
+        # merge the bags of all tiles
+        r_pos, sizes, s_pos, dists = [], [], [], []
+        for task in tasks:
+            with np.load(task[2]) as data:
+                r_pos.append(data["r_pos"])
+                sizes.append(data["sizes"])
+                s_pos.append(data["s_pos"])
+                dists.append(data["dists"])
+    r_pos = np.concatenate(r_pos).astype(np.int64)
+    graph = ProximityGraph(
+        r_cells.values[r_pos], s_cells.values,
+        _offsets(np.concatenate(sizes)), np.concatenate(s_pos).astype(np.int64),
+        np.concatenate(dists))
+    order = np.argsort(r_pos, kind="stable")
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = r_pos[order][1:] != r_pos[order][:-1]
+    return graph.take(order[first]), tiles
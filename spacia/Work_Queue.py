@@ -0,0 +1,453 @@
+"""
+Work queue of spacia_job.R jobs on a shared filesystem, so that the MCMC jobs
+of one spacia.py run are executed by worker processes on any number of nodes.
+
+Each run of the driver (spacia.py --work_queue) is a folder of the queue:
+
+    <queue_dir>/<run_id>/manifest.json       run info and list of jobs
+    <queue_dir>/<run_id>/jobs/<key>.json     command and attempt of each job
+    <queue_dir>/<run_id>/claims/<key>.<attempt>.json
+    <queue_dir>/<run_id>/heartbeats/<key>.<attempt>.json
+    <queue_dir>/<run_id>/done/<key>.<attempt>.json  completion marker and job record
+    <queue_dir>/<run_id>/closed              the run does not take jobs anymore
+
+Workers claim a job by creating its claim file exclusively (O_EXCL, atomic
+on local filesystems and NFSv3 or later), so that each attempt of a job runs
+on one worker only. While a job runs, its worker increments a counter in
+the heartbeat file. The driver watches the heartbeats with its own clock,
+so the clocks of the nodes do not need to agree, and reassigns the job to a
+new attempt when a heartbeat has not changed for dead_after seconds.
+
+Attempts are fenced: the worker of an attempt checks at each heartbeat that
+its attempt is still the current one of the job, and kills its command
+otherwise, e.g. after a pause or a network partition that outlasted
+dead_after. A superseded attempt writes no completion marker, and the
+driver only accepts the marker of the current attempt, so the results are
+always those of the last attempt.
+"""
+
+# Standard library imports
+import os
+import re
+import json
+import time
+import signal
+import socket
+import argparse
+import threading
+from typing import Callable, List, Optional, Tuple
+
+# Local imports
+from Run_Profiler import run_timed_command
+
+
+FAILED_RECORD = {"wall_s": None, "cpu_s": None, "peak_rss_mb": None, "returncode": None}
+
+
+def _write_json_atomic(fn: str, obj: dict):
+    """Write json to a temporary file and rename it, readers never see a partial file."""
+    tmp_fn = "{}.{}.{}.{}.tmp".format(
+        fn, socket.gethostname(), os.getpid(), threading.get_ident())
+    with open(tmp_fn, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_fn, fn)
+
+
+def _read_json(fn: str) -> Optional[dict]:
+    """Read a json file, None if it does not exist (yet) or is incomplete."""
+    try:
+        with open(fn) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _create_exclusive(fn: str, obj: dict) -> bool:
+    """Create a json file only if it does not exist, returns whether it was created."""
+    try:
+        fd = os.open(fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        json.dump(obj, f)
+    return True
+
+
+class QueuedJob:
+    """
+    Handle of a job submitted to a WorkQueue, with the ready/wait/get
+    interface of the AsyncResult of a multiprocessing pool.
+
+    Attributes:
+        key (str): File name of the job in the queue
+        job_id (str): Id of the job in the spacia run
+        attempt (int): Current attempt, increased when the job is reassigned
+        record (Optional[dict]): Job record of the worker once done
+    """
+
+    def __init__(
+        self, key: str, job_id: str,
+        callback: Optional[Callable] = None,
+    ):
+        self.key = key
+        self.job_id = job_id
+        self.callback = callback
+        self.attempt = 0
+        self.record = None
+        self.last_beat = None
+        self.last_seen = None
+        self._done = threading.Event()
+
+    def ready(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None):
+        self._done.wait(timeout)
+
+    def get(self, timeout: Optional[float] = None) -> dict:
+        if not self._done.wait(timeout):
+            raise TimeoutError("Job {} is not done.".format(self.job_id))
+        return self.record
+
+    def _finish(self, record: dict):
+        self.record = record
+        self._done.set()
+        if self.callback is not None:
+            self.callback(record)
+
+
+class WorkQueue:
+    """
+    Driver side of the work queue: publishes the jobs of one run to the
+    shared queue folder, and watches their claims, heartbeats and completion
+    markers in a background thread.
+
+    Use as a context manager; the run is closed on exit, after which
+    workers serving only this run stop.
+
+    Attributes:
+        queue_dir (str): Shared queue folder
+        run_id (str): Folder of this run in the queue
+        run_dir (str): Path of the run folder
+        dead_after (float): Seconds without heartbeat after which a claimed
+            job is reassigned
+        max_attempts (int): Attempts of a job before it is given up
+        poll_interval (float): Seconds between two checks of the markers
+        jobs (Dict[str, QueuedJob]): Submitted jobs by key
+    """
+
+    def __init__(
+        self,
+        queue_dir: str,
+        run_id: Optional[str] = None,
+        dead_after: float = 120,
+        max_attempts: int = 3,
+        poll_interval: float = 2,
+    ):
+        self.queue_dir = queue_dir
+        self.run_id = run_id or "{}_{}_{}".format(
+            time.strftime("%Y%m%d-%H%M%S"), socket.gethostname(), os.getpid())
+        self.run_dir = os.path.join(queue_dir, self.run_id)
+        self.dead_after = dead_after
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        for folder in ["jobs", "claims", "heartbeats", "done"]:
+            os.makedirs(os.path.join(self.run_dir, folder), exist_ok=True)
+        self.manifest = {
+            "run_id": self.run_id,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "cwd": os.getcwd(),
+            "jobs": [],
+        }
+        _write_json_atomic(os.path.join(self.run_dir, "manifest.json"), self.manifest)
+
+    def _path(self, folder: str, fn: str) -> str:
+        return os.path.join(self.run_dir, folder, fn)
+
+    def submit(
+        self, job_id: str, cmd: str,
+        callback: Optional[Callable] = None,
+    ) -> QueuedJob:
+        """
+        Publish a shell command to the queue. callback is called with the
+        job record from the watcher thread when the job is done.
+        """
+        with self._lock:
+            key = "{:05d}_{}".format(len(self.jobs), re.sub(r"[^\w.-]", "_", job_id))
+            job = QueuedJob(key, job_id, callback)
+            _write_json_atomic(self._path("jobs", key + ".json"), {
+                "key": key, "job_id": job_id, "cmd": cmd,
+                "cwd": self.manifest["cwd"], "attempt": 0,
+            })
+            self.manifest["jobs"].append({"key": key, "job_id": job_id})
+            _write_json_atomic(os.path.join(self.run_dir, "manifest.json"), self.manifest)
+            self.jobs[key] = job
+        return job
+
+    def _reassign(self, job: QueuedJob, reason: str):
+        """Give the job a new attempt, or give it up after max_attempts."""
+        job.attempt += 1
+        job.last_beat, job.last_seen = None, None
+        if job.attempt >= self.max_attempts:
+            print("Job {} is given up after {} attempts: {}".format(
+                job.job_id, job.attempt, reason))
+            record = dict(FAILED_RECORD, error=reason, attempts=job.attempt)
+            _create_exclusive(
+                self._path("done", "{}.{}.json".format(job.key, job.attempt)),
+                {"record": record})
+            job._finish(record)
+            return
+        print("Job {} is reassigned (attempt {}): {}".format(
+            job.job_id, job.attempt + 1, reason))
+        fn = self._path("jobs", job.key + ".json")
+        job_info = _read_json(fn)
+        job_info["attempt"] = job.attempt
+        _write_json_atomic(fn, job_info)
+
+    def check(self):
+        """Check the markers of all jobs that are not done yet, once."""
+        with self._lock:
+            pending = [x for x in self.jobs.values() if not x.ready()]
+        now = time.time()
+        for job in pending:
+            name = "{}.{}.json".format(job.key, job.attempt)
+            # markers of superseded attempts are ignored
+            done = _read_json(self._path("done", name))
+            if done is not None:
+                record = dict(done["record"])
+                for k in ["worker", "attempt"]:
+                    if k in done:
+                        record[k] = done[k]
+                job._finish(record)
+                continue
+            claim = _read_json(self._path("claims", name))
+            if claim is None:
+                continue
+            heartbeat = _read_json(self._path("heartbeats", name)) or {}
+            beat = heartbeat.get("beat", -1)
+            if beat != job.last_beat:
+                job.last_beat, job.last_seen = beat, now
+            elif now - job.last_seen > self.dead_after:
+                self._reassign(job, "no heartbeat from worker {} for {:.0f}s".format(
+                    claim.get("worker"), self.dead_after))
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            self.check()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop watching and close the run for the workers."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with open(os.path.join(self.run_dir, "closed"), "w") as f:
+            f.write(time.strftime("%Y-%m-%d %H:%M:%S"))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class QueueWorker:
+    """
+    Worker side of the work queue: claims jobs of the open runs of a queue
+    folder and executes them, with n_slots jobs at a time.
+
+    Attributes:
+        queue_dir (str): Shared queue folder
+        n_slots (int): Number of jobs run at the same time
+        run_id (Optional[str]): Only serve this run, and stop once it is closed
+        heartbeat_interval (float): Seconds between two heartbeats of a job
+        poll_interval (float): Seconds between two looks for new jobs
+        idle_exit (Optional[float]): Stop after this many seconds without jobs
+        worker_id (str): Name of the worker in claims and markers
+    """
+
+    def __init__(
+        self,
+        queue_dir: str,
+        n_slots: int = 1,
+        run_id: Optional[str] = None,
+        heartbeat_interval: float = 10,
+        poll_interval: float = 2,
+        idle_exit: Optional[float] = None,
+        worker_id: Optional[str] = None,
+    ):
+        self.queue_dir = queue_dir
+        self.n_slots = n_slots
+        self.run_id = run_id
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.idle_exit = idle_exit
+        self.worker_id = worker_id or "{}:{}".format(socket.gethostname(), os.getpid())
+
+    def open_runs(self) -> List[str]:
+        """Run folders that take jobs, oldest first."""
+        if self.run_id is not None:
+            runs = [self.run_id]
+        else:
+            runs = sorted(os.listdir(self.queue_dir)) if os.path.isdir(self.queue_dir) else []
+        return [
+            os.path.join(self.queue_dir, x) for x in runs
+            if os.path.exists(os.path.join(self.queue_dir, x, "manifest.json"))
+            and not os.path.exists(os.path.join(self.queue_dir, x, "closed"))
+        ]
+
+    def stopped(self) -> bool:
+        """Whether the worker should stop: a 'stop' file in the queue, or its run is closed."""
+        if os.path.exists(os.path.join(self.queue_dir, "stop")):
+            return True
+        return (self.run_id is not None) and os.path.exists(
+            os.path.join(self.queue_dir, self.run_id, "closed"))
+
+    def claim(self) -> Optional[Tuple[str, dict]]:
+        """Claim the first job that is not done or claimed in its current attempt."""
+        for run_dir in self.open_runs():
+            for fn in sorted(os.listdir(os.path.join(run_dir, "jobs"))):
+                if not fn.endswith(".json"):
+                    continue
+                key = fn[:-len(".json")]
+                job = _read_json(os.path.join(run_dir, "jobs", fn))
+                if job is None:
+                    continue
+                name = "{}.{}.json".format(key, job["attempt"])
+                if os.path.exists(os.path.join(run_dir, "done", name)):
+                    continue
+                if _create_exclusive(os.path.join(run_dir, "claims", name), {
+                    "worker": self.worker_id, "claimed": time.strftime("%Y-%m-%d %H:%M:%S"),
+                }):
+                    return run_dir, job
+        return None
+
+    def superseded(self, run_dir: str, job: dict) -> bool:
+        """Whether the job was reassigned to a later attempt than job's."""
+        current = _read_json(os.path.join(run_dir, "jobs", job["key"] + ".json"))
+        return (current is not None) and (current["attempt"] != job["attempt"])
+
+    def run_job(self, run_dir: str, job: dict) -> Optional[dict]:
+        """
+        Run a claimed job, beating its heartbeat until it finishes. The
+        command is killed if the attempt is superseded, and None is returned
+        without completion marker.
+        """
+        name = "{}.{}.json".format(job["key"], job["attempt"])
+        heartbeat_fn = os.path.join(run_dir, "heartbeats", name)
+        finished = threading.Event()
+        superseded = threading.Event()
+        procs = []
+
+        def kill():
+            for proc in procs:
+                try:
+                    os.killpg(proc.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+        def started(proc):
+            # the attempt may be superseded before the command starts
+            procs.append(proc)
+            if superseded.is_set():
+                kill()
+
+        def beat():
+            n = 0
+            while True:
+                if self.superseded(run_dir, job):
+                    superseded.set()
+                    kill()
+                    return
+                _write_json_atomic(heartbeat_fn, {"worker": self.worker_id, "beat": n})
+                n += 1
+                if finished.wait(self.heartbeat_interval):
+                    return
+
+        heartbeat = threading.Thread(target=beat, daemon=True)
+        heartbeat.start()
+        print("[{}] running {}".format(self.worker_id, job["job_id"]), flush=True)
+        try:
+            record = run_timed_command(
+                job["cmd"], cwd=job.get("cwd"), started=started)
+        except OSError as e:
+            record = dict(FAILED_RECORD, error=str(e))
+        finished.set()
+        heartbeat.join()
+        if superseded.is_set() or self.superseded(run_dir, job):
+            print("[{}] {} attempt {} was superseded, its results are dropped".format(
+                self.worker_id, job["job_id"], job["attempt"]), flush=True)
+            return None
+        _create_exclusive(os.path.join(run_dir, "done", name), {
+            "worker": self.worker_id, "attempt": job["attempt"], "record": record,
+        })
+        return record
+
+    def _serve_slot(self):
+        idle_since = time.time()
+        while not self.stopped():
+            claimed = self.claim()
+            if claimed is None:
+                if (self.idle_exit is not None) and (time.time() - idle_since > self.idle_exit):
+                    return
+                time.sleep(self.poll_interval)
+                continue
+            self.run_job(*claimed)
+            idle_since = time.time()
+
+    def serve(self):
+        """Run jobs in n_slots threads until stopped."""
+        slots = [threading.Thread(target=self._serve_slot) for _ in range(self.n_slots)]
+        for slot in slots:
+            slot.start()
+        for slot in slots:
+            slot.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Worker running the spacia_job.R jobs of a shared work queue, \
+            see spacia.py --work_queue. Start any number of workers on any node \
+            that mounts the queue folder."
+    )
+    parser.add_argument("queue_dir", type=str, help="Shared work queue folder.")
+    parser.add_argument(
+        "--slots",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of jobs run at the same time by this worker.",
+    )
+    parser.add_argument(
+        "--run_id",
+        type=str,
+        default=None,
+        help="Only run jobs of this run, and stop when it is closed.",
+    )
+    parser.add_argument(
+        "--heartbeat_interval",
+        type=float,
+        default=10,
+        help="Seconds between two heartbeats of a running job.",
+    )
+    parser.add_argument(
+        "--idle_exit",
+        type=float,
+        default=None,
+        help="Stop after this many seconds without jobs. By default the worker \
+            runs until a 'stop' file is created in the queue folder.",
+    )
+    args = parser.parse_args()
+    QueueWorker(
+        args.queue_dir, args.slots, args.run_id, args.heartbeat_interval,
+        idle_exit=args.idle_exit,
+    ).serve()
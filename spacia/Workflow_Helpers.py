@@ -1,34 +1,65 @@
 # Standard library imports
 import os
+import hashlib
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from multiprocessing import Pool
+from typing import List, Optional, Tuple, Union
 
 # Third-party library imports
 import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
-from matplotlib.path import Path
-from scipy import stats
+from scipy import sparse, stats
+from scipy.signal import fftconvolve
 from scipy.stats import gaussian_kde
-from scipy.spatial import ConvexHull
-
-def process_spacia_data(receiving_cell: str, sending_cell: str, directory: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+from scipy.spatial import ConvexHull, cKDTree
+from scipy import ndimage
+
+# Local imports
+from Results_Catalog import ResultsCatalog
+from Spatial_Index import ProximityGraph
+
+def process_spacia_data(receiving_cell: str, 
+                        sending_cell: str, 
+                        directory: str,
+                        catalog: Optional[Union[str, ResultsCatalog]] = None,
+                        receiving_genes: Optional[List[str]] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     Process Spacia data files from a given directory, combining beta and pip files.
 
     This function walks through the specified directory, processes 'betas.csv' and 'pip.csv' files,
     and combines them into two separate DataFrames.
 
+    With a catalog, the files are loaded in parallel into a SQLite results catalog the first
+    time, and later calls only load new or changed files before querying the catalog.
+
     Parameters:
     receiving_cell (str): Identifier for the receiving cell type
     sending_cell (str): Identifier for the sending cell type
     directory (str): Path to the directory containing the data files
+    catalog (str or ResultsCatalog): Optional results catalog, or the path of its database file
+    receiving_genes (list): Only return these receiving genes, requires a catalog
 
     Returns:
     Tuple[pd.DataFrame, pd.DataFrame]: A tuple containing two DataFrames:
         - combined_betas: DataFrame with combined data from all 'betas.csv' files
         - combined_pip: DataFrame with combined data from all 'pip.csv' files
     """
+    if catalog is not None:
+        own_catalog = isinstance(catalog, str)
+        if own_catalog:
+            catalog = ResultsCatalog(catalog)
+        run = os.path.abspath(directory)
+        catalog.add_run(directory, receiving_cell, sending_cell, run)
+        combined_betas = catalog.query_betas(run=run, receiving_gene=receiving_genes)
+        combined_pip = catalog.query_pips(run=run, receiving_gene=receiving_genes)
+        if own_catalog:
+            catalog.close()
+        return combined_betas, combined_pip
+    elif receiving_genes is not None:
+        raise ValueError("receiving_genes requires a catalog")
+
     def read_csv_files(file_paths: List[str]) -> pd.DataFrame:
         """Read and combine multiple CSV files into a single DataFrame."""
         return pd.concat([pd.read_csv(file) for file in file_paths], ignore_index=True)
@@ -60,6 +91,9 @@ def process_spacia_data(receiving_cell: str, sending_cell: str, directory: str)
 
 # Example usage:
 # betas_df, pip_df = process_spacia_data("TumorCells", "EndothelialCells", "/path/to/data/directory")
+# With a results catalog, reused by later calls:
+# betas_df, pip_df = process_spacia_data("TumorCells", "EndothelialCells", "/path/to/data/directory",
+#                                        catalog="/path/to/spacia_results.sqlite")
 
 
 
@@ -67,12 +101,13 @@ def calculate_weighted_activation_scores(expression_data: pd.DataFrame,
                                          cell_metadata: pd.DataFrame, 
                                          beta_values: pd.DataFrame, 
                                          pi_scores: pd.DataFrame, 
-                                         proximity_dict: dict, 
+                                         proximity_dict: Union[dict, ProximityGraph], 
                                          receiver_type: str, 
                                          sender_type: str, 
                                          sending_genes: list, 
                                          receiving_genes: list,
-                                         score_name: str) -> pd.DataFrame:
+                                         score_name: str,
+                                         dtype: type = np.float64) -> pd.DataFrame:
     """
     Calculate weighted activation scores for cell-cell interactions based on gene expression,
     interaction strengths, and spatial proximity.
@@ -82,12 +117,15 @@ def calculate_weighted_activation_scores(expression_data: pd.DataFrame,
     cell_metadata (pd.DataFrame): Cell metadata including cell type
     beta_values (pd.DataFrame): Beta values for gene interactions
     pi_scores (pd.DataFrame): Primary instance scores
-    proximity_dict (dict): Dictionary of receiver cells and their nearby sender cells
+    proximity_dict (dict or ProximityGraph): Dictionary of receiver cells and their nearby sender cells,
+        or the graph returned by build_proximity_graph
     receiver_type (str): Cell type of the receiver cells
     sender_type (str): Cell type of the sender cells
     sending_genes (list): List of sending genes to consider
     receiving_genes (list): List of receiving genes to consider
     score_name (str): Name of the activation score
+    dtype (type): Float type of the expression and score products, np.float32
+        halves their memory, as spacia.py --float32
 
     Returns:
     pd.DataFrame: Final data with weighted activation scores for each receiver cell
@@ -95,23 +133,24 @@ def calculate_weighted_activation_scores(expression_data: pd.DataFrame,
 
     def calculate_activation_scores(proximity_dict: dict, 
                                     beta_filtered: pd.DataFrame, 
-                                    exp_data: pd.DataFrame) -> pd.DataFrame:
-        """Calculate activation scores for cells using the pre-computed proximity dictionary."""
-        activation_scores = []
-        unique_sender_cells = set(cell for cells in proximity_dict.values() for cell in cells)
-        
-        for sender_cell in unique_sender_cells:
-            cell_expression = exp_data.loc[sender_cell]
-            merged_data = beta_filtered.merge(cell_expression, left_on='sending_gene', right_index=True, how='left')
-            merged_data['expression'] = merged_data.iloc[:, -1]
-            merged_data['score'] = np.maximum(0, merged_data['avg_beta_sampled']) * merged_data['expression']
-            
-            activation_scores.append({
-                'sending_cell': sender_cell,
-                'activation_score': merged_data['score'].sum()
-            })
-        
-        return pd.DataFrame(activation_scores)
+                                    exp_data: pd.DataFrame) -> pd.Series:
+        """
+        Calculate activation scores for the sender cells in the pre-computed proximity dictionary,
+        as one product of the sender x gene expression matrix and the vector of positive betas.
+        """
+        unique_sender_cells = pd.unique(pd.Series(
+            [cell for cells in proximity_dict.values() for cell in cells], dtype=object))
+        # genes missing from the expression data do not contribute
+        gene_weights = np.maximum(0, beta_filtered['avg_beta_sampled']).groupby(
+            beta_filtered['sending_gene']).sum()
+        gene_weights = gene_weights[gene_weights.index.isin(exp_data.columns)]
+        sender_exp = exp_data.loc[unique_sender_cells, gene_weights.index].fillna(0)
+        return pd.Series(
+            sender_exp.values.astype(dtype, copy=False) @ gene_weights.values.astype(dtype),
+            index=unique_sender_cells)
+
+    if isinstance(proximity_dict, ProximityGraph):
+        proximity_dict = proximity_dict.to_dict()
 
     # Filter beta values
     beta_filtered = beta_values[
@@ -127,25 +166,35 @@ def calculate_weighted_activation_scores(expression_data: pd.DataFrame,
 
     # Summarize PI scores
     pi_summary = pi_scores.groupby(['receiving_cell', 'sending_cell'])['avg_primary_instance_score'].mean().reset_index()
-
-    # Merge activation scores with PI scores
-    merged_scores = pi_summary.merge(activation_scores, on='sending_cell', how='left')
-    merged_scores['weighted_score'] = merged_scores['avg_primary_instance_score'] * merged_scores['activation_score']
-
-    # Calculate final scores for each receiving cell
-    final_scores = []
-    for receiver, senders in proximity_dict.items():
-        cell_scores = merged_scores[
-            (merged_scores['receiving_cell'].astype(str) == str(receiver)) & 
-            (merged_scores['sending_cell'].isin([str(cell) for cell in senders]))
-        ]
-        if not cell_scores.empty:
-            final_scores.append({
-                'receiving_cell': receiver,
-                score_name: cell_scores['weighted_score'].sum()
-            })
-
-    final_scores_df = pd.DataFrame(final_scores)
+    pi_summary['receiver_key'] = pi_summary['receiving_cell'].astype(str)
+
+    # Receiver-sender pairs of the proximity dictionary, matched to the PI scores by cell id
+    receivers = list(proximity_dict.keys())
+    bag_sizes = [len(senders) for senders in proximity_dict.values()]
+    proximity_pairs = pd.DataFrame({
+        'receiver_pos': np.repeat(np.arange(len(receivers)), bag_sizes),
+        'receiver_key': np.repeat([str(cell) for cell in receivers], bag_sizes),
+        'sending_cell': [str(cell) for senders in proximity_dict.values() for cell in senders],
+    }).drop_duplicates(['receiver_pos', 'sending_cell'])
+    pairs = proximity_pairs.merge(pi_summary, on=['receiver_key', 'sending_cell'], how='inner')
+
+    # Sparse receiver x sender matrix of the PI scores, times the activation scores of the senders
+    sender_codes, sender_cells = pd.factorize(pairs['sending_cell'])
+    pi_matrix = sparse.csr_matrix(
+        (np.nan_to_num(pairs['avg_primary_instance_score'].values.astype(dtype)),
+         (pairs['receiver_pos'].values, sender_codes)),
+        shape=(len(receivers), len(sender_cells)),
+    )
+    sender_activation = np.nan_to_num(
+        activation_scores.reindex(sender_cells).values.astype(dtype))
+    receiver_scores = pi_matrix @ sender_activation
+
+    # Only receivers with at least one scored sender are kept
+    has_scores = np.bincount(pairs['receiver_pos'].values, minlength=len(receivers)) > 0
+    final_scores_df = pd.DataFrame({
+        'receiving_cell': pd.Series(receivers, dtype=object)[has_scores].values,
+        score_name: receiver_scores[has_scores],
+    })
 
     # Merge with receiver cell metadata
     receiver_cells = cell_metadata[cell_metadata['cell_type'] == receiver_type].reset_index()
@@ -157,12 +206,17 @@ def calculate_weighted_activation_scores(expression_data: pd.DataFrame,
     return final_data
 
 # Example usage:
+# from Spatial_Index import build_proximity_graph
+# proximity_graph = build_proximity_graph(
+#     cell_metadata, "Tumor Cells", "Endothelial Cells", radius=50,
+#     save_path="proximity_graph.npz"
+# )
 # result = calculate_weighted_activation_scores(
 #     expression_data=expression_data,
 #     cell_metadata=cell_metadata,
 #     beta_values=beta_values,
 #     pi_scores=pi_scores,
-#     proximity_dict=proximity_dict,
+#     proximity_dict=proximity_graph,
 #     receiver_type="Tumor Cells",
 #     sender_type="Endothelial Cells",
 #     sending_genes=["HGF", "WNT5A", "FGF2", "IL6", "CXCL8", "FGF1", "TGFB1", "TGFB2"],
@@ -172,6 +226,154 @@ def calculate_weighted_activation_scores(expression_data: pd.DataFrame,
 
 
 
+def binned_kde(kde: gaussian_kde, xi: np.ndarray, yi: np.ndarray) -> np.ndarray:
+    """
+    Evaluate a 2D gaussian_kde on a regular grid by linear binning and FFT convolution
+    
+    The data points are linearly binned onto the grid, extended by the kernel radius so that
+    points outside the grid still contribute, and convolved with the kernel of the KDE. The
+    bandwidth, covariance and weights are taken from kde, so bw_method has the same meaning
+    as for gaussian_kde. Cost is O(N + G log G) instead of O(N x G) for N points and G grid
+    points. The binning error grows as the kernel gets narrow relative to the grid spacing,
+    it is below 1% of the peak density for kernels wider than a few grid cells.
+    
+    Parameters:
+        kde: gaussian_kde of the data
+        xi, yi: Regular grid as created by np.mgrid, x varying along the first axis
+        
+    Returns:
+        density: KDE evaluated on the grid, same shape as xi
+    """
+    if xi.shape[0] < 2 or xi.shape[1] < 2:
+        raise ValueError("Grid must have at least 2 points per axis")
+    dx = xi[1, 0] - xi[0, 0]
+    dy = yi[0, 1] - yi[0, 0]
+    if (not np.allclose(xi, xi[:, :1])) or (not np.allclose(yi, yi[:1, :])) or \
+            (not np.allclose(np.diff(xi[:, 0]), dx)) or (not np.allclose(np.diff(yi[0]), dy)):
+        raise ValueError("The fft KDE requires a regular grid as created by np.mgrid")
+    
+    # Kernel on the grid offsets, truncated at 4 standard deviations
+    cov = kde.covariance
+    rx = int(np.ceil(4 * np.sqrt(cov[0, 0]) / dx))
+    ry = int(np.ceil(4 * np.sqrt(cov[1, 1]) / dy))
+    ox, oy = np.mgrid[-rx:rx + 1, -ry:ry + 1]
+    offsets = np.vstack([ox.ravel() * dx, oy.ravel() * dy])
+    inv_cov = np.linalg.inv(cov)
+    kernel = np.exp(-0.5 * np.sum(offsets * (inv_cov @ offsets), axis=0))
+    kernel = kernel.reshape(ox.shape) / (2 * np.pi * np.sqrt(np.linalg.det(cov)))
+    
+    # Linear binning onto the grid padded by the kernel radius
+    nx, ny = xi.shape[0] + 2 * rx, xi.shape[1] + 2 * ry
+    u = (kde.dataset[0] - xi[0, 0]) / dx + rx
+    v = (kde.dataset[1] - yi[0, 0]) / dy + ry
+    i, j = np.floor(u).astype(int), np.floor(v).astype(int)
+    fu, fv = u - i, v - j
+    binned = np.zeros(nx * ny)
+    for di, dj, w in [
+        (0, 0, (1 - fu) * (1 - fv)), (1, 0, fu * (1 - fv)),
+        (0, 1, (1 - fu) * fv), (1, 1, fu * fv),
+    ]:
+        keep = (i + di >= 0) & (i + di < nx) & (j + dj >= 0) & (j + dj < ny)
+        binned += np.bincount(
+            ((i + di) * ny + j + dj)[keep], weights=(kde.weights * w)[keep], minlength=nx * ny)
+    
+    density = fftconvolve(binned.reshape(nx, ny), kernel, mode='same')
+    return density[rx:rx + xi.shape[0], ry:ry + xi.shape[1]]
+
+# Tissue masks by (grid, coordinates, method, radius), shared by all scores on the same grid
+_MASK_CACHE = OrderedDict()
+_MASK_CACHE_SIZE = 32
+
+def clear_mask_cache():
+    """Remove all cached tissue masks"""
+    _MASK_CACHE.clear()
+
+def _scanline_hull_mask(coords: np.ndarray, xi: np.ndarray, yi: np.ndarray) -> np.ndarray:
+    """Fill the convex hull of coords on the grid, one y interval per grid column"""
+    hull_points = coords[ConvexHull(coords).vertices]
+    x1, y1 = hull_points[:, 0], hull_points[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    xs = xi[:, 0][:, None]
+    # y of every hull edge crossing each grid column
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y_cross = y1 + (xs - x1) * (y2 - y1) / (x2 - x1)
+    crosses = (xs >= np.minimum(x1, x2)) & (xs <= np.maximum(x1, x2)) & (x1 != x2)
+    lo = np.where(crosses, y_cross, np.inf).min(axis=1)
+    hi = np.where(crosses, y_cross, -np.inf).max(axis=1)
+    # vertical edges are covered by the crossings at their end points
+    eps = 1e-9 * max(np.ptp(coords[:, 1]), 1)
+    return (yi >= lo[:, None] - eps) & (yi <= hi[:, None] + eps)
+
+def _occupancy_mask(coords: np.ndarray, xi: np.ndarray, yi: np.ndarray,
+                    radius: Optional[float] = None) -> np.ndarray:
+    """
+    Grid points occupied by cells, closed with a disk of the given radius and with holes filled,
+    which follows concave tissue borders like an alpha shape
+    """
+    dx = xi[1, 0] - xi[0, 0]
+    dy = yi[0, 1] - yi[0, 0]
+    if radius is None:
+        # twice the median distance between neighboring cells
+        dist, _ = cKDTree(coords).query(coords, k=2)
+        radius = 2 * np.median(dist[:, 1])
+    rx, ry = max(int(np.ceil(radius / dx)), 1), max(int(np.ceil(radius / dy)), 1)
+    ox, oy = np.mgrid[-rx:rx + 1, -ry:ry + 1]
+    disk = (ox * dx) ** 2 + (oy * dy) ** 2 <= radius ** 2
+    
+    # nearest grid point of each cell, on a grid padded by the radius
+    i = np.rint((coords[:, 0] - xi[0, 0]) / dx).astype(int) + rx
+    j = np.rint((coords[:, 1] - yi[0, 0]) / dy).astype(int) + ry
+    occupied = np.zeros((xi.shape[0] + 2 * rx, xi.shape[1] + 2 * ry), dtype=bool)
+    keep = (i >= 0) & (i < occupied.shape[0]) & (j >= 0) & (j < occupied.shape[1])
+    occupied[i[keep], j[keep]] = True
+    
+    mask = ndimage.binary_dilation(occupied, structure=disk)
+    mask = ndimage.binary_fill_holes(mask)
+    mask = ndimage.binary_erosion(mask, structure=disk)
+    return mask[rx:rx + xi.shape[0], ry:ry + xi.shape[1]] | occupied[rx:rx + xi.shape[0], ry:ry + xi.shape[1]]
+
+def rasterize_mask(x_coords: np.ndarray, y_coords: np.ndarray, xi: np.ndarray, yi: np.ndarray,
+                   method: str = 'hull', radius: Optional[float] = None) -> np.ndarray:
+    """
+    Rasterize the tissue region of a set of cells onto a regular grid
+    
+    Masks are cached by grid, coordinates, method and radius, so scores that share a grid and
+    cells reuse one mask.
+    
+    Parameters:
+        x_coords, y_coords: Cell coordinates
+        xi, yi: Regular grid as created by np.mgrid
+        method: 'hull' fills the convex hull of the cells scanline by scanline, 'occupancy'
+            closes the grid points occupied by cells with a disk and fills holes, which
+            follows concave tissue
+        radius: Closing radius of the occupancy mask, twice the median distance between
+            neighboring cells by default
+        
+    Returns:
+        mask: Binary mask with the shape of the grid
+    """
+    if method not in ['hull', 'occupancy']:
+        raise ValueError("Method must be 'hull' or 'occupancy'")
+    coords = np.column_stack([x_coords, y_coords]).astype(float)
+    digest = hashlib.sha1()
+    for arr in [coords, np.asarray(xi, dtype=float), np.asarray(yi, dtype=float)]:
+        digest.update(str(arr.shape).encode())
+        digest.update(np.ascontiguousarray(arr).tobytes())
+    key = (digest.hexdigest(), method, radius)
+    if key in _MASK_CACHE:
+        _MASK_CACHE.move_to_end(key)
+        return _MASK_CACHE[key]
+    
+    if method == 'hull':
+        mask = _scanline_hull_mask(coords, xi, yi)
+    else:
+        mask = _occupancy_mask(coords, xi, yi, radius)
+    mask.setflags(write=False)
+    _MASK_CACHE[key] = mask
+    if len(_MASK_CACHE) > _MASK_CACHE_SIZE:
+        _MASK_CACHE.popitem(last=False)
+    return mask
+
 
 @dataclass 
 class SpatialScore:
@@ -181,15 +383,23 @@ class SpatialScore:
     Attributes:
         score_data (pd.DataFrame): DataFrame containing cell coordinates and scores
         score_name (str): Name of the score (e.g. "EMT", "Activation")
-        mask (Optional[np.ndarray]): Custom binary mask for the tissue area
+        mask (Optional[np.ndarray]): Custom binary mask for the tissue area, bool or 0/1
         xi (Optional[np.ndarray]): Optional x coordinates of the grid
         yi (Optional[np.ndarray]): Optional y coordinates of the grid
+        kde_method (str): 'exact' evaluates gaussian_kde at every grid point, 'fft' uses
+            linear binning and FFT convolution, see binned_kde
+        mask_method (str): 'hull' or 'occupancy' tissue mask when no mask is provided,
+            see rasterize_mask
+        mask_radius (Optional[float]): Closing radius of the occupancy mask
     """
     score_data: pd.DataFrame
     score_name: str
     mask: Optional[np.ndarray] = None
     xi: Optional[np.ndarray] = None
     yi: Optional[np.ndarray] = None
+    kde_method: str = 'exact'
+    mask_method: str = 'hull'
+    mask_radius: Optional[float] = None
     
     def __post_init__(self):
         self.x_coords = self.score_data['X'].values
@@ -214,14 +424,19 @@ class SpatialScore:
             self._xi = None
             self._yi = None
 
-    def compute_kde(self, bandwidth: float = 0.1, grid_size: int = 300):
+    def compute_kde(self, bandwidth: float = 0.1, grid_size: int = 300, method: Optional[str] = None):
         """
         Compute kernel density estimation
         
         Parameters:
             bandwidth: KDE bandwidth parameter
             grid_size: Size of the grid (used only if xi/yi not provided at init)
+            method: 'exact' or 'fft', defaults to kde_method
         """
+        method = method or self.kde_method
+        if method not in ['exact', 'fft']:
+            raise ValueError("Method must be 'exact' or 'fft'")
+        
         # Compute KDE
         self._kde = gaussian_kde(
             np.vstack([self.x_coords, self.y_coords]),
@@ -237,29 +452,30 @@ class SpatialScore:
                                          y_min:y_max:grid_size*1j]
         
         # Compute density
-        positions = np.vstack([self._xi.ravel(), self._yi.ravel()])
-        self._density = self._kde(positions).reshape(self._xi.shape)
+        if method == 'fft':
+            self._density = binned_kde(self._kde, self._xi, self._yi)
+        else:
+            positions = np.vstack([self._xi.ravel(), self._yi.ravel()])
+            self._density = self._kde(positions).reshape(self._xi.shape)
         
         # Generate automatic hull mask if no custom mask provided
         if self.mask is None:
             self._generate_hull_mask()
         else:
-            if self.mask.shape != self._xi.shape:
+            # 0/1 masks would otherwise index grid points by position
+            mask = np.asarray(self.mask, dtype=bool)
+            if mask.shape != self._xi.shape:
                 raise ValueError("Provided mask shape must match grid shape")
-            self._hull_mask = self.mask
+            self._hull_mask = mask
             
         return self
 
     def _generate_hull_mask(self):
-        """Generate convex hull mask for the tissue area"""
-        coords = np.column_stack([self.x_coords, self.y_coords])
-        hull = ConvexHull(coords)
-        hull_points = coords[hull.vertices]
-        
-        # Create mask using hull
-        points = np.vstack([self._xi.ravel(), self._yi.ravel()]).T
-        hull_path = Path(hull_points)
-        self._hull_mask = hull_path.contains_points(points).reshape(self._xi.shape)
+        """Generate the tissue mask, a convex hull by default, see rasterize_mask"""
+        self._hull_mask = rasterize_mask(
+            self.x_coords, self.y_coords, self._xi, self._yi,
+            self.mask_method, self.mask_radius
+        )
     
     
     def get_masked_density(self) -> np.ndarray:
@@ -343,13 +559,98 @@ def compute_correlation(score1: SpatialScore,
     else:
         raise ValueError("Method must be 'spearman' or 'pearson'")
 
-def create_common_mask(score_objects: List[SpatialScore], xi: np.ndarray, yi: np.ndarray) -> np.ndarray:
+def _compute_kde_worker(task: Tuple[SpatialScore, dict]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Worker function computing the KDE of one SpatialScore in a separate process."""
+    score, kde_kwargs = task
+    score.compute_kde(**kde_kwargs)
+    return score._density, score._hull_mask, score._xi, score._yi
+
+def _correlate_columns(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Pearson correlations and two-sided p-values between all columns of a matrix."""
+    n = values.shape[0]
+    centered = values - values.mean(axis=0)
+    norms = np.sqrt((centered ** 2).sum(axis=0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = (centered.T @ centered) / np.outer(norms, norms)
+        corr = np.clip(corr, -1, 1)
+        t = corr * np.sqrt((n - 2) / (1 - corr ** 2))
+    pval = 2 * stats.t.sf(np.abs(t), n - 2)
+    np.fill_diagonal(pval, 0)
+    return corr, pval
+
+def compute_correlation_matrix(score_objects: List[SpatialScore],
+                               method: str = 'spearman',
+                               n_workers: Optional[int] = None,
+                               **kde_kwargs) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Compute correlations between all pairs of spatial scores on a shared grid
+    
+    The masked densities are stacked once and all correlations are computed with one matrix
+    product, on ranks for 'spearman'. Results match compute_correlation for each pair. When
+    all scores share the same mask this is a single operation, otherwise each pair uses the
+    grid points inside both masks.
+    
+    Parameters:
+        score_objects: List of SpatialScore objects on the same grid
+        method: 'spearman' or 'pearson'
+        n_workers: Number of processes computing the missing KDEs, serial if None
+        kde_kwargs: Arguments of compute_kde for the scores without a KDE
+        
+    Returns:
+        correlation matrix and p-value matrix, indexed by score names
+    """
+    if method not in ['spearman', 'pearson']:
+        raise ValueError("Method must be 'spearman' or 'pearson'")
+    
+    # Compute missing KDEs, in parallel if requested
+    todo = [obj for obj in score_objects if obj._density is None]
+    if todo and n_workers is not None and n_workers > 1:
+        with Pool(min(n_workers, len(todo))) as p:
+            results = p.map(_compute_kde_worker, [(obj, kde_kwargs) for obj in todo])
+        for obj, (density, hull_mask, xi, yi) in zip(todo, results):
+            obj._density, obj._hull_mask, obj._xi, obj._yi = density, hull_mask, xi, yi
+    else:
+        for obj in todo:
+            obj.compute_kde(**kde_kwargs)
+    
+    shapes = set(obj._density.shape for obj in score_objects)
+    if len(shapes) > 1:
+        raise ValueError("All scores must share the same grid, see create_common_grid")
+    
+    # Stack densities and masks once, one column per score
+    densities = np.column_stack([obj._density.ravel() for obj in score_objects])
+    masks = np.column_stack([
+        np.asarray(obj._hull_mask, dtype=bool).ravel() for obj in score_objects])
+    names = [obj.score_name for obj in score_objects]
+    k = len(score_objects)
+    
+    def prepare(values):
+        return stats.rankdata(values, axis=0) if method == 'spearman' else values
+    
+    if (masks == masks[:, :1]).all():
+        corr, pval = _correlate_columns(prepare(densities[masks[:, 0]]))
+    else:
+        corr, pval = np.eye(k), np.zeros((k, k))
+        for i in range(k):
+            for j in range(i + 1, k):
+                valid = masks[:, i] & masks[:, j]
+                c, p = _correlate_columns(prepare(densities[valid][:, [i, j]]))
+                corr[i, j] = corr[j, i] = c[0, 1]
+                pval[i, j] = pval[j, i] = p[0, 1]
+    
+    return (pd.DataFrame(corr, index=names, columns=names),
+            pd.DataFrame(pval, index=names, columns=names))
+
+def create_common_mask(score_objects: List[SpatialScore], xi: np.ndarray, yi: np.ndarray,
+                       method: str = 'hull', radius: Optional[float] = None) -> np.ndarray:
     """
     Create a common mask using all cell coordinates from all score objects
     
     Parameters:
         score_objects: List of SpatialScore objects
         xi, yi: Grid coordinates
+        method: 'hull' or 'occupancy', see rasterize_mask
+        radius: Closing radius of the occupancy mask
         
     Returns:
         mask: Common binary mask
@@ -357,16 +658,7 @@ def create_common_mask(score_objects: List[SpatialScore], xi: np.ndarray, yi: np
     # Combine all cell coordinates
     all_x_coords = np.concatenate([obj.x_coords for obj in score_objects])
     all_y_coords = np.concatenate([obj.y_coords for obj in score_objects])
-    
-    # Create convex hull from all coordinates
-    coords = np.column_stack([all_x_coords, all_y_coords])
-    hull = ConvexHull(coords)
-    hull_points = coords[hull.vertices]
-    
-    # Create mask using hull
-    points = np.vstack([xi.ravel(), yi.ravel()]).T
-    hull_path = Path(hull_points)
-    return hull_path.contains_points(points).reshape(xi.shape)
+    return rasterize_mask(all_x_coords, all_y_coords, xi, yi, method, radius)
 
 # Example usage:
 # """
@@ -406,6 +698,10 @@ def create_common_mask(score_objects: List[SpatialScore], xi: np.ndarray, yi: np
 # fibro_spatialscore.compute_kde()
 
 # corr, pval = compute_correlation(endo_spatialscore, fibro_spatialscore)
+#
+# # Or all pairs of many scores at once, computing their KDEs in 4 processes
+# corr_df, pval_df = compute_correlation_matrix(
+#     [endo_spatialscore, fibro_spatialscore, tumor_spatialscore], method='spearman', n_workers=4)
 # """
 
 
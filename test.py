@@ -42,3 +42,70 @@ if codes == 0:
 else:
     print('Test failed, please check log at {}'.format(output_path))
         
+
+print('Testing Spacia in float32 mode against the float64 model inputs')
+output_path_32 = os.path.join(test_path,'single_gene_simple_agg_float32')
+params = '-rc A -sc B -rf gene1 -sf gene2,gene3 -d 5 -m 2000,1000,10,1 -nc 20 --float32'
+cmd = 'python {} {} {} {} -o {}'.format(
+    spacia_fn, counts_fn, meta_fn, params, output_path_32)
+codes = os.system(cmd)
+if codes == 0:
+    import json
+    import numpy as np
+    # model_input values are rounded to 3 (sender features) and 5 (distances)
+    # decimals, float32 may change them by one rounding step
+    tolerances = {'exp_sender.json': 1.5e-3, 'dist_sender.json': 1.5e-5}
+    max_diffs = {}
+    for fn in tolerances:
+        with open(os.path.join(test_path, 'single_gene_simple_agg', 'model_input', fn)) as f:
+            res_64 = json.load(f)
+        with open(os.path.join(output_path_32, 'model_input', fn)) as f:
+            res_32 = json.load(f)
+        max_diffs[fn] = max(
+            np.abs(np.array(res_64[x]) - np.array(res_32[x])).max() for x in res_64)
+    if all(max_diffs[x] <= tolerances[x] for x in tolerances):
+        print('Test Succeeded.')
+    else:
+        print('Test failed, float32 differences {} exceed {}'.format(max_diffs, tolerances))
+else:
+    print('Test failed, please check log at {}'.format(output_path_32))
+
+print('Testing the work queue with two local workers, one of them killed')
+import sys
+import time
+import shutil
+import tempfile
+import contextlib
+import subprocess
+sys.path.append(os.path.join(os.path.dirname(spacia_path), 'spacia'))
+from Work_Queue import WorkQueue
+queue_dir = tempfile.mkdtemp()
+worker_cmd = [
+    sys.executable, os.path.join(os.path.dirname(spacia_path), 'spacia', 'Work_Queue.py'),
+    queue_dir, '--slots', '1', '--heartbeat_interval', '0.5']
+out_fns = [os.path.join(queue_dir, 'job_{}.txt'.format(i)) for i in range(4)]
+# the driver messages of the reassignment are not part of the test output
+with contextlib.redirect_stdout(open(os.devnull, 'w')), \
+        WorkQueue(queue_dir, dead_after=3, poll_interval=0.5) as work_queue:
+    jobs = [
+        work_queue.submit('job_{}'.format(i), 'sleep 2 && echo {} > {}'.format(i, fn))
+        for i, fn in enumerate(out_fns)]
+    workers = [
+        subprocess.Popen(worker_cmd + ['--run_id', work_queue.run_id], stdout=subprocess.DEVNULL)
+        for _ in range(2)]
+    # kill the first worker while it runs a job, without completion marker
+    heartbeats = os.path.join(work_queue.run_dir, 'heartbeats')
+    while len(os.listdir(heartbeats)) < 2:
+        time.sleep(0.1)
+    workers[0].kill()
+    records = [job.get(timeout=120) for job in jobs]
+workers[1].wait(timeout=60)
+if (
+    all(x['returncode'] == 0 for x in records)
+    and any(x.get('attempt', 0) > 0 for x in records)
+    and all(os.path.exists(fn) for fn in out_fns)
+):
+    print('Test Succeeded.')
+else:
+    print('Test failed, work queue records: {}'.format(records))
+shutil.rmtree(queue_dir)